@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+"""Memory allocated per record from structlog to the transport.
+
+Run from the repository root (Python 3) with::
+
+    python -m benchmarks.bench_allocations
+
+Each configuration logs events carrying a 2-8 KB traceback through a
+:class:`graystruct.encoder.GELFEncoder` to two graystruct handlers whose
+``send`` discards the payload, as with the HTTP + AMQP setup from the
+README.  ``tracemalloc`` reports the peak memory allocated while
+handling a single record, both with compression (dominated by the zlib
+state) and with compression disabled, which isolates the cost of
+materializing the payload.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import logging
+import tracemalloc
+
+from structlog import wrap_logger
+
+from graystruct.encoder import GELFEncoder, available_serializers
+from graystruct.handler import GELFHandler, _get_payload
+
+
+class NullGELFHandler(GELFHandler):
+
+    def send(self, data):
+        pass
+
+
+class UncompressedNullGELFHandler(NullGELFHandler):
+
+    def makePickle(self, record):
+        return _get_payload(record)
+
+
+def make_exception(size):
+    frame = ('  File "/srv/app/module.py", line 123, in handler\n'
+             '    result = process(request, retries=3)\n')
+    lines = ['Traceback (most recent call last):\n']
+    while sum(len(line) for line in lines) < size:
+        lines.append(frame)
+    lines.append('ValueError: could not process request\n')
+    return ''.join(lines)
+
+
+def measure(encoder, exception, count, handler_class):
+    std_logger = logging.Logger('benchmark', logging.DEBUG)
+    for _ in range(2):
+        std_logger.addHandler(handler_class('localhost'))
+    logger = wrap_logger(std_logger, processors=[encoder])
+    logger.error('request.failed', exception=exception, user='someone')
+
+    peaks = 0
+    tracemalloc.start()
+    try:
+        for _ in range(count):
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            logger.error(
+                'request.failed', exception=exception, user='someone')
+            peaks += tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+    return peaks / count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=500)
+    args = parser.parse_args(argv)
+    configurations = [('json', False), ('json', True)]
+    if 'orjson' in available_serializers():
+        configurations.append(('orjson', False))
+    print('{:>10} {:>10} {:>12} {:>16} {:>16}'.format(
+        'serializer', 'as_bytes', 'event size', 'peak B (zlib)',
+        'peak B (no zlib)'))
+    for size in (2048, 4096, 8192):
+        exception = make_exception(size)
+        for serializer, as_bytes in configurations:
+            encoder = GELFEncoder(
+                fqdn=False, localname='host', serializer=serializer,
+                as_bytes=as_bytes)
+            compressed = measure(
+                encoder, exception, args.count, NullGELFHandler)
+            uncompressed = measure(
+                encoder, exception, args.count, UncompressedNullGELFHandler)
+            print('{:>10} {:>10} {:>12} {:>16.0f} {:>16.0f}'.format(
+                serializer, str(as_bytes), size, compressed, uncompressed))
+
+
+if __name__ == '__main__':
+    main()
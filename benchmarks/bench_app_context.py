@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+"""Cost of :func:`graystruct.utils.add_app_context` by stack depth.
+
+Run from the repository root with::
+
+    python -m benchmarks.bench_app_context
+
+``before`` is the original implementation built on structlog's
+``_find_first_app_frame_and_name``; ``after`` is the current processor.
+``depth`` is the number of ignored (``logging``-like) frames between
+the call site and the processor, in addition to the application frames
+below the call site.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import logging
+import timeit
+
+from structlog._frames import _find_first_app_frame_and_name
+
+from graystruct.utils import add_app_context
+
+
+# Compiled as if it lived in ``graystruct.utils``, like the original.
+_REFERENCE_SOURCE = '''
+def reference_add_app_context(logger, method_name, event_dict):
+    f, name = _find_first_app_frame_and_name(['logging', __name__])
+    event_dict['file'] = f.f_code.co_filename
+    event_dict['line'] = f.f_lineno
+    event_dict['function'] = f.f_code.co_name
+    return event_dict
+'''
+_reference_namespace = {
+    '__name__': 'graystruct.utils',
+    '_find_first_app_frame_and_name': _find_first_app_frame_and_name,
+}
+exec(compile(_REFERENCE_SOURCE, '<graystruct.utils>', 'exec'),
+     _reference_namespace)
+reference_add_app_context = _reference_namespace['reference_add_app_context']
+
+
+# Compiled as if it lived in a ``logging`` submodule, so that its frames
+# are skipped like those of the logging machinery.
+_IGNORED_SOURCE = '''
+def call_through(depth, processor, logger):
+    if depth:
+        return call_through(depth - 1, processor, logger)
+    return processor(logger, 'warning', {})
+'''
+_ignored_namespace = {'__name__': 'logging.benchmark'}
+exec(compile(_IGNORED_SOURCE, '<logging.benchmark>', 'exec'),
+     _ignored_namespace)
+call_through = _ignored_namespace['call_through']
+
+
+def calls_per_second(processor, depth, number):
+    logger = logging.getLogger('benchmark')
+    def log():
+        return call_through(depth, processor, logger)
+    timer = timeit.Timer(log)
+    return number / min(timer.repeat(repeat=3, number=number))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args(argv)
+    print('{:>8} {:>14} {:>14} {:>8}'.format(
+        'depth', 'before calls/s', 'after calls/s', 'speedup'))
+    for depth in (0, 5, 20, 50):
+        old = calls_per_second(reference_add_app_context, depth, args.number)
+        new = calls_per_second(add_app_context, depth, args.number)
+        print('{:>8} {:>14.0f} {:>14.0f} {:>7.2f}x'.format(
+            depth, old, new, new / old))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+"""CPU time and bytes on the wire of GELF payload compression settings.
+
+Run from the repository root with::
+
+    python -m benchmarks.bench_compression
+
+For each payload size, every compression setting is applied through
+``_CompressHandler.compress_payload`` (``makePickle`` would return the
+payload cached on the record) and the CPU time per record (in
+microseconds) and the resulting payload size are reported.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import time
+
+from graystruct.handler import _CompressHandler, GZIP
+
+
+SETTINGS = [
+    ('none', dict(threshold=float('inf'))),
+    ('zlib -1', dict()),
+    ('zlib 1', dict(level=1)),
+    ('zlib 1 mem1', dict(level=1, memlevel=1)),
+    ('zlib 9', dict(level=9)),
+    ('gzip -1', dict(codec=GZIP)),
+    ('gzip 1 mem1', dict(codec=GZIP, level=1, memlevel=1)),
+]
+
+
+def make_payload(size):
+    event = {
+        'version': '1.1',
+        'host': 'web-01.example.com',
+        'short_message': 'user.login',
+        'level': 4,
+        '_pid': 12345,
+        '_logger': 'app.views',
+        '_level_name': 'WARNING',
+        '_file': '/srv/app/views.py',
+        '_line': 123,
+        '_function': 'login',
+    }
+    index = 0
+    while len(json.dumps(event)) < size:
+        event['_field_{}'.format(index)] = 'value {} of {}'.format(
+            index, size)
+        index += 1
+    return json.dumps(event).encode('utf-8')[:size]
+
+
+def measure(handler, payload, number):
+    start = time.process_time()
+    for _ in range(number):
+        data = handler.compress_payload(payload)
+    elapsed = time.process_time() - start
+    return elapsed / number * 1e6, len(data)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=5000)
+    args = parser.parse_args(argv)
+    handler = _CompressHandler()
+    print('{:>8} {:>14} {:>10} {:>10}'.format(
+        'size', 'setting', 'us/record', 'bytes'))
+    for size in (150, 500, 1500, 4000, 16000):
+        payload = make_payload(size)
+        for name, settings in SETTINGS:
+            handler.set_compression(**settings)
+            cpu, length = measure(handler, payload, args.number)
+            print('{:>8} {:>14} {:>10.1f} {:>10}'.format(
+                size, name, cpu, length))
+
+
+if __name__ == '__main__':
+    main()
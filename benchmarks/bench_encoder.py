@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+"""Records/sec of :class:`graystruct.encoder.GELFEncoder` by event size.
+
+Run from the repository root with::
+
+    python -m benchmarks.bench_encoder
+
+``before`` is the original copy-and-translate implementation, kept here
+as a reference; ``after`` is the current encoder.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import logging
+import os
+import timeit
+
+from graypy.handler import SYSLOG_LEVELS
+from structlog.processors import JSONRenderer
+from structlog.stdlib import _NAME_TO_LEVEL
+
+from graystruct.encoder import GELFEncoder, _get_gelf_compatible_key
+
+
+class ReferenceGELFEncoder(GELFEncoder):
+    """The encoder as it was before the single-pass rewrite."""
+
+    def _translate_non_gelf_keys(self, event_dict):
+        return {
+            _get_gelf_compatible_key(key): value
+            for key, value in event_dict.items()
+        }
+
+    def __call__(self, logger, method_name, event_dict):
+        event_dict = event_dict.copy()
+        levelno = _NAME_TO_LEVEL[method_name]
+
+        gelf_dict = {
+            'version': '1.1',
+            'host': self.host,
+            'level': SYSLOG_LEVELS.get(levelno, levelno),
+        }
+
+        message = gelf_dict['short_message'] = event_dict.pop('event', '')
+
+        if 'exception' in event_dict:
+            exc = event_dict.pop('exception')
+            gelf_dict['full_message'] = '\n'.join([message, exc])
+
+        gelf_dict['_pid'] = os.getpid()
+        gelf_dict['_logger'] = logger.name
+        gelf_dict['_level_name'] = logging.getLevelName(levelno)
+
+        gelf_dict.update(self._translate_non_gelf_keys(event_dict))
+
+        return JSONRenderer.__call__(self, logger, method_name, gelf_dict)
+
+
+def make_event(fields):
+    event = {'event': 'user.login'}
+    for index in range(fields - 1):
+        if index % 3 == 0:
+            event['field_{}'.format(index)] = index
+        else:
+            event['field_{}'.format(index)] = 'value {}'.format(index)
+    return event
+
+
+def records_per_second(encoder, event, number):
+    logger = logging.getLogger('benchmark')
+    timer = timeit.Timer(lambda: encoder(logger, 'warning', event))
+    return number / min(timer.repeat(repeat=3, number=number))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000)
+    parser.add_argument(
+        '--serializer', default='json',
+        help='JSON backend for the current encoder (default: json)')
+    args = parser.parse_args(argv)
+    before = ReferenceGELFEncoder(fqdn=False, localname='host')
+    after = GELFEncoder(
+        fqdn=False, localname='host', serializer=args.serializer)
+    print('{:>8} {:>14} {:>14} {:>8}'.format(
+        'fields', 'before rec/s', 'after rec/s', 'speedup'))
+    for fields in (5, 20, 100):
+        event = make_event(fields)
+        old = records_per_second(before, event, args.number)
+        new = records_per_second(after, event, args.number)
+        print('{:>8} {:>14.0f} {:>14.0f} {:>7.2f}x'.format(
+            fields, old, new, new / old))
+
+
+if __name__ == '__main__':
+    main()
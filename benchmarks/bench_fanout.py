@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+"""CPU time per record when shipping to several destinations.
+
+Run from the repository root (Python 3) with::
+
+    python -m benchmarks.bench_fanout
+
+``independent`` attaches one handler per destination that compresses
+each record itself, as graystruct did before payloads were cached on
+the record; ``shared`` attaches one handler per destination sharing the
+cached payload; ``fanout`` attaches a single
+:class:`graystruct.fanout.FanoutGELFHandler`, which adds a queue and a
+thread per destination, so its cost grows by a queue hand-off for each
+destination while ``shared`` stays roughly flat.  Destinations discard the payloads, so the
+figures are the encoding, compression and dispatch cost (best of three
+runs, process CPU time, all threads included).
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import logging
+import time
+
+from structlog import wrap_logger
+
+from graystruct.encoder import GELFEncoder
+from graystruct.fanout import FanoutGELFHandler
+from graystruct.handler import _CompressHandler, _get_payload
+
+
+class NullTransport(_CompressHandler, logging.Handler):
+
+    def send(self, data):
+        pass
+
+    def emit(self, record):
+        self.send(self.makePickle(record))
+
+
+class UncachedNullTransport(NullTransport):
+
+    def makePickle(self, record):
+        return self.compress_payload(_get_payload(record))
+
+
+def cpu_per_record(make_handlers, number):
+    return min(_cpu_per_record(make_handlers(), number) for _ in range(3))
+
+
+def _cpu_per_record(handlers, number):
+    std_logger = logging.Logger('benchmark', logging.DEBUG)
+    for handler in handlers:
+        std_logger.addHandler(handler)
+    logger = wrap_logger(std_logger, processors=[
+        GELFEncoder(fqdn=False, localname='host')])
+    fields = {'field_{}'.format(index): 'value {}'.format(index)
+              for index in range(40)}
+    start = time.process_time()
+    for index in range(number):
+        logger.warning('request.done', attempt=index, **fields)
+    for handler in handlers:
+        handler.close()
+    return (time.process_time() - start) / number * 1e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args(argv)
+    print('{:>12} {:>18} {:>14} {:>14}'.format(
+        'destinations', 'independent us/rec', 'shared us/rec',
+        'fanout us/rec'))
+    for count in (1, 2, 4):
+        independent = cpu_per_record(
+            lambda: [UncachedNullTransport() for _ in range(count)],
+            args.number)
+        shared = cpu_per_record(
+            lambda: [NullTransport() for _ in range(count)], args.number)
+        fanout = cpu_per_record(
+            lambda: [FanoutGELFHandler(
+                [NullTransport() for _ in range(count)])],
+            args.number)
+        print('{:>12} {:>18.1f} {:>14.1f} {:>14.1f}'.format(
+            count, independent, shared, fanout))
+
+
+if __name__ == '__main__':
+    main()
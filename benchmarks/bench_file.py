@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+"""Records/sec and write calls of GELFFileHandler against FileHandler.
+
+Run from the repository root with::
+
+    python -m benchmarks.bench_file
+
+``logging.FileHandler`` formats each record and flushes after it, one
+``write`` per record; :class:`graystruct.file.GELFFileHandler` appends
+the encoded payload to a buffer written out every ``buffer_size``
+bytes.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from graystruct.file import GELFFileHandler
+
+PAYLOAD = (
+    '{"version": "1.1", "host": "host", "short_message": "request.done", '
+    '"level": 4, "_logger": "benchmark", "_path": "/v1/invoices", '
+    '"_status": 200, "_duration": 0.0123}')
+
+
+def records_per_second(handler, number):
+    record = logging.makeLogRecord({'msg': PAYLOAD})
+    start = time.time()
+    for _ in range(number):
+        handler.handle(record)
+    handler.close()
+    return number / (time.time() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=200000)
+    args = parser.parse_args(argv)
+    directory = tempfile.mkdtemp()
+    try:
+        plain = logging.FileHandler(os.path.join(directory, 'plain.log'))
+        plain_rate = records_per_second(plain, args.number)
+        gelf = GELFFileHandler(
+            os.path.join(directory, 'app.gelf'), max_bytes=64 * 1024 * 1024)
+        gelf_rate = records_per_second(gelf, args.number)
+    finally:
+        shutil.rmtree(directory)
+    print('{:>16} {:>12} {:>10}'.format('handler', 'records/s', 'writes'))
+    print('{:>16} {:>12.0f} {:>10}'.format(
+        'FileHandler', plain_rate, args.number))
+    print('{:>16} {:>12.0f} {:>10}'.format(
+        'GELFFileHandler', gelf_rate, gelf.writes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+"""Requests/sec and connections opened by :class:`GELFHandler`.
+
+Run from the repository root with::
+
+    python -m benchmarks.bench_http
+
+Records are sent to a local ``http.server`` stand-in for a Graylog GELF
+HTTP input, with and without keep-alive connections.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import logging
+import time
+
+from graystruct.handler import GELFHandler
+from graystruct.tests.test_handler import GELFHTTPInput
+
+
+def run(count, keep_alive):
+    server = GELFHTTPInput()
+    try:
+        handler = GELFHandler('127.0.0.1', server.port, keep_alive=keep_alive)
+        record = logging.makeLogRecord(
+            {'msg': '{"short_message": "benchmark", "_answer": 42}'})
+        start = time.time()
+        for _ in range(count):
+            handler.emit(record)
+        elapsed = time.time() - start
+        handler.close()
+        return count / elapsed, server.connections
+    finally:
+        server.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=2000)
+    args = parser.parse_args(argv)
+    print('{:>12} {:>12} {:>12}'.format('keep-alive', 'requests/s', 'opened'))
+    for keep_alive in (False, True):
+        rate, opened = run(args.count, keep_alive)
+        print('{:>12} {:>12.0f} {:>12}'.format(str(keep_alive), rate, opened))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+"""Throughput of :class:`graystruct.rabbitmq.RabbitSocket` by batch size.
+
+Run from the repository root with::
+
+    python -m benchmarks.bench_rabbit_batching
+
+The broker is replaced by an in-process fake channel.  Each publish
+costs a small fixed amount of work (framing the message) and, in
+confirm mode, each wait for a broker acknowledgement costs a simulated
+network round trip of ``--rtt`` seconds.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import time
+import zlib
+from collections import defaultdict
+
+from mock import patch
+
+from graystruct.rabbitmq import RabbitSocket
+
+
+PAYLOAD = zlib.compress(b'{"short_message": "benchmark", "_answer": 42}' * 8)
+
+
+class FakeChannel(object):
+
+    def __init__(self, rtt):
+        self.rtt = rtt
+        self.events = defaultdict(set)
+        self.published = 0
+
+    def exchange_declare(self, **kwargs):
+        pass
+
+    def confirm_select(self):
+        pass
+
+    def basic_publish(self, msg, exchange):
+        # Roughly the cost of serializing the frame for the wire
+        bytes(bytearray(msg.body))
+        self.published += 1
+
+    def wait(self, allowed_methods=None, timeout=None):
+        time.sleep(self.rtt)
+        for callback in self.events['basic_ack']:
+            callback(self.published, True)
+
+
+def _connection_factory(rtt):
+    class FakeConnection(object):
+        def __init__(self, **kwargs):
+            self._channel = FakeChannel(rtt)
+
+        def channel(self):
+            return self._channel
+
+        def close(self):
+            pass
+    return FakeConnection
+
+
+def run(batch_size, count, confirm, rtt):
+    with patch('amqp.Connection', _connection_factory(rtt)):
+        sock = RabbitSocket(
+            {}, 1, 'logging.gelf', 'fanout',
+            batch_size=batch_size, confirm=confirm)
+    start = time.time()
+    for _ in range(count):
+        sock.sendall(PAYLOAD)
+    sock.flush()
+    elapsed = time.time() - start
+    return count / elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--rtt', type=float, default=0.0002)
+    args = parser.parse_args(argv)
+    print('{:>10} {:>16} {:>16}'.format(
+        'batch', 'msgs/s', 'msgs/s confirm'))
+    for batch_size in (1, 10, 100, 1000):
+        plain = run(batch_size, args.count, False, args.rtt)
+        confirmed = run(batch_size, args.count, True, args.rtt)
+        print('{:>10} {:>16.0f} {:>16.0f}'.format(
+            batch_size, plain, confirmed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+"""Records/sec forwarded from worker processes to one sender.
+
+Run from the repository root with::
+
+    python -m benchmarks.bench_sender
+
+Each worker process logs through a
+:class:`graystruct.sender.GELFForwardingHandler`; a
+:class:`graystruct.sender.GELFSender` thread in this process compresses
+the payloads and counts them.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from graystruct.handler import _CompressHandler
+from graystruct.sender import GELFForwardingHandler, GELFSender
+
+
+class CountingHandler(_CompressHandler, logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.count = 0
+
+    def emit(self, record):
+        self.makePickle(record)
+        self.count += 1
+
+
+def worker(path, count):
+    handler = GELFForwardingHandler(path)
+    record = logging.makeLogRecord(
+        {'msg': '{"short_message": "benchmark", "_answer": 42}'})
+    for _ in range(count):
+        handler.handle(record)
+    handler.close()
+
+
+def run(path, workers, count):
+    counter = CountingHandler()
+    sender = GELFSender(path, [counter])
+    thread = threading.Thread(target=sender.serve_forever)
+    thread.daemon = True
+    thread.start()
+    context = multiprocessing.get_context('fork')
+    processes = [
+        context.Process(target=worker, args=(path, count))
+        for _ in range(workers)
+    ]
+    start = time.time()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    deadline = time.time() + 60
+    while counter.count < workers * count and time.time() < deadline:
+        time.sleep(0.001)
+    elapsed = time.time() - start
+    sender.shutdown()
+    sender.server_close()
+    return counter.count / elapsed, workers * count - counter.count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=20000)
+    args = parser.parse_args(argv)
+    tempdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tempdir, 'sender.sock')
+        print('{:>8} {:>12} {:>8}'.format('workers', 'records/s', 'lost'))
+        for workers in (1, 2, 4, 8):
+            rate, lost = run(path, workers, args.count // workers)
+            print('{:>8} {:>12.0f} {:>8}'.format(workers, rate, lost))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+"""Records/sec of GELFEncoder with static fields and cached bound fields.
+
+Run from the repository root with::
+
+    python -m benchmarks.bench_static_fields
+
+Each event has 5 service-wide fields, 8 fields bound to the logger and
+the rest passed to the logging call.  ``plain`` binds all of them to a
+regular dict context; ``cached`` declares the service-wide fields as
+``static_fields`` and binds the others to a
+:class:`graystruct.encoder.CachedContext`.  Both build the event dict
+the way structlog does, by copying the context and adding the call's
+fields.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import logging
+import timeit
+
+from graystruct.encoder import CachedContext, GELFEncoder
+
+STATIC = {
+    'service': 'billing-api',
+    'environment': 'production',
+    'build': '2016.05.1-4f2a9c1',
+    'region': 'eu-west-1',
+    'team': 'payments',
+}
+
+BOUND = {
+    'request_id': '9a1f0c3e-5d2b-4c1e-8f7a-0b6d2e4c9f11',
+    'user': 'sjagoe',
+    'account': 12345,
+    'method': 'POST',
+    'path': '/v1/invoices',
+    'client_ip': '10.1.2.3',
+    'session': 'f00dfeed',
+    'tenant': 'enthought',
+}
+
+
+def call_fields(count):
+    fields = {'event': 'invoice.created'}
+    for index in range(count):
+        fields['field_{}'.format(index)] = index if index % 2 else 'value'
+    return fields
+
+
+def records_per_second(encoder, context, fields, number):
+    logger = logging.getLogger('benchmark')
+
+    def log():
+        event_dict = context.copy()
+        event_dict.update(fields)
+        encoder(logger, 'warning', event_dict)
+    return number / min(timeit.Timer(log).repeat(repeat=3, number=number))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000)
+    parser.add_argument('--serializer', default='json')
+    args = parser.parse_args(argv)
+    plain = GELFEncoder(
+        fqdn=False, localname='host', serializer=args.serializer)
+    cached = GELFEncoder(
+        fqdn=False, localname='host', serializer=args.serializer,
+        static_fields=STATIC)
+    plain_context = dict(STATIC, **BOUND)
+    cached_context = CachedContext(BOUND)
+    print('{:>8} {:>14} {:>14} {:>8}'.format(
+        'fields', 'plain rec/s', 'cached rec/s', 'speedup'))
+    for total in (15, 20, 25):
+        fields = call_fields(total - len(STATIC) - len(BOUND))
+        old = records_per_second(plain, plain_context, fields, args.number)
+        new = records_per_second(
+            cached, cached_context, fields, args.number)
+        print('{:>8} {:>14.0f} {:>14.0f} {:>7.2f}x'.format(
+            total, old, new, new / old))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+"""Frames/sec through :class:`graystruct.handler.GELFTCPHandler`.
+
+Run from the repository root with::
+
+    python -m benchmarks.bench_tcp
+
+Several threads log through one handler to a local TCP server that
+counts null-byte terminated frames.  The number of write calls shows
+how much the handler coalesces frames under contention.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import logging
+import threading
+import time
+
+from graystruct.handler import GELFTCPHandler
+from graystruct.tests.test_handler import TCPCollector
+
+
+def run(threads, count):
+    collector = TCPCollector()
+    handler = GELFTCPHandler('127.0.0.1', collector.port)
+    record = logging.makeLogRecord(
+        {'msg': '{"short_message": "benchmark", "_answer": 42}'})
+
+    def log():
+        for _ in range(count):
+            handler.handle(record)
+
+    workers = [threading.Thread(target=log) for _ in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    collector.wait_for(threads * count, timeout=60)
+    elapsed = time.time() - start
+    handler.close()
+    collector.close()
+    return threads * count / elapsed, handler.writes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=20000)
+    args = parser.parse_args(argv)
+    print('{:>8} {:>12} {:>10}'.format('threads', 'frames/s', 'writes'))
+    for threads in (1, 2, 4, 8):
+        rate, writes = run(threads, args.count // threads)
+        print('{:>8} {:>12.0f} {:>10}'.format(threads, rate, writes))
+
+
+if __name__ == '__main__':
+    main()
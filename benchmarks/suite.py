@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+"""Benchmark suite for the structlog -> GELFEncoder -> handler pipeline.
+
+Run from the repository root (Python 3) with::
+
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --compare results.json
+
+Each case reports operations per second, per-operation latency
+percentiles and the peak memory allocated by one operation.  Results
+are saved as JSON together with the git revision; ``--compare`` prints
+the ratio of each case's throughput to a saved run.  Network transports
+are replaced by in-process fakes.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import collections
+import json
+import logging
+import platform
+import subprocess
+import sys
+import time
+import traceback
+import tracemalloc
+
+from mock import patch
+from structlog import wrap_logger
+from structlog.processors import format_exc_info
+from structlog.stdlib import filter_by_level
+
+from graystruct import handler as handler_module
+from graystruct.encoder import GELFEncoder
+from graystruct.handler import GELFHandler, _CompressHandler
+from graystruct.rabbitmq import GELFRabbitHandler, _pool
+from graystruct.utils import (
+    add_app_context, ExceptionFormatter, filter_by_handler_level)
+
+from .bench_app_context import call_through
+from .bench_rabbit_batching import _connection_factory
+
+CASES = collections.OrderedDict()
+
+
+def case(name):
+    """Register a benchmark case.
+
+    The decorated generator sets up the case, yields the operation to
+    measure and then tears the case down.
+
+    """
+    def register(function):
+        CASES[name] = function
+        return function
+    return register
+
+
+def _exception_text():
+    try:
+        raise ValueError('benchmark')
+    except ValueError:
+        return traceback.format_exc() * 8
+
+
+EVENTS = {
+    'small': {'event': 'user.login', 'user': 'sjagoe'},
+    'medium': dict(
+        {'event': 'user.login'},
+        **{'field_{}'.format(index): index for index in range(20)}),
+    'large': dict(
+        {'event': 'user.login'},
+        **{'field_{}'.format(index): 'value {}'.format(index)
+           for index in range(100)}),
+    'nested': {
+        'event': 'request.done',
+        'request': {'method': 'POST', 'headers': {'a': '1', 'b': '2'}},
+        'items': [{'id': index, 'tags': ['x', 'y']} for index in range(10)],
+    },
+    'exception': {'event': 'request.failed', 'exception': _exception_text()},
+}
+
+
+def _encoder_case(shape):
+    def run():
+        encoder = GELFEncoder(fqdn=False, localname='host')
+        logger = logging.getLogger('benchmark')
+        event = EVENTS[shape]
+        yield lambda: encoder(logger, 'warning', dict(event))
+    return run
+
+
+for _shape in EVENTS:
+    case('encoder.{}'.format(_shape))(_encoder_case(_shape))
+
+
+def _app_context_case(depth):
+    def run():
+        logger = logging.getLogger('benchmark')
+        yield lambda: call_through(depth, add_app_context, logger)
+    return run
+
+
+for _depth in (0, 10, 50):
+    case('app_context.depth_{}'.format(_depth))(_app_context_case(_depth))
+
+
+def _compress_case(size):
+    def run():
+        compressor = _CompressHandler()
+        unit = b'{"short_message": "benchmark", "_answer": 42}'
+        payload = (unit * (size // len(unit) + 1))[:size]
+        # makePickle would return the payload cached on a reused record
+        yield lambda: compressor.compress_payload(payload)
+    return run
+
+
+for _size in (100, 1000, 10000, 100000):
+    case('make_pickle.{}b'.format(_size))(_compress_case(_size))
+
+
+class FakeHTTPResponse(object):
+    status = 202
+    reason = 'Accepted'
+    will_close = False
+
+    def read(self):
+        return b''
+
+
+class FakeHTTPConnection(object):
+
+    def __init__(self, **kwargs):
+        pass
+
+    def request(self, method, url, body, headers):
+        pass
+
+    def getresponse(self):
+        return FakeHTTPResponse()
+
+    def close(self):
+        pass
+
+
+def _pipeline_logger(handler):
+    std_logger = logging.Logger('benchmark', logging.DEBUG)
+    std_logger.addHandler(handler)
+    return wrap_logger(std_logger, processors=[
+        add_app_context, GELFEncoder(fqdn=False, localname='host')])
+
+
+@case('pipeline.http')
+def http_pipeline():
+    with patch.object(
+            handler_module.httplib, 'HTTPConnection', FakeHTTPConnection):
+        handler = GELFHandler('localhost')
+        logger = _pipeline_logger(handler)
+        yield lambda: logger.warning('user.login', user='sjagoe', attempt=1)
+        handler.close()
+
+
+@case('pipeline.rabbitmq')
+def rabbitmq_pipeline():
+    with patch('amqp.Connection', _connection_factory(0)):
+        handler = GELFRabbitHandler('amqp://localhost/')
+        logger = _pipeline_logger(handler)
+        yield lambda: logger.warning('user.login', user='sjagoe', attempt=1)
+        handler.close()
+        _pool.clear()
+
+
+def _dropped_debug_case(level_filter):
+    def run():
+        std_logger = logging.Logger('benchmark', logging.DEBUG)
+        std_logger.addHandler(logging.NullHandler(logging.WARNING))
+        logger = wrap_logger(std_logger, processors=[
+            level_filter, add_app_context,
+            GELFEncoder(fqdn=False, localname='host')])
+        yield lambda: logger.debug('cache.miss', key='user:1', size=3)
+    return run
+
+
+case('dropped_debug.filter_by_level')(_dropped_debug_case(filter_by_level))
+case('dropped_debug.handler_level')(
+    _dropped_debug_case(filter_by_handler_level))
+
+
+def _raise_nested(depth):
+    if depth == 0:
+        raise ValueError('benchmark')
+    _raise_nested(depth - 1)
+
+
+def _exception_case(formatter):
+    def run():
+        try:
+            _raise_nested(10)
+        except ValueError as exc:
+            error = exc
+        yield lambda: formatter(None, 'error', {'exc_info': error})
+    return run
+
+
+case('exception.format_exc_info')(_exception_case(format_exc_info))
+case('exception.cached')(_exception_case(ExceptionFormatter()))
+
+
+def _percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+def measure(operation, min_time, samples):
+    # Calibrate the number of operations per timed batch
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            operation()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / 10:
+            break
+        number *= 2
+    best = elapsed
+    for _ in range(4):
+        start = time.perf_counter()
+        for _ in range(number):
+            operation()
+        best = min(best, time.perf_counter() - start)
+
+    timer = time.perf_counter
+    latencies = []
+    for _ in range(samples):
+        start = timer()
+        operation()
+        latencies.append(timer() - start)
+    latencies.sort()
+
+    peak = None
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.start()
+        try:
+            peaks = []
+            for _ in range(min(samples, 200)):
+                current = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                operation()
+                peaks.append(tracemalloc.get_traced_memory()[1] - current)
+        finally:
+            tracemalloc.stop()
+        peak = sorted(peaks)[len(peaks) // 2]
+
+    return {
+        'ops_per_sec': number / best,
+        'p50_us': _percentile(latencies, 0.50) * 1e6,
+        'p90_us': _percentile(latencies, 0.90) * 1e6,
+        'p99_us': _percentile(latencies, 0.99) * 1e6,
+        'peak_alloc_bytes': peak,
+    }
+
+
+def run_case(name, min_time, samples):
+    steps = CASES[name]()
+    operation = next(steps)
+    try:
+        return measure(operation, min_time, samples)
+    finally:
+        for _ in steps:
+            pass
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--filter', default='',
+        help='only run the cases whose name contains this string')
+    parser.add_argument(
+        '--min-time', type=float, default=0.5,
+        help='approximate seconds spent timing throughput per case')
+    parser.add_argument(
+        '--samples', type=int, default=2000,
+        help='operations timed individually for latency percentiles')
+    parser.add_argument('--output', help='save the results to this file')
+    parser.add_argument('--compare', help='results file to compare with')
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)['results']
+
+    header = '{:<24} {:>12} {:>9} {:>9} {:>9} {:>10}'.format(
+        'case', 'ops/s', 'p50 us', 'p90 us', 'p99 us', 'peak B')
+    if baseline:
+        header += ' {:>8}'.format('change')
+    print(header)
+    results = collections.OrderedDict()
+    for name in CASES:
+        if args.filter not in name:
+            continue
+        result = results[name] = run_case(name, args.min_time, args.samples)
+        line = '{:<24} {:>12.0f} {:>9.1f} {:>9.1f} {:>9.1f} {:>10}'.format(
+            name, result['ops_per_sec'], result['p50_us'], result['p90_us'],
+            result['p99_us'], result['peak_alloc_bytes'])
+        if name in baseline:
+            line += ' {:>7.2f}x'.format(
+                result['ops_per_sec'] / baseline[name]['ops_per_sec'])
+        print(line)
+        sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump({
+                'revision': _git_revision(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'results': results,
+            }, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+from __future__ import absolute_import
+
+import collections
+import json
+import logging
+import threading
+import time
+
+from .encoder import _get_gelf_compatible_key
+from .handler import _get_payload
+from .utils import _register_after_fork
+
+
+class AggregatingGELFHandler(logging.Handler):
+    """Collapse identical GELF records logged within a time window.
+
+    The first record (encoded by :class:`graystruct.encoder.GELFEncoder`)
+    with a given ``short_message``, ``_logger``, ``level`` and values of
+    ``fields`` is handed to ``target`` immediately and unchanged.  The
+    identical records logged within ``window`` seconds after it are
+    absorbed; when the window ends, one more record is handed on for
+    them, a copy of the first carrying ``_count`` (the number of records
+    absorbed), ``_first_seen`` and ``_last_seen`` (UNIX timestamps of
+    the first and last record of the group).  A record with no
+    duplicates therefore costs a single parse of its payload.
+
+    :param target: The graystruct handler that ships the records.
+    :param window: Seconds to hold the first record of each group.
+    :param fields: Other fields that must be equal for records to be
+        collapsed, e.g. ``('user', 'host')``.
+    :param max_entries: Maximum number of groups held; beyond it the
+        oldest group is ended early.
+
+    A background thread ends expired groups; :meth:`flush` and
+    :meth:`close` end all of them.  ``aggregated`` counts the records
+    absorbed into an earlier one.
+
+    """
+
+    def __init__(self, target, window=5, fields=(), max_entries=10000):
+        logging.Handler.__init__(self, level=target.level)
+        self.target = target
+        self.window = window
+        self.fields = tuple(_get_gelf_compatible_key(key) for key in fields)
+        self.max_entries = max_entries
+        self.aggregated = 0
+        # key -> [record, GELF dict, absorbed, first seen, last seen]
+        self._entries = collections.OrderedDict()
+        self._stopped = threading.Event()
+        self._start()
+        _register_after_fork(self)
+
+    def _start(self):
+        self._thread = threading.Thread(
+            target=self._run, name='graystruct-aggregating-handler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _after_fork(self):
+        # Groups held at the fork are handed on by the parent
+        self._entries = collections.OrderedDict()
+        if not self._stopped.is_set():
+            self._start()
+
+    def _key(self, gelf_dict):
+        fields = self.fields
+        extra = None
+        if fields:
+            extra = json.dumps(
+                [gelf_dict.get(key) for key in fields], sort_keys=True,
+                default=repr)
+        return (gelf_dict.get('short_message'), gelf_dict.get('_logger'),
+                gelf_dict.get('level'), extra)
+
+    def emit(self, record):
+        try:
+            payload = _get_payload(record)
+            gelf_dict = json.loads(bytes(payload).decode('utf-8'))
+            key = self._key(gelf_dict)
+        except Exception:
+            self.handleError(record)
+            return
+        evicted = None
+        entries = self._entries
+        entry = entries.get(key)
+        if entry is not None:
+            entry[2] += 1
+            entry[4] = record.created
+            self.aggregated += 1
+            return
+        if len(entries) >= self.max_entries:
+            _, evicted = entries.popitem(last=False)
+        entries[key] = [record, gelf_dict, 0, record.created, record.created]
+        self.target.handle(record)
+        if evicted is not None:
+            self._forward([evicted])
+
+    def _collapse(self, entry):
+        record, gelf_dict, count, first_seen, last_seen = entry
+        gelf_dict['_count'] = count
+        gelf_dict['_first_seen'] = first_seen
+        gelf_dict['_last_seen'] = last_seen
+        msg = json.dumps(gelf_dict)
+        if not isinstance(record.msg, type(msg)):
+            msg = msg.encode('utf-8')
+        collapsed = logging.makeLogRecord(record.__dict__)
+        collapsed.msg = msg
+        return collapsed
+
+    def _forward(self, entries):
+        for entry in entries:
+            if entry[2]:
+                self.target.handle(self._collapse(entry))
+
+    def _take(self, expired_before=None):
+        self.acquire()
+        try:
+            entries = self._entries
+            if expired_before is None:
+                taken = list(entries.values())
+                entries.clear()
+                return taken
+            taken = []
+            while entries:
+                key, entry = next(iter(entries.items()))
+                if entry[3] > expired_before:
+                    break
+                del entries[key]
+                taken.append(entry)
+            return taken
+        finally:
+            self.release()
+
+    def _run(self):
+        interval = min(self.window, 1.0) / 2
+        while not self._stopped.wait(interval):
+            self._forward(self._take(time.time() - self.window))
+
+    def flush(self):
+        """End every group, handing on its duplicates, and flush the target.
+        """
+        self._forward(self._take())
+        self.target.flush()
+
+    def close(self):
+        """Stop the timer thread, end every group and close the target.
+        """
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+        self.target.close()
+        logging.Handler.close(self)
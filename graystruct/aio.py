@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+"""Ship GELF records from asyncio applications without blocking the loop.
+
+:class:`AsyncGELFHandler` is a ``logging`` handler whose ``emit`` only
+appends the record to a bounded buffer.  A task running on the event
+loop ships the buffered records through a transport built on asyncio
+streams: :class:`TCPTransport`, :class:`UDPTransport` or
+:class:`HTTPTransport`.  Requires Python 3.7 or later.
+
+"""
+from __future__ import absolute_import
+
+import asyncio
+import collections
+import logging
+import random
+import struct
+import threading
+import zlib
+
+from .handler import (
+    GELF_CHUNK_HEADER_SIZE, GELF_CHUNK_MAGIC, GELF_MAX_CHUNKS, ZLIB,
+    _CompressHandler, _content_encoding, _get_payload)
+from .queued import DROP_NEWEST, DROP_OLDEST
+
+
+class TCPTransport(object):
+    """Write null-byte terminated records to a GELF TCP input.
+
+    :param host: GELF TCP input host.
+    :param port: GELF TCP input port (default 12201).
+    :param ssl: An :class:`ssl.SSLContext` to connect with TLS.
+
+    Each batch is written at once and the sender waits for the stream to
+    drain, so a slow input slows the sender down instead of buffering
+    without bound.
+
+    """
+
+    def __init__(self, host, port=12201, ssl=None):
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self._writer = None
+
+    def makePickle(self, record):
+        return _get_payload(record)
+
+    async def send(self, payloads):
+        if self._writer is None:
+            _, self._writer = await asyncio.open_connection(
+                self.host, self.port, ssl=self.ssl)
+        writer = self._writer
+        writer.write(b'\0'.join(payloads) + b'\0')
+        try:
+            await writer.drain()
+        except OSError:
+            self._writer = None
+            writer.close()
+            raise
+
+    async def close(self):
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+
+class UDPTransport(_CompressHandler):
+    """Send records to a GELF UDP input, chunking large payloads.
+
+    :param host: GELF UDP input host.
+    :param port: GELF UDP input port (default 12201).
+    :param chunk_size: Maximum datagram size, including the chunk header
+        (default 1420).
+
+    Other keyword arguments configure compression as for
+    :class:`graystruct.handler.GELFUDPHandler`.  Records that need more
+    than 128 chunks are counted in ``dropped``.
+
+    """
+
+    def __init__(self, host, port=12201, chunk_size=1420,
+                 compress_threshold=0,
+                 compress_level=zlib.Z_DEFAULT_COMPRESSION,
+                 compress_codec=ZLIB, compress_memlevel=zlib.DEF_MEM_LEVEL):
+        if chunk_size <= GELF_CHUNK_HEADER_SIZE:
+            raise ValueError('chunk_size too small: %r' % (chunk_size,))
+        self.set_compression(
+            compress_threshold, compress_level, compress_codec,
+            compress_memlevel)
+        self.host = host
+        self.port = port
+        self.chunk_size = chunk_size
+        self.dropped = 0
+        self._transport = None
+
+    async def send(self, payloads):
+        if self._transport is None:
+            loop = asyncio.get_running_loop()
+            self._transport, _ = await loop.create_datagram_endpoint(
+                asyncio.DatagramProtocol, remote_addr=(self.host, self.port))
+        sendto = self._transport.sendto
+        chunk_size = self.chunk_size
+        body_size = chunk_size - GELF_CHUNK_HEADER_SIZE
+        for data in payloads:
+            if len(data) <= chunk_size:
+                sendto(data)
+                continue
+            count = (len(data) + body_size - 1) // body_size
+            if count > GELF_MAX_CHUNKS:
+                self.dropped += 1
+                continue
+            message_id = GELF_CHUNK_MAGIC + struct.pack(
+                '>Q', random.getrandbits(64))
+            view = memoryview(data)
+            for sequence in range(count):
+                offset = sequence * body_size
+                sendto(message_id + bytes(bytearray((sequence, count))) +
+                       view[offset:offset + body_size])
+
+    async def close(self):
+        transport, self._transport = self._transport, None
+        if transport is not None:
+            transport.close()
+
+
+class HTTPTransport(_CompressHandler):
+    """POST records to a GELF HTTP input over a keep-alive connection.
+
+    :param host: GELF HTTP input host.
+    :param port: GELF HTTP input port (default 12203).
+    :param path: Path of the GELF endpoint (default ``'/gelf'``).
+    :param timeout: Seconds to wait for each response.
+
+    A request that fails on a reused connection is retried once on a
+    new one; other responses than 2xx raise :class:`IOError`.  Other
+    keyword arguments configure compression as for
+    :class:`graystruct.handler.GELFHandler`.
+
+    """
+
+    def __init__(self, host, port=12203, path='/gelf', timeout=5,
+                 compress_threshold=0,
+                 compress_level=zlib.Z_DEFAULT_COMPRESSION,
+                 compress_codec=ZLIB, compress_memlevel=zlib.DEF_MEM_LEVEL):
+        self.set_compression(
+            compress_threshold, compress_level, compress_codec,
+            compress_memlevel)
+        self.host = host
+        self.port = port
+        self.path = path
+        self.timeout = timeout
+        self._connection = None
+
+    async def send(self, payloads):
+        for data in payloads:
+            await self._post(data)
+
+    async def _post(self, data):
+        head = [
+            'POST {} HTTP/1.1'.format(self.path),
+            'Host: {}:{}'.format(self.host, self.port),
+            'Content-Type: application/json',
+            'Content-Length: {}'.format(len(data)),
+        ]
+        encoding = _content_encoding(data)
+        if encoding is not None:
+            head.append('Content-Encoding: {}'.format(encoding))
+        request = ('\r\n'.join(head) + '\r\n\r\n').encode('ascii')
+
+        reused = self._connection is not None
+        while True:
+            if self._connection is None:
+                self._connection = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port),
+                    self.timeout)
+            reader, writer = self._connection
+            try:
+                writer.write(request)
+                writer.write(data)
+                status, keep_alive = await asyncio.wait_for(
+                    self._read_response(reader), self.timeout)
+            except (OSError, EOFError, asyncio.TimeoutError):
+                self._connection = None
+                writer.close()
+                if not reused:
+                    raise
+                reused = False
+                continue
+            if not keep_alive:
+                self._connection = None
+                writer.close()
+            if not 200 <= status < 300:
+                raise IOError(
+                    'GELF HTTP input returned status {}'.format(status))
+            return
+
+    async def _read_response(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise EOFError('connection closed by the GELF HTTP input')
+        version, status = status_line.split()[:2]
+        length = 0
+        keep_alive = version == b'HTTP/1.1'
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.partition(b':')
+            name = name.strip().lower()
+            value = value.strip().lower()
+            if name == b'content-length':
+                length = int(value)
+            elif name == b'connection':
+                keep_alive = value == b'keep-alive'
+        if length:
+            await reader.readexactly(length)
+        return int(status), keep_alive
+
+    async def close(self):
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            connection[1].close()
+
+
+class AsyncGELFHandler(logging.Handler):
+    """Buffer records and ship them from a task on the event loop.
+
+    ``emit`` never blocks: it appends the record (already encoded by
+    :class:`graystruct.encoder.GELFEncoder`) to a bounded buffer and
+    wakes the sender task, which ships the buffered records in batches
+    through ``transport``.  Records may also be logged from other
+    threads.
+
+    :param transport: A :class:`TCPTransport`, :class:`UDPTransport`,
+        :class:`HTTPTransport`, or any object providing ``makePickle``
+        and the coroutines ``send(payloads)`` and ``close()``.
+    :param maxsize: Maximum number of buffered records.
+    :param overflow: ``'drop-newest'`` (the default) or
+        ``'drop-oldest'``, applied when the buffer is full.
+    :param batch_size: Maximum number of records per ``send``.
+
+    Call :meth:`start` from the event loop, and ``await``
+    :meth:`aclose` to ship the remaining records before the loop stops.
+    When the loop shuts down with the task still running (for example
+    at the end of :func:`asyncio.run`), the cancelled task ships the
+    remaining records before exiting.  ``sent`` and ``dropped`` count
+    records shipped and records discarded or lost to transport errors.
+
+    """
+
+    def __init__(self, transport, maxsize=10000, overflow=DROP_NEWEST,
+                 batch_size=100, level=logging.NOTSET):
+        if overflow not in (DROP_NEWEST, DROP_OLDEST):
+            raise ValueError('invalid overflow policy: %r' % (overflow,))
+        logging.Handler.__init__(self, level)
+        self.transport = transport
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.sent = 0
+        self.dropped = 0
+        self._buffer = collections.deque()
+        self._closed = False
+        self._loop = None
+        self._loop_thread = None
+        self._wakeup = None
+        self._task = None
+
+    def start(self):
+        """Start the sender task on the running event loop.
+        """
+        if self._task is not None:
+            raise RuntimeError('handler already started')
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._wakeup = asyncio.Event()
+        self._task = self._loop.create_task(self._run())
+        if self._buffer:
+            self._wakeup.set()
+
+    def handle(self, record):
+        # Appending to the buffer is thread-safe, so the handler lock is
+        # not taken.
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record):
+        buffer = self._buffer
+        if self._closed:
+            self.dropped += 1
+            return
+        if len(buffer) >= self.maxsize:
+            self.dropped += 1
+            if self.overflow == DROP_NEWEST:
+                return
+            try:
+                buffer.popleft()
+            except IndexError:
+                pass
+        buffer.append(record)
+        self._wake()
+
+    def _wake(self):
+        wakeup = self._wakeup
+        if wakeup is None or wakeup.is_set():
+            return
+        if threading.get_ident() == self._loop_thread:
+            wakeup.set()
+        else:
+            try:
+                self._loop.call_soon_threadsafe(wakeup.set)
+            except RuntimeError:
+                # The loop is closed
+                pass
+
+    async def _run(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                await self._ship()
+                if self._closed:
+                    return
+        except asyncio.CancelledError:
+            self._closed = True
+            await self._ship()
+            raise
+        finally:
+            await self.transport.close()
+
+    async def _ship(self):
+        buffer = self._buffer
+        transport = self.transport
+        while buffer:
+            batch = []
+            while buffer and len(batch) < self.batch_size:
+                batch.append(buffer.popleft())
+            try:
+                payloads = [transport.makePickle(record) for record in batch]
+                await transport.send(payloads)
+            except asyncio.CancelledError:
+                buffer.extendleft(reversed(batch))
+                raise
+            except Exception:
+                self.dropped += len(batch)
+                self.handleError(batch[-1])
+            else:
+                self.sent += len(batch)
+
+    async def aclose(self):
+        """Ship the buffered records, stop the task and close the transport.
+        """
+        self._closed = True
+        if self._task is None:
+            await self.transport.close()
+        elif not self._task.done():
+            self._wakeup.set()
+            await self._task
+        logging.Handler.close(self)
+
+    def close(self):
+        # Records logged after this are dropped; a running sender task
+        # still ships what is buffered.
+        self._closed = True
+        self._wake()
+        logging.Handler.close(self)
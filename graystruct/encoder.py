@@ -6,15 +6,29 @@
 # of the 3-clause BSD license.  See the LICENSE.txt file for details.
 from __future__ import absolute_import
 
+import datetime
+import decimal
+import importlib
 import logging
 import os
 import json
 import socket
+import uuid
 
 from graypy.handler import SYSLOG_LEVELS
-from structlog.processors import JSONRenderer
+from structlog.processors import JSONRenderer, _json_fallback_handler
 from structlog.stdlib import _NAME_TO_LEVEL
 
+try:
+    from enum import Enum
+except ImportError:  # pragma: no cover
+    Enum = None
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
 
 STANDARD_GELF_KEYS = (
     'version',
@@ -26,15 +40,406 @@ STANDARD_GELF_KEYS = (
 )
 
 
-def _get_gelf_compatible_key(key):
-    if key in STANDARD_GELF_KEYS or key.startswith('_'):
+#: Upper bound on the number of memoized key translations per encoder.
+KEY_CACHE_SIZE = 1024
+
+
+if hasattr(os, 'register_at_fork'):
+    _pid = [os.getpid()]
+
+    def _refresh_pid():
+        _pid[0] = os.getpid()
+
+    os.register_at_fork(after_in_child=_refresh_pid)
+
+    def _current_pid():
+        return _pid[0]
+else:  # pragma: no cover
+    _current_pid = os.getpid
+
+
+#: Fields never removed when a record exceeds ``max_message_size``.
+_PROTECTED_KEYS = frozenset([
+    '_pid', '_logger', '_level_name', '_truncated', '_truncated_fields'])
+
+
+def _isoformat(value):
+    return value.isoformat()
+
+
+def _decode_bytes(value):
+    return bytes(value).decode('utf-8', 'replace')
+
+
+# Conversions of common types that JSON backends do not handle, looked up
+# by exact type before any ``isinstance`` check.
+_FAST_PATHS = {
+    bytes: _decode_bytes,
+    bytearray: _decode_bytes,
+    memoryview: _decode_bytes,
+    datetime.datetime: _isoformat,
+    datetime.date: _isoformat,
+    datetime.time: _isoformat,
+    uuid.UUID: str,
+    decimal.Decimal: str,
+}
+
+
+def _truncate_text(value, length):
+    return u'{}...[{} more chars]'.format(value[:length], len(value) - length)
+
+
+def _json_key(key):
+    # Dict keys converted as by the standard library's json module
+    if isinstance(key, text_type):
+        return key
+    if key is True:
+        return 'true'
+    if key is False:
+        return 'false'
+    if key is None:
+        return 'null'
+    if isinstance(key, (int, float)):
+        return json.dumps(key)
+    raise TypeError(
+        'keys must be str, int, float, bool or None, not {}'.format(
+            type(key).__name__))
+
+
+def _make_default(max_field_length=None):
+    """Return the ``default`` hook passed to the JSON backends.
+    """
+    fast_paths = _FAST_PATHS
+
+    def default(obj):
+        convert = fast_paths.get(type(obj))
+        if convert is not None:
+            return convert(obj)
+        if Enum is not None and isinstance(obj, Enum):
+            return obj.value
+        if isinstance(obj, dict):
+            # Only reached for dicts a backend cannot encode itself,
+            # i.e. with non-string keys (rapidjson)
+            return dict((_json_key(key), value) for key, value in obj.items())
+        if isinstance(obj, (datetime.date, datetime.time)):
+            return obj.isoformat()
+        value = _json_fallback_handler(obj)
+        if (max_field_length is not None and
+                isinstance(value, text_type) and
+                len(value) > max_field_length):
+            return _truncate_text(value, max_field_length)
+        return value
+    return default
+
+
+class _Limiter(object):
+    """Bound the length of strings and the size of nested containers.
+
+    Values are returned unchanged (the same object) unless something
+    was cut, in which case a truncated copy with markers is returned.
+
+    """
+
+    def __init__(self, max_field_length=None, max_depth=None,
+                 max_items=None):
+        self.max_field_length = max_field_length
+        self.max_depth = max_depth
+        self.max_items = max_items
+
+    def __call__(self, value, depth=1):
+        if isinstance(value, text_type):
+            length = self.max_field_length
+            if length is not None and len(value) > length:
+                return _truncate_text(value, length)
+            return value
+        if isinstance(value, (list, tuple, dict)):
+            if self.max_depth is not None and depth > self.max_depth:
+                return u'...[nested {}]'.format(type(value).__name__)
+            if isinstance(value, dict):
+                return self._limit_dict(value, depth)
+            return self._limit_list(value, depth)
+        return value
+
+    def _limit_list(self, value, depth):
+        max_items = self.max_items
+        cut = max_items is not None and len(value) > max_items
+        items = value[:max_items] if cut else value
+        limited = [self(item, depth + 1) for item in items]
+        if cut:
+            limited.append(
+                u'...[{} more items]'.format(len(value) - max_items))
+        elif all(new is old for new, old in zip(limited, value)):
+            return value
+        return limited
+
+    def _limit_dict(self, value, depth):
+        max_items = self.max_items
+        cut = max_items is not None and len(value) > max_items
+        items = list(value.items())
+        if cut:
+            items = items[:max_items]
+        limited = {key: self(item, depth + 1) for key, item in items}
+        if cut:
+            limited[u'...'] = u'[{} more items]'.format(
+                len(value) - max_items)
+        elif all(limited[key] is item for key, item in items):
+            return value
+        return limited
+
+
+def _import_optional(name):
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+def _json_serializer(dumps_kw, default):
+    def serialize(obj):
+        return json.dumps(obj, default=default, **dumps_kw)
+    return serialize
+
+
+def _orjson_serializer(dumps_kw, default):
+    orjson = importlib.import_module('orjson')
+    if dumps_kw:
+        raise ValueError(
+            'orjson does not accept json.dumps options: {}'.format(
+                ', '.join(sorted(dumps_kw))))
+    # Let datetimes and dataclasses reach the fallback handler, as they
+    # do with the standard library, and convert keys as it does.
+    option = (orjson.OPT_PASSTHROUGH_DATETIME |
+              orjson.OPT_PASSTHROUGH_DATACLASS |
+              orjson.OPT_NON_STR_KEYS)
+
+    def serialize(obj):
+        try:
+            return orjson.dumps(obj, default=default, option=option)
+        except TypeError:
+            # e.g. integers beyond 64 bits, which orjson rejects
+            return json.dumps(
+                obj, default=default, separators=(',', ':')).encode('utf-8')
+    return serialize
+
+
+def _ujson_serializer(dumps_kw, default):
+    ujson = importlib.import_module('ujson')
+    dumps_kw.setdefault('escape_forward_slashes', False)
+
+    def serialize(obj):
+        return ujson.dumps(obj, default=default, **dumps_kw)
+    return serialize
+
+
+def _rapidjson_serializer(dumps_kw, default):
+    rapidjson = importlib.import_module('rapidjson')
+    # rapidjson encodes bytes itself, failing on invalid UTF-8, unless
+    # they are left to ``default``
+    dumps_kw.setdefault('bytes_mode', rapidjson.BM_NONE)
+
+    def serialize(obj):
+        return rapidjson.dumps(obj, default=default, **dumps_kw)
+    return serialize
+
+
+#: Named JSON backends, mapping to (module, serializer factory).
+SERIALIZERS = {
+    'json': ('json', _json_serializer),
+    'orjson': ('orjson', _orjson_serializer),
+    'ujson': ('ujson', _ujson_serializer),
+    'rapidjson': ('rapidjson', _rapidjson_serializer),
+}
+
+#: Backends tried, fastest first, by ``serializer='auto'``.
+AUTO_SERIALIZERS = ('orjson', 'rapidjson', 'ujson', 'json')
+
+
+def available_serializers():
+    """Return the names of the JSON backends that can be imported.
+    """
+    return [
+        name for name in AUTO_SERIALIZERS
+        if _import_optional(SERIALIZERS[name][0]) is not None
+    ]
+
+
+def _make_serializer(serializer, dumps_kw, default=None):
+    if default is None:
+        default = _make_default()
+    if callable(serializer):
+        def serialize(obj):
+            return serializer(obj, default=default, **dumps_kw)
+        return serialize
+    if serializer == 'auto':
+        serializer = available_serializers()[0]
+    try:
+        _, factory = SERIALIZERS[serializer]
+    except KeyError:
+        raise ValueError('unknown serializer: {!r}'.format(serializer))
+    return factory(dict(dumps_kw), default)
+
+
+def _as_bytes(serialize):
+    def serialize_bytes(obj):
+        data = serialize(obj)
+        if isinstance(data, bytes):
+            return data
+        return data.encode('utf-8')
+    return serialize_bytes
+
+
+_MISSING = object()
+
+# Types of bound values whose serialized form may be cached.
+_SCALAR_TYPES = frozenset([text_type, str, int, float, bool, type(None)])
+
+# Fields computed by the encoder for every record.
+_COMPUTED_KEYS = frozenset([
+    'level', 'short_message', 'full_message', '_logger', '_level_name'])
+
+
+def _strip_braces(serialized):
+    """Return the members of a serialized JSON object without the braces.
+    """
+    if isinstance(serialized, bytes):
+        start, end = b'{', b'}'
+    else:
+        start, end = '{', '}'
+    return serialized[
+        serialized.index(start) + 1:serialized.rindex(end)].strip()
+
+
+class _EventDict(dict):
+    """An event dict remembering the :class:`CachedContext` it came from.
+    """
+
+    __slots__ = ('context',)
+
+
+class CachedContext(dict):
+    """structlog context class letting :class:`GELFEncoder` cache fields.
+
+    The serialized form of scalar fields added with ``bind()`` is kept
+    on the bound context, so that each logging call only serializes the
+    fields passed to it::
+
+        structlog.configure(context_class=CachedContext, ...)
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CachedContext, self).__init__(*args, **kwargs)
+        self._fragments = {}
+
+    def copy(self):
+        event_dict = _EventDict(self)
+        event_dict.context = self
+        return event_dict
+
+    def _changed(self):
+        self._fragments = {}
+
+    def __setitem__(self, key, value):
+        self._changed()
+        super(CachedContext, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._changed()
+        super(CachedContext, self).__delitem__(key)
+
+    def clear(self):
+        self._changed()
+        super(CachedContext, self).clear()
+
+    def pop(self, *args):
+        self._changed()
+        return super(CachedContext, self).pop(*args)
+
+    def popitem(self):
+        self._changed()
+        return super(CachedContext, self).popitem()
+
+    def setdefault(self, key, default=None):
+        self._changed()
+        return super(CachedContext, self).setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self._changed()
+        super(CachedContext, self).update(*args, **kwargs)
+
+
+class Lazy(object):
+    """A field value computed only if the event is encoded.
+
+    ``log.debug('cache.state', entries=Lazy(cache.dump, verbose=True))``
+    calls ``cache.dump(verbose=True)`` when :class:`GELFEncoder` renders
+    the record, and never if the event is dropped before that, e.g. by
+    :class:`graystruct.utils.HandlerLevelFilter`.
+
+    """
+
+    __slots__ = ('function', 'args', 'kwargs')
+
+    def __init__(self, function, *args, **kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self):
+        return self.function(*self.args, **self.kwargs)
+
+    def __repr__(self):
+        return repr(self())
+
+
+def _get_gelf_compatible_key(key, gelf_keys=STANDARD_GELF_KEYS):
+    if key in gelf_keys or key.startswith('_'):
         return key
     return '_{}'.format(key)
 
 
 class GELFEncoder(JSONRenderer):
+    """Render a structlog event dict as a GELF JSON document.
+
+    :param serializer: The JSON backend: ``'json'`` (the default),
+        ``'orjson'``, ``'ujson'``, ``'rapidjson'``, ``'auto'`` (the
+        fastest one installed) or a ``json.dumps``-compatible callable.
+        The ``orjson`` backend produces ``bytes``, which the graystruct
+        handlers send without re-encoding; the others produce ``str``.
+    :param as_bytes: Always produce UTF-8 encoded ``bytes``, so that the
+        payload is encoded once here instead of once per attached
+        handler.  Only graystruct handlers understand such records.
+    :param max_field_length: Maximum length of string values, including
+        strings nested in containers and the ``repr`` of values that
+        cannot be serialized.
+    :param max_depth: Maximum nesting of lists, tuples and dicts; deeper
+        containers are replaced by a marker.
+    :param max_items: Maximum number of items kept from each container.
+    :param max_message_size: Maximum length of the serialized record.
+        A longer record loses ``full_message``, then its largest
+        additional fields (listed in ``_truncated_fields``), then the
+        end of ``short_message``.
+    :param static_fields: Fields added to every record, e.g.
+        ``{'service': 'api', 'environment': 'prod'}``.
+    :param dumps_kw: Passed to the serializer.
+
+    ``version``, ``host``, ``_pid`` and the static fields are serialized
+    once and each record's other fields are spliced after them; see also
+    :class:`CachedContext`.  Cut values end with a ``...[...]`` marker
+    and the record gets ``_truncated: true``.  Bytes, datetimes, UUIDs,
+    decimals and enums are converted directly rather than through
+    ``repr``, and :class:`Lazy` values are computed.
+
+    ``bytes`` payloads are returned as a structlog ``(args, kwargs)``
+    tuple, so that they reach the logging call as the message unchanged.
+
+    """
+
     def __init__(self, fqdn=True, localname=None,
-                 gelf_keys=STANDARD_GELF_KEYS, **dumps_kw):
+                 gelf_keys=STANDARD_GELF_KEYS, serializer='json',
+                 as_bytes=False, max_field_length=None, max_depth=None,
+                 max_items=None, max_message_size=None, static_fields=None,
+                 **dumps_kw):
         if fqdn:
             host = socket.getfqdn()
         elif localname is not None:
@@ -43,35 +448,201 @@ class GELFEncoder(JSONRenderer):
             host = socket.gethostname()
         self.host = host
         self.gelf_keys = frozenset(gelf_keys)
+        self._key_cache = {}
+        # (syslog level, level name) for each structlog method name
+        self._levels = {
+            method_name: (SYSLOG_LEVELS.get(levelno, levelno),
+                          logging.getLevelName(levelno))
+            for method_name, levelno in _NAME_TO_LEVEL.items()
+        }
+        if (max_field_length is None and max_depth is None and
+                max_items is None):
+            self._limit = None
+        else:
+            self._limit = _Limiter(max_field_length, max_depth, max_items)
+        self.max_message_size = max_message_size
         super(GELFEncoder, self).__init__(**dumps_kw)
-
-    def _translate_non_gelf_keys(self, event_dict):
-        return {
-            _get_gelf_compatible_key(key): value
-            for key, value in event_dict.items()
+        serialize = _make_serializer(
+            serializer, dumps_kw, _make_default(max_field_length))
+        if as_bytes:
+            serialize = _as_bytes(serialize)
+        self._serialize = serialize
+        self.static_fields = {
+            _get_gelf_compatible_key(key, self.gelf_keys): value
+            for key, value in (static_fields or {}).items()
         }
+        self._static_keys = frozenset(
+            ['version', 'host', '_pid']).union(self.static_fields)
+        self._excluded_keys = self._static_keys.union(_COMPUTED_KEYS).union(
+            ['event', 'exception'])
+        self._prefix_pid = None
+        # Splicing would break sorted or indented output
+        self._splice = not (dumps_kw.get('sort_keys') or
+                            dumps_kw.get('indent'))
+
+    def _get_gelf_key(self, key):
+        gelf_key = _get_gelf_compatible_key(key, self.gelf_keys)
+        cache = self._key_cache
+        if len(cache) >= KEY_CACHE_SIZE:
+            cache.clear()
+        cache[key] = gelf_key
+        return gelf_key
+
+    def _build_prefix(self, pid):
+        static = {'version': '1.1', 'host': self.host, '_pid': pid}
+        static.update(self.static_fields)
+        self._static = static
+        serialized = self._serialize(static)
+        brace = b'{' if isinstance(serialized, bytes) else '{'
+        self._prefix = brace + _strip_braces(serialized)
+        self._prefix_pid = pid
+
+    def _context_fields(self, context):
+        """Return the cacheable bound fields of a :class:`CachedContext`.
+
+        Returns ``(bound, fragment)``: the raw key/value pairs whose
+        serialized form is cached, and that serialized JSON fragment.
+
+        """
+        cached = context._fragments.get(self)
+        if cached is not None:
+            return cached
+        excluded = self._excluded_keys
+        limit = self._limit
+        bound = {}
+        bound_gelf = {}
+        for key, value in context.items():
+            if type(value) not in _SCALAR_TYPES:
+                continue
+            gelf_key = self._key_cache.get(key) or self._get_gelf_key(key)
+            if key in excluded or gelf_key in excluded:
+                continue
+            if limit is not None and limit(value) is not value:
+                continue
+            bound[key] = value
+            bound_gelf[gelf_key] = value
+        fragment = None
+        if bound_gelf:
+            fragment = _strip_braces(self._serialize(bound_gelf))
+        cached = context._fragments[self] = (bound, fragment)
+        return cached
 
     def __call__(self, logger, method_name, event_dict):
-        event_dict = event_dict.copy()
-        levelno = _NAME_TO_LEVEL[method_name]
+        level, level_name = self._levels[method_name]
+        message = event_dict.get('event', '')
 
         gelf_dict = {
-            'version': '1.1',
-            'host': self.host,
-            'level': SYSLOG_LEVELS.get(levelno, levelno),
+            'level': level,
+            'short_message': message,
+            '_logger': logger.name,
+            '_level_name': level_name,
         }
 
-        message = gelf_dict['short_message'] = event_dict.pop('event', '')
-
         if 'exception' in event_dict:
-            exc = event_dict.pop('exception')
-            gelf_dict['full_message'] = '\n'.join([message, exc])
+            gelf_dict['full_message'] = '\n'.join(
+                [message, event_dict['exception']])
+
+        bound = fragment = None
+        if isinstance(event_dict, _EventDict) and self._splice:
+            bound, fragment = self._context_fields(event_dict.context)
+        spliced = self._splice
+        skipped = 0
+        static_keys = self._static_keys
+        key_cache = self._key_cache
+        for key, value in event_dict.items():
+            if key == 'event' or key == 'exception':
+                continue
+            if bound and key in bound and bound[key] is value:
+                skipped += 1
+                continue
+            gelf_key = key_cache.get(key)
+            if gelf_key is None:
+                gelf_key = self._get_gelf_key(key)
+            if gelf_key in static_keys:
+                # Overrides a field of the cached prefix
+                spliced = False
+            if type(value) is Lazy:
+                value = value()
+            gelf_dict[gelf_key] = value
+
+        pid = _current_pid()
+        if pid != self._prefix_pid:
+            self._build_prefix(pid)
+        if bound and skipped != len(bound):
+            spliced = False
+        if not spliced:
+            gelf_dict = self._full_dict(gelf_dict, event_dict, bound)
+
+        if self._limit is not None:
+            self._apply_limits(gelf_dict)
+        if spliced:
+            body = self._serialize(gelf_dict)
+            prefix = self._prefix
+            separator = b',' if isinstance(body, bytes) else ','
+            if fragment:
+                payload = separator.join((prefix, fragment, body[1:]))
+            else:
+                payload = separator.join((prefix, body[1:]))
+        else:
+            payload = self._serialize(gelf_dict)
+
+        if (self.max_message_size is not None and
+                len(payload) > self.max_message_size):
+            if spliced:
+                gelf_dict = self._full_dict(gelf_dict, event_dict, bound)
+            payload = self._shrink(gelf_dict, payload)
+        if isinstance(payload, bytes):
+            return (payload,), {}
+        return payload
+
+    def _full_dict(self, gelf_dict, event_dict, bound):
+        full = dict(self._static)
+        if bound:
+            for key, value in bound.items():
+                if event_dict.get(key, _MISSING) is value:
+                    full[self._key_cache.get(key) or
+                         self._get_gelf_key(key)] = value
+        full.update(gelf_dict)
+        return full
+
+    def _apply_limits(self, gelf_dict):
+        limit = self._limit
+        truncated = False
+        for key, value in gelf_dict.items():
+            limited = limit(value)
+            if limited is not value:
+                gelf_dict[key] = limited
+                truncated = True
+        if truncated:
+            gelf_dict['_truncated'] = True
 
-        gelf_dict['_pid'] = os.getpid()
-        gelf_dict['_logger'] = logger.name
-        gelf_dict['_level_name'] = logging.getLevelName(levelno)
+    def _shrink(self, gelf_dict, payload):
+        limit = self.max_message_size
+        serialize = self._serialize
+        gelf_dict.pop('full_message', None)
+        gelf_dict['_truncated'] = True
+        payload = serialize(gelf_dict)
 
-        gelf_dict.update(self._translate_non_gelf_keys(event_dict))
+        gelf_keys = self.gelf_keys
+        candidates = sorted(
+            ((len(serialize({key: value})), key)
+             for key, value in gelf_dict.items()
+             if key not in gelf_keys and key not in _PROTECTED_KEYS),
+            reverse=True)
+        dropped = []
+        for _, key in candidates:
+            if len(payload) <= limit:
+                return payload
+            del gelf_dict[key]
+            dropped.append(key)
+            gelf_dict['_truncated_fields'] = ','.join(dropped)
+            payload = serialize(gelf_dict)
 
-        return super(GELFEncoder, self).__call__(
-            logger, method_name, gelf_dict)
+        excess = len(payload) - limit
+        message = gelf_dict.get('short_message')
+        if excess > 0 and isinstance(message, text_type):
+            # Leave room for the marker
+            length = max(0, len(message) - excess - 32)
+            gelf_dict['short_message'] = _truncate_text(message, length)
+            payload = serialize(gelf_dict)
+        return payload
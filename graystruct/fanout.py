@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+from __future__ import absolute_import
+
+import logging
+
+from .queued import DROP_NEWEST, QueuedGELFHandler
+
+
+class FanoutGELFHandler(logging.Handler):
+    """Ship each record to several destinations, compressing it once.
+
+    The record's payload is compressed in ``emit``, once for each
+    distinct compression setting among the targets, and cached on the
+    record (see :class:`graystruct.handler._CompressHandler`).  The
+    record and its payload are then placed on one
+    :class:`graystruct.queued.QueuedGELFHandler` per target, whose
+    thread only sends it, so a slow or unreachable destination only
+    fills its own queue and does not hold up the others.
+
+    Each destination still costs a queue hand-off and a thread wake-up
+    per record, a few microseconds, on top of the shared encoding and
+    compression: compared to attaching the targets directly, the
+    fan-out trades CPU for isolation between destinations.
+
+    :param targets: The graystruct handlers that perform the transport.
+    :param maxsize: Maximum number of records held per destination.
+    :param overflow: Overflow policy of each queue, see
+        :class:`graystruct.queued.QueuedGELFHandler`.
+    :param timeout: Maximum time to block with the ``'block'`` policy.
+
+    ``sent`` and ``dropped`` sum the counters of the queues.
+
+    """
+
+    def __init__(self, targets, maxsize=10000, overflow=DROP_NEWEST,
+                 timeout=None):
+        targets = list(targets)
+        if not targets:
+            raise ValueError('FanoutGELFHandler requires at least one target')
+        logging.Handler.__init__(
+            self, level=min(target.level for target in targets))
+        self.targets = targets
+        self.queues = [
+            QueuedGELFHandler(target, maxsize, overflow, timeout)
+            for target in targets]
+
+    @property
+    def sent(self):
+        return sum(queue.sent for queue in self.queues)
+
+    @property
+    def dropped(self):
+        return sum(queue.dropped for queue in self.queues)
+
+    def emit(self, record):
+        levelno = record.levelno
+        try:
+            items = [
+                (queue, (record, queue.target.makePickle(record)))
+                for queue in self.queues if levelno >= queue.level]
+        except Exception:
+            self.handleError(record)
+            return
+        for queue, item in items:
+            queue._put(item)
+
+    def flush(self):
+        """Block until every queued record has been handed to its target.
+        """
+        for queue in self.queues:
+            queue.flush()
+
+    def close(self):
+        """Drain the queues, stop their threads and close the targets.
+        """
+        for queue in self.queues:
+            queue.close()
+        logging.Handler.close(self)
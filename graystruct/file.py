@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+from __future__ import absolute_import
+
+import gzip
+import logging
+import os
+import shutil
+import threading
+import time
+import traceback
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .handler import _get_payload, _payload_record
+from .utils import _register_after_fork
+
+_STOP = object()
+
+
+class GELFFileHandler(logging.Handler):
+    """Write GELF records to a local file, one JSON document per line.
+
+    Meant for hosts where a log shipper (Filebeat, Graylog Sidecar)
+    forwards the file.  Records are appended to an in-memory buffer that
+    is written out in one call once it holds ``buffer_size`` bytes, and
+    at least every ``flush_interval`` seconds by a background thread.
+    The encoder must not be configured with ``indent``.
+
+    :param filename: Path of the active file.
+    :param buffer_size: Bytes buffered before they are written.
+    :param flush_interval: Maximum seconds a record stays buffered, or
+        ``None`` to only write full buffers (and on :meth:`flush`).
+    :param fsync: Also ``os.fsync`` the file on each periodic flush and
+        before rotating it.
+    :param max_bytes: Rotate the file once it reaches this size, or
+        ``None``.
+    :param rotate_interval: Rotate the file once it is this many seconds
+        old, or ``None``.
+    :param compress: Compress rotated files with gzip, on a background
+        thread.
+    :param backup_count: Number of rotated files kept, or ``None`` to
+        keep all of them.
+
+    Rotated files are renamed to ``<filename>.<YYYYmmddHHMMSS>.<n>``
+    (with ``.gz`` when compressed); :func:`rotated_files` lists them in
+    order and :func:`replay` sends them through another handler.
+
+    In a process forked from the one that opened the handler, records
+    buffered by the parent are discarded and the file is appended to
+    but never rotated nor compressed; the file is reopened when the
+    parent has rotated it.
+
+    """
+
+    def __init__(self, filename, buffer_size=64 * 1024, flush_interval=1.0,
+                 fsync=False, max_bytes=None, rotate_interval=None,
+                 compress=False, backup_count=None):
+        logging.Handler.__init__(self)
+        self.filename = os.path.abspath(filename)
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.compress = compress
+        self.backup_count = backup_count
+        self.writes = 0
+        self.rotations = 0
+        self._child = False
+        self._buffer = bytearray()
+        self._index = _next_index(self.filename)
+        self._open()
+        self._compressions = queue.Queue()
+        self._stopped = threading.Event()
+        self._threads = []
+        if compress:
+            self._start_thread(self._compress_rotated, 'compressor')
+        if flush_interval is not None:
+            self._start_thread(self._flush_periodically, 'flusher')
+        _register_after_fork(self)
+
+    def _after_fork(self):
+        # The parent writes what it buffered; rotating here as well
+        # would rename the file under it.
+        del self._buffer[:]
+        self._child = True
+        self._threads = []
+        if self._stopped.is_set():
+            return
+        if self.flush_interval is not None:
+            self._start_thread(self._flush_periodically, 'flusher')
+
+    def _start_thread(self, target, role):
+        thread = threading.Thread(
+            target=target, name='graystruct-file-handler-{}'.format(role))
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def _open(self):
+        self._file = open(self.filename, 'ab')
+        self._size = self._file.tell()
+        self._opened = time.time()
+
+    def makePickle(self, record):
+        return _get_payload(record)
+
+    def send(self, data):
+        buffer = self._buffer
+        buffer += data
+        buffer += b'\n'
+        self._size += len(data) + 1
+        if len(buffer) >= self.buffer_size:
+            self._write_buffer()
+        if self._child:
+            return
+        if ((self.max_bytes is not None and self._size >= self.max_bytes) or
+                (self.rotate_interval is not None and
+                 time.time() - self._opened >= self.rotate_interval)):
+            self._rotate()
+
+    def emit(self, record):
+        try:
+            self.send(self.makePickle(record))
+        except Exception:
+            self.handleError(record)
+
+    def _write_buffer(self):
+        if self._buffer:
+            if self._child and self._replaced():
+                self._file.close()
+                self._open()
+            self._file.write(self._buffer)
+            self._file.flush()
+            del self._buffer[:]
+            self.writes += 1
+
+    def _replaced(self):
+        try:
+            return (os.stat(self.filename).st_ino !=
+                    os.fstat(self._file.fileno()).st_ino)
+        except OSError:
+            return True
+
+    def _rotated_name(self):
+        stamp = time.strftime('%Y%m%d%H%M%S', time.localtime(self._opened))
+        # The index keeps increasing, so that names of files rotated in
+        # the same second sort in order even after old ones are removed
+        while True:
+            name = '{}.{}.{}'.format(self.filename, stamp, self._index)
+            self._index += 1
+            if not (os.path.exists(name) or os.path.exists(name + '.gz')):
+                return name
+
+    def _rotate(self):
+        self._write_buffer()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        rotated = self._rotated_name()
+        os.rename(self.filename, rotated)
+        self._open()
+        self.rotations += 1
+        if self.compress:
+            self._compressions.put(rotated)
+        else:
+            self._remove_old()
+
+    def _remove_old(self):
+        if self.backup_count is None:
+            return
+        files = rotated_files(self.filename)
+        for path in files[:max(0, len(files) - self.backup_count)]:
+            os.remove(path)
+
+    def _compress_rotated(self):
+        while True:
+            path = self._compressions.get()
+            if path is _STOP:
+                return
+            try:
+                with open(path, 'rb') as source:
+                    with gzip.open(path + '.gz.tmp', 'wb') as target:
+                        shutil.copyfileobj(source, target)
+                os.rename(path + '.gz.tmp', path + '.gz')
+                os.remove(path)
+                self._remove_old()
+            except Exception:
+                if logging.raiseExceptions:
+                    traceback.print_exc()
+
+    def _flush_periodically(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.acquire()
+            try:
+                self._write_buffer()
+                if self.fsync:
+                    os.fsync(self._file.fileno())
+            finally:
+                self.release()
+
+    def flush(self):
+        self.acquire()
+        try:
+            self._write_buffer()
+        finally:
+            self.release()
+
+    def close(self):
+        """Write buffered records, stop the threads and close the file.
+
+        Rotated files still waiting to be compressed are compressed
+        first.
+
+        """
+        if not self._stopped.is_set():
+            # The flusher thread takes the handler lock: join it first
+            self._stopped.set()
+            if not self._child:
+                self._compressions.put(_STOP)
+            for thread in self._threads:
+                thread.join()
+            self.acquire()
+            try:
+                self._write_buffer()
+                if self.fsync:
+                    os.fsync(self._file.fileno())
+                self._file.close()
+            finally:
+                self.release()
+        logging.Handler.close(self)
+
+
+def _rotated(filename):
+    directory, base = os.path.split(os.path.abspath(filename))
+    prefix = base + '.'
+    rotated = []
+    for name in os.listdir(directory):
+        if not name.startswith(prefix):
+            continue
+        # <filename>.<stamp>.<index>[.gz]
+        parts = name[len(prefix):].split('.')
+        if parts[-1] == 'gz':
+            parts.pop()
+        if (len(parts) != 2 or not parts[0].isdigit() or
+                not parts[1].isdigit()):
+            continue
+        rotated.append(
+            ((parts[0], int(parts[1])), os.path.join(directory, name)))
+    return sorted(rotated)
+
+
+def _next_index(filename):
+    return max([index for (_, index), _ in _rotated(filename)] or [-1]) + 1
+
+
+def rotated_files(filename):
+    """Return the rotated files of ``filename``, oldest first.
+    """
+    return [path for _, path in _rotated(filename)]
+
+
+def read_records(path):
+    """Yield the GELF payloads (bytes) stored in a file, gzipped or not.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as fh:
+        for line in fh:
+            line = line.rstrip(b'\n')
+            if line:
+                yield line
+
+
+def replay(paths, handler, name='graystruct.replay'):
+    """Send the records stored in ``paths`` through a graystruct handler.
+
+    Each payload is handed to ``handler`` as the message of a new
+    record, so any transport (or :class:`graystruct.spool.
+    SpoolingGELFHandler`, :class:`graystruct.fanout.FanoutGELFHandler`
+    and so on) can be used.  Returns the number of records replayed.
+
+    """
+    count = 0
+    for path in paths:
+        for payload in read_records(path):
+            handler.handle(_payload_record(payload, name))
+            count += 1
+    return count
@@ -6,14 +6,532 @@
 # of the 3-clause BSD license.  See the LICENSE.txt file for details.
 from __future__ import absolute_import
 
+import json
+import logging
+import random
+import socket
+import struct
+import threading
 import zlib
+from logging.handlers import DatagramHandler, SocketHandler
+
 from graypy.handler import GELFHTTPHandler as BaseGELFHandler
 
+from .utils import _register_after_fork
+
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+
+def _get_payload(record):
+    # Pre-encoded payloads (bytes, bytearray or memoryview) are used in
+    # place without another copy.
+    msg = record.msg
+    if isinstance(msg, text_type):
+        msg = msg.encode('utf-8')
+    return msg
+
+
+def _payload_record(payload, name):
+    # Records carrying an already encoded payload, as replayed from a
+    # file or forwarded by another process, are logged at CRITICAL so
+    # that the level checks of the receiving handlers let them through.
+    return logging.makeLogRecord({
+        'name': name,
+        'msg': payload,
+        'levelno': logging.CRITICAL,
+        'levelname': logging.getLevelName(logging.CRITICAL),
+    })
+
+
+ZLIB = 'zlib'
+GZIP = 'gzip'
+
+_WBITS = {
+    ZLIB: zlib.MAX_WBITS,
+    GZIP: 16 + zlib.MAX_WBITS,
+}
+
+
+def _content_encoding(data):
+    """Return the HTTP Content-Encoding of a payload from its magic bytes.
+    """
+    head = bytes(data[:2])
+    if head == b'\x1f\x8b':
+        return 'gzip'
+    if head[:1] == b'\x78':
+        return 'deflate'
+    return None
+
 
 class _CompressHandler(object):
+    """Compress GELF payloads for the transport.
+
+    The compression settings default to zlib at the default level for
+    every record and are changed with :meth:`set_compression`.  The
+    compressed payload is cached on the record, so that several handlers
+    with the same settings compress each record once.
+
+    """
+
+    compress_threshold = 0
+    compress_level = zlib.Z_DEFAULT_COMPRESSION
+    compress_codec = ZLIB
+    compress_memlevel = zlib.DEF_MEM_LEVEL
+
+    def set_compression(self, threshold=0, level=zlib.Z_DEFAULT_COMPRESSION,
+                        codec=ZLIB, memlevel=zlib.DEF_MEM_LEVEL):
+        """Configure payload compression.
+
+        :param threshold: Payloads shorter than this many bytes are sent
+            uncompressed (Graylog detects compression per message).
+        :param level: zlib compression level, 0-9 or -1 for the default.
+        :param codec: ``'zlib'`` or ``'gzip'``; Graylog accepts both.
+        :param memlevel: zlib memory level, 1-9.  Low values shrink the
+            compressor state, which is cheaper for small records at a
+            small cost in compression ratio.
+
+        """
+        if codec not in _WBITS:
+            raise ValueError('invalid compression codec: %r' % (codec,))
+        self.compress_threshold = threshold
+        self.compress_level = level
+        self.compress_codec = codec
+        self.compress_memlevel = memlevel
+
+    def compress_payload(self, payload):
+        if len(payload) < self.compress_threshold:
+            return bytes(payload)
+        if (self.compress_codec == ZLIB and
+                self.compress_memlevel == zlib.DEF_MEM_LEVEL):
+            return zlib.compress(payload, self.compress_level)
+        compressor = zlib.compressobj(
+            self.compress_level, zlib.DEFLATED,
+            _WBITS[self.compress_codec], self.compress_memlevel)
+        return compressor.compress(payload) + compressor.flush()
+
     def makePickle(self, record):
-        return zlib.compress(record.msg.encode('utf-8'))
+        # Handlers with the same settings share the compressed payload
+        # of a record; the cache is tied to the message it was made from.
+        key = (self.compress_threshold, self.compress_level,
+               self.compress_codec, self.compress_memlevel)
+        msg = record.msg
+        cache = getattr(record, '_gelf_compressed', None)
+        if cache is None or cache[0] is not msg:
+            cache = record._gelf_compressed = (msg, {})
+        data = cache[1].get(key)
+        if data is None:
+            data = cache[1][key] = self.compress_payload(_get_payload(record))
+        return data
+
+
+class _HTTPConnectionPool(object):
+    """Idle keep-alive HTTP connections to a single GELF HTTP input.
+    """
+
+    def __init__(self, host, port, timeout, maxsize):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.opened = 0
+        self._lock = threading.Lock()
+        self._idle = []
+        _register_after_fork(self)
+
+    def _after_fork(self):
+        # Closing a plain HTTP connection only closes this process's
+        # descriptor; the parent keeps using its connections.
+        self._lock = threading.Lock()
+        idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    def get(self):
+        """Return an idle connection, or a new one, and whether it was
+        reused.
+
+        """
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self.connect(), False
+
+    def connect(self):
+        with self._lock:
+            self.opened += 1
+        return httplib.HTTPConnection(
+            host=self.host, port=self.port, timeout=self.timeout)
+
+    def put(self, connection):
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
 
 
 class GELFHandler(_CompressHandler, BaseGELFHandler):
-    pass
+    """Graylog Extended Log Format HTTP handler.
+
+    Connections to the GELF HTTP input are kept alive and reused.  A
+    request that fails on a reused connection (for instance because the
+    server closed it while idle) is retried once on a new connection; a
+    request failing on a new connection is not retried, as the input
+    may already have received it.
+
+    :param host: GELF HTTP input host.
+    :param port: GELF HTTP input port (default 12203).
+    :param timeout: Socket timeout in seconds for each request
+        (default 5).
+    :param keep_alive: Reuse connections between records (default
+        ``True``).
+    :param pool_size: Maximum number of idle connections kept open
+        (default 1).  Records are sent one at a time under the handler's
+        lock, so more than one is only useful when :meth:`send` is
+        called concurrently without holding it.
+    :param compress_threshold: See :meth:`set_compression`.
+    :param compress_level: See :meth:`set_compression`.
+    :param compress_codec: See :meth:`set_compression`.
+    :param compress_memlevel: See :meth:`set_compression`.
+
+    Other keyword arguments are passed to graypy's ``GELFHTTPHandler``.
+
+    """
+
+    def __init__(self, host, port=12203, timeout=5, keep_alive=True,
+                 pool_size=1, compress_threshold=0,
+                 compress_level=zlib.Z_DEFAULT_COMPRESSION,
+                 compress_codec=ZLIB, compress_memlevel=zlib.DEF_MEM_LEVEL,
+                 **kwargs):
+        BaseGELFHandler.__init__(self, host, port, timeout=timeout, **kwargs)
+        self.set_compression(
+            compress_threshold, compress_level, compress_codec,
+            compress_memlevel)
+        self.keep_alive = keep_alive
+        self.pool = _HTTPConnectionPool(
+            host, port, timeout, pool_size if keep_alive else 0)
+
+    def emit(self, record):
+        try:
+            self.send(self.makePickle(record))
+        except Exception:
+            self.handleError(record)
+
+    def send(self, data):
+        headers = dict(self.headers)
+        headers.pop('Content-Encoding', None)
+        encoding = _content_encoding(data)
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        if not self.keep_alive:
+            headers['Connection'] = 'close'
+
+        connection, reused = self.pool.get()
+        while True:
+            try:
+                connection.request('POST', self.path, data, headers)
+                response = connection.getresponse()
+                response.read()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if not reused:
+                    raise
+                connection, reused = self.pool.connect(), False
+                continue
+            break
+        if response.will_close:
+            connection.close()
+        else:
+            self.pool.put(connection)
+        if not 200 <= response.status < 300:
+            raise IOError('GELF HTTP input returned {} {}'.format(
+                response.status, response.reason))
+
+    def close(self):
+        self.pool.close()
+        BaseGELFHandler.close(self)
+
+
+GELF_CHUNK_MAGIC = b'\x1e\x0f'
+GELF_CHUNK_HEADER_SIZE = 12
+GELF_MAX_CHUNKS = 128
+
+DROP = 'drop'
+TRUNCATE = 'truncate'
+
+
+class GELFUDPHandler(_CompressHandler, DatagramHandler):
+    """Graylog Extended Log Format UDP handler with chunking.
+
+    Payloads larger than ``chunk_size`` are split into GELF chunks.  The
+    12-byte chunk header is kept in a preallocated buffer and sent
+    together with a ``memoryview`` slice of the payload using
+    ``sendmsg`` where the platform supports it, so chunks are never
+    built by concatenating bytes.
+
+    :param host: GELF UDP input host.
+    :param port: GELF UDP input port (default 12201).
+    :param chunk_size: Maximum datagram size, including the chunk header
+        (default 1420, which fits in a typical WAN MTU).
+    :param oversize: What to do with records that need more than 128
+        chunks: ``'drop'`` (the default) discards them and
+        ``'truncate'`` removes ``full_message``, shortens long string
+        fields and adds ``_truncated: true`` before dropping the record
+        if it is still too large.
+    :param truncate_length: Maximum length of string fields when
+        truncating (default 1024).
+
+    Other keyword arguments configure compression as for
+    :class:`GELFHandler`.  ``dropped`` counts discarded records.
+
+    """
+
+    def __init__(self, host, port=12201, chunk_size=1420, oversize=DROP,
+                 truncate_length=1024, compress_threshold=0,
+                 compress_level=zlib.Z_DEFAULT_COMPRESSION,
+                 compress_codec=ZLIB, compress_memlevel=zlib.DEF_MEM_LEVEL):
+        if chunk_size <= GELF_CHUNK_HEADER_SIZE:
+            raise ValueError('chunk_size too small: %r' % (chunk_size,))
+        if oversize not in (DROP, TRUNCATE):
+            raise ValueError('invalid oversize policy: %r' % (oversize,))
+        DatagramHandler.__init__(self, host, port)
+        self.set_compression(
+            compress_threshold, compress_level, compress_codec,
+            compress_memlevel)
+        self.chunk_size = chunk_size
+        self.oversize = oversize
+        self.truncate_length = truncate_length
+        self.dropped = 0
+        self.max_message_size = GELF_MAX_CHUNKS * (
+            chunk_size - GELF_CHUNK_HEADER_SIZE)
+        self._header = bytearray(GELF_CHUNK_HEADER_SIZE)
+        self._header[:2] = GELF_CHUNK_MAGIC
+        self._buffer = bytearray(chunk_size)
+        self._use_sendmsg = hasattr(socket.socket, 'sendmsg')
+
+    def emit(self, record):
+        try:
+            self.send(self.makePickle(record))
+        except Exception:
+            self.handleError(record)
+
+    def _truncate(self, data):
+        payload = bytes(data)
+        if _content_encoding(payload) is not None:
+            payload = zlib.decompress(payload, 47)
+        gelf_dict = json.loads(payload.decode('utf-8'))
+        gelf_dict.pop('full_message', None)
+        limit = self.truncate_length
+        for key, value in gelf_dict.items():
+            if isinstance(value, text_type) and len(value) > limit:
+                gelf_dict[key] = value[:limit] + '...'
+        gelf_dict['_truncated'] = True
+        return self.compress_payload(json.dumps(gelf_dict).encode('utf-8'))
+
+    def send(self, s):
+        """Send a compressed payload, in chunks if needed.
+
+        Payloads that need more than 128 chunks are handled according
+        to the ``oversize`` policy.
+
+        """
+        if len(s) > self.max_message_size:
+            if self.oversize == TRUNCATE:
+                s = self._truncate(s)
+            if len(s) > self.max_message_size:
+                self.dropped += 1
+                return
+        if self.sock is None:
+            self.createSocket()
+        if len(s) <= self.chunk_size:
+            self.sock.sendto(s, self.address)
+            return
+
+        body_size = self.chunk_size - GELF_CHUNK_HEADER_SIZE
+        count = (len(s) + body_size - 1) // body_size
+        header = self._header
+        header[2:10] = struct.pack('>Q', random.getrandbits(64))
+        header[11] = count
+        view = memoryview(s)
+        sock = self.sock
+        address = self.address
+        if self._use_sendmsg:
+            for sequence in range(count):
+                header[10] = sequence
+                offset = sequence * body_size
+                sock.sendmsg(
+                    [header, view[offset:offset + body_size]],
+                    [], 0, address)
+        else:
+            buf = self._buffer
+            buf[:GELF_CHUNK_HEADER_SIZE] = header
+            out = memoryview(buf)
+            for sequence in range(count):
+                buf[10] = sequence
+                chunk = view[sequence * body_size:
+                             (sequence + 1) * body_size]
+                end = GELF_CHUNK_HEADER_SIZE + len(chunk)
+                out[GELF_CHUNK_HEADER_SIZE:end] = chunk
+                sock.sendto(out[:end], address)
+
+
+class _FrameBatch(object):
+    """Frames queued while another thread writes, and the outcome of
+    writing them.
+
+    """
+
+    def __init__(self):
+        self.frames = []
+        self.error = None
+        self.done = threading.Event()
+
+
+class GELFTCPHandler(SocketHandler):
+    """Graylog Extended Log Format TCP handler.
+
+    Records are sent uncompressed and null-byte terminated, as expected
+    by the GELF TCP input, over one long-lived connection.  While one
+    thread is writing, records logged by other threads are queued and
+    then written together in a single call; those threads wait for that
+    write and see its error, if any.  A write interrupted by a
+    connection error is resumed on a new connection from the start of
+    the frame that was cut off.
+
+    :param host: GELF TCP input host, or the path of a Unix domain
+        socket when ``port`` is ``None``.
+    :param port: GELF TCP input port (default 12201).
+    :param ssl_context: An :class:`ssl.SSLContext` used to wrap the
+        connection in TLS (default ``None``, plain TCP).
+    :param server_hostname: Host name to verify the certificate against
+        (defaults to ``host``).
+
+    ``frames_sent`` and ``writes`` count frames and write batches sent;
+    ``dropped`` counts frames lost because the input was unreachable.
+
+    """
+
+    def __init__(self, host, port=12201, ssl_context=None,
+                 server_hostname=None):
+        SocketHandler.__init__(self, host, port)
+        self.ssl_context = ssl_context
+        self.server_hostname = server_hostname or host
+        self.frames_sent = 0
+        self.writes = 0
+        self.dropped = 0
+        self._pending = None
+        self._pending_lock = threading.Lock()
+        self._writing = False
+        _register_after_fork(self)
+
+    def _after_fork(self):
+        # Frames pending at the fork are written by the parent
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self._pending = None
+        self._pending_lock = threading.Lock()
+        self._writing = False
+
+    def makeSocket(self, timeout=1):
+        sock = SocketHandler.makeSocket(self, timeout)
+        if self.ssl_context is not None:
+            sock = self.ssl_context.wrap_socket(
+                sock, server_hostname=self.server_hostname)
+        return sock
+
+    def makePickle(self, record):
+        return _get_payload(record)
+
+    def handle(self, record):
+        # The handler lock is not held while writing so that records
+        # from other threads can be queued and coalesced meanwhile.
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record):
+        try:
+            self.send(self.makePickle(record))
+        except Exception:
+            self.handleError(record)
+
+    def send(self, data):
+        """Send one payload, null-byte terminated.
+
+        If another thread is writing, the payload is queued and written
+        by that thread in its next batch, and this call waits for it.
+        Raises if the input is unreachable.
+
+        """
+        with self._pending_lock:
+            batch = self._pending
+            if batch is None:
+                batch = self._pending = _FrameBatch()
+            batch.frames.append(data)
+            writing, self._writing = self._writing, True
+        if writing:
+            batch.done.wait()
+        else:
+            self._drain()
+        if batch.error is not None:
+            raise batch.error
+
+    def _drain(self):
+        # Write batches until none is left; each batch's error is left
+        # for the threads that queued its frames.
+        while True:
+            with self._pending_lock:
+                batch = self._pending
+                if batch is None:
+                    self._writing = False
+                    return
+                self._pending = None
+            try:
+                self._write(batch.frames)
+            except Exception as error:
+                batch.error = error
+                with self._pending_lock:
+                    self.dropped += len(batch.frames)
+            else:
+                with self._pending_lock:
+                    self.frames_sent += len(batch.frames)
+                    self.writes += 1
+            finally:
+                batch.done.set()
+
+    def _write(self, frames):
+        data = b'\0'.join(frames) + b'\0'
+        view = memoryview(data)
+        sent = 0
+        retried = False
+        while sent < len(data):
+            if self.sock is None:
+                self.createSocket()
+                if self.sock is None:
+                    raise socket.error('GELF TCP input is unreachable')
+            try:
+                sent += self.sock.send(view[sent:])
+            except socket.error:
+                self.sock.close()
+                self.sock = None
+                if retried:
+                    raise
+                retried = True
+                # Resume after the last frame that was completely sent
+                sent = data.rfind(b'\0', 0, sent) + 1
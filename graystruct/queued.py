@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+from __future__ import absolute_import
+
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .utils import _register_after_fork
+
+DROP_NEWEST = 'drop-newest'
+DROP_OLDEST = 'drop-oldest'
+BLOCK = 'block'
+
+OVERFLOW_POLICIES = (DROP_NEWEST, DROP_OLDEST, BLOCK)
+
+_STOP = object()
+
+
+class QueuedGELFHandler(logging.Handler):
+    """Non-blocking wrapper around a graystruct GELF handler.
+
+    ``emit`` only places the record (whose message has already been
+    encoded by :class:`graystruct.encoder.GELFEncoder`) on a bounded
+    queue.  A background thread compresses the payload with the target
+    handler's ``makePickle``, unless it was already made by the caller,
+    and ships it with the target's ``send``.
+
+    :param target: The handler that performs the actual transport
+        (e.g. :class:`graystruct.handler.GELFHandler` or
+        :class:`graystruct.rabbitmq.GELFRabbitHandler`).
+    :param maxsize: Maximum number of records held in the queue.
+    :param overflow: What to do when the queue is full: ``'drop-newest'``
+        (default) discards the incoming record, ``'drop-oldest'``
+        discards the oldest queued record and ``'block'`` waits up to
+        ``timeout`` seconds for space before discarding the record.
+    :param timeout: Maximum time to block with the ``'block'`` policy;
+        ``None`` waits indefinitely.
+
+    """
+
+    def __init__(self, target, maxsize=10000, overflow=DROP_NEWEST,
+                 timeout=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('invalid overflow policy: %r' % (overflow,))
+        logging.Handler.__init__(self, level=target.level)
+        self.target = target
+        self.queue = queue.Queue(maxsize)
+        self.overflow = overflow
+        self.timeout = timeout
+        self.sent = 0
+        self.dropped = 0
+        self._closed = False
+        self._start()
+        _register_after_fork(self)
+
+    def _start(self):
+        self._thread = threading.Thread(
+            target=self._run, name='graystruct-queued-handler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _after_fork(self):
+        # Records queued before the fork are shipped by the parent; the
+        # worker thread does not exist in the child.
+        self.queue = queue.Queue(self.queue.maxsize)
+        if not self._closed:
+            self._start()
+
+    def emit(self, record):
+        self._put((record, None))
+
+    def _put(self, item):
+        # Items are (record, payload) pairs; the payload is None unless
+        # it was made by the caller, see FanoutGELFHandler.
+        if self._closed:
+            self.dropped += 1
+            return
+        if self.overflow == BLOCK:
+            try:
+                self.queue.put(item, True, self.timeout)
+            except queue.Full:
+                self.dropped += 1
+            return
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                if self.overflow == DROP_NEWEST:
+                    self.dropped += 1
+                    return
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                continue
+            self.queue.task_done()
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is _STOP:
+                    return
+                self._ship(*item)
+            finally:
+                self.queue.task_done()
+
+    def _ship(self, record, data):
+        target = self.target
+        if not target.filter(record):
+            return
+        try:
+            if data is None:
+                data = target.makePickle(record)
+            target.acquire()
+            try:
+                target.send(data)
+            finally:
+                target.release()
+        except Exception:
+            target.handleError(record)
+        else:
+            self.sent += 1
+
+    def flush(self):
+        """Block until every queued record has been handed to the target.
+        """
+        if self._thread.is_alive():
+            self.queue.join()
+        self.target.flush()
+
+    def close(self):
+        """Drain the queue, stop the worker thread and close the target.
+        """
+        self.acquire()
+        try:
+            if not self._closed:
+                self._closed = True
+                self.queue.put(_STOP)
+                self._thread.join()
+                self.target.close()
+        finally:
+            self.release()
+        logging.Handler.close(self)
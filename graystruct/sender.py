@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+"""Ship logs from many worker processes through a single sender process.
+
+Worker processes (e.g. gunicorn or uwsgi workers) attach a
+:class:`GELFForwardingHandler`, which writes encoded GELF payloads to a
+local Unix domain socket.  A :class:`GELFSender`, usually running in a
+dedicated process started with :func:`start_sender_process`, reads them
+and hands them to the real graystruct handlers, which own the broker or
+Graylog connections and do the batching and compression.
+
+"""
+from __future__ import absolute_import
+
+import multiprocessing
+import os
+import signal
+import stat
+import threading
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from .handler import GELFTCPHandler, _payload_record
+
+
+class GELFForwardingHandler(GELFTCPHandler):
+    """Forward encoded GELF payloads to a :class:`GELFSender`.
+
+    Payloads are written uncompressed and null-byte framed over a Unix
+    domain socket; compression is left to the sender process.
+
+    :param path: Path of the sender's Unix domain socket.
+
+    """
+
+    def __init__(self, path):
+        GELFTCPHandler.__init__(self, path, None)
+
+
+class _FrameReader(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        buf = b''
+        dispatch = self.server.dispatch
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                return
+            frames = (buf + data).split(b'\0')
+            buf = frames.pop()
+            for frame in frames:
+                dispatch(frame)
+
+
+class GELFSender(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Receive payloads from forwarding handlers and ship them.
+
+    :param path: Path of the Unix domain socket to listen on.  A stale
+        socket left at this path is removed.
+    :param handlers: The graystruct handlers that ship each payload.
+
+    Payloads are handed on as ``CRITICAL`` records, as by
+    :func:`graystruct.file.replay`, so that the handlers' levels do not
+    filter them out; the level was checked in the worker.
+
+    """
+
+    daemon_threads = True
+    # Many workers may connect at once, e.g. right after a pre-fork
+    # server spawns them.
+    request_queue_size = 128
+
+    def __init__(self, path, handlers):
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, _FrameReader)
+        self.path = path
+        self.handlers = list(handlers)
+        self.received = 0
+        self._received_lock = threading.Lock()
+
+    def dispatch(self, payload):
+        with self._received_lock:
+            self.received += 1
+        record = _payload_record(payload, __name__)
+        for handler in self.handlers:
+            handler.handle(record)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        for handler in self.handlers:
+            handler.flush()
+            handler.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def _raise_exit(signum, frame):
+    raise SystemExit(0)
+
+
+def _run_sender(path, handler_factory, ready):
+    signal.signal(signal.SIGTERM, _raise_exit)
+    sender = GELFSender(path, handler_factory())
+    ready.set()
+    try:
+        sender.serve_forever()
+    finally:
+        sender.server_close()
+
+
+def start_sender_process(path, handler_factory):
+    """Start a daemon process running a :class:`GELFSender` on ``path``.
+
+    :param handler_factory: Callable returning the list of handlers; it
+        is called in the sender process so that the connections are
+        owned by that process.
+
+    Returns the :class:`multiprocessing.Process` once the socket is
+    listening.  ``terminate()`` stops it after flushing the handlers.
+
+    """
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(
+        target=_run_sender, args=(path, handler_factory, ready),
+        name='graystruct-sender')
+    process.daemon = True
+    process.start()
+    while not ready.wait(0.1):
+        if not process.is_alive():
+            raise RuntimeError(
+                'sender process exited with code {}'.format(
+                    process.exitcode))
+    return process
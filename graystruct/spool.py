@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+from __future__ import absolute_import
+
+import collections
+import errno
+import logging
+import mmap
+import os
+import shutil
+import struct
+import threading
+
+from .utils import _register_after_fork
+
+_FRAME_HEADER = struct.Struct('>I')
+_INDEX = struct.Struct('>QQ')
+
+SEGMENT_SUFFIX = '.seg'
+INDEX_NAME = 'index'
+
+
+def _segment_id(name):
+    stem = name[:-len(SEGMENT_SUFFIX)]
+    if name.endswith(SEGMENT_SUFFIX) and stem.isdigit():
+        return int(stem)
+    return None
+
+
+class DiskSpool(object):
+    """Append-only queue of payloads kept in segment files on disk.
+
+    Payloads are appended as length-prefixed frames to numbered segment
+    files of about ``segment_size`` bytes.  The position of the oldest
+    unsent payload (segment number and offset) is kept in a small
+    memory-mapped ``index`` file, so a spool opened again after a
+    restart resumes where the previous process stopped.
+
+    :param directory: Directory holding the segments; created if needed.
+    :param segment_size: Size in bytes after which a new segment is
+        started.
+    :param max_size: Maximum number of bytes held.  Beyond it the oldest
+        segments are deleted, whether they were sent or not; ``evicted``
+        counts the payloads lost this way.
+    :param fsync: Call ``os.fsync`` after each append, so that payloads
+        also survive a crash of the machine (much slower).
+
+    """
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024,
+                 max_size=256 * 1024 * 1024, fsync=False):
+        try:
+            os.makedirs(directory)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.fsync = fsync
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._reader = None
+        self._reader_segment = None
+        self._index = self._open_index()
+        self._read_segment, self._read_offset = _INDEX.unpack(
+            self._index[:_INDEX.size])
+
+        segments = sorted(
+            segment for segment in map(_segment_id, os.listdir(directory))
+            if segment is not None)
+        for segment in segments:
+            if segment < self._read_segment:
+                os.remove(self._path(segment))
+        segments = [
+            segment for segment in segments if segment >= self._read_segment]
+        if not segments:
+            segments = [self._read_segment]
+            self._read_offset = 0
+        elif segments[0] > self._read_segment:
+            self._read_segment, self._read_offset = segments[0], 0
+        self._segments = collections.deque(segments)
+        self._sizes = {}
+        for segment in segments[:-1]:
+            self._sizes[segment] = os.path.getsize(self._path(segment))
+        self._sizes[segments[-1]] = self._recover(segments[-1])
+        self._writer = open(self._path(segments[-1]), 'ab')
+        self._save_index()
+
+    def _path(self, segment):
+        return os.path.join(
+            self.directory, '{:016d}{}'.format(segment, SEGMENT_SUFFIX))
+
+    def _open_index(self):
+        path = os.path.join(self.directory, INDEX_NAME)
+        with open(path, 'a+b') as fh:
+            fh.seek(0, os.SEEK_END)
+            if fh.tell() < _INDEX.size:
+                fh.truncate(0)
+                fh.write(_INDEX.pack(0, 0))
+                fh.flush()
+            return mmap.mmap(fh.fileno(), _INDEX.size)
+
+    def _save_index(self):
+        self._index[:_INDEX.size] = _INDEX.pack(
+            self._read_segment, self._read_offset)
+
+    def _recover(self, segment):
+        # Cut off a frame left incomplete by a crash during an append.
+        path = self._path(segment)
+        offset = 0
+        with open(path, 'a+b') as fh:
+            fh.seek(0, os.SEEK_END)
+            size = fh.tell()
+            fh.seek(0)
+            while offset + _FRAME_HEADER.size <= size:
+                length, = _FRAME_HEADER.unpack(fh.read(_FRAME_HEADER.size))
+                if offset + _FRAME_HEADER.size + length > size:
+                    break
+                offset += _FRAME_HEADER.size + length
+                fh.seek(offset)
+            if offset != size:
+                fh.truncate(offset)
+        return offset
+
+    def _count(self, segment, offset):
+        count = 0
+        size = self._sizes[segment]
+        with open(self._path(segment), 'rb') as fh:
+            while offset < size:
+                fh.seek(offset)
+                length, = _FRAME_HEADER.unpack(fh.read(_FRAME_HEADER.size))
+                offset += _FRAME_HEADER.size + length
+                count += 1
+        return count
+
+    @property
+    def size(self):
+        """Number of bytes not yet committed.
+        """
+        with self._lock:
+            return sum(self._sizes.values()) - self._read_offset
+
+    def empty(self):
+        with self._lock:
+            return (self._read_segment == self._segments[-1] and
+                    self._read_offset >= self._sizes[self._read_segment])
+
+    def append(self, payload):
+        frame = _FRAME_HEADER.pack(len(payload)) + bytes(payload)
+        with self._lock:
+            segment = self._segments[-1]
+            if (self._sizes[segment] and
+                    self._sizes[segment] + len(frame) > self.segment_size):
+                self._writer.close()
+                segment += 1
+                self._writer = open(self._path(segment), 'ab')
+                self._segments.append(segment)
+                self._sizes[segment] = 0
+            self._writer.write(frame)
+            self._writer.flush()
+            if self.fsync:
+                os.fsync(self._writer.fileno())
+            self._sizes[segment] += len(frame)
+            self._evict()
+
+    def _evict(self):
+        segments = self._segments
+        while (len(segments) > 1 and
+               sum(self._sizes.values()) - self._read_offset > self.max_size):
+            segment = segments[0]
+            offset = 0
+            if segment == self._read_segment:
+                offset = self._read_offset
+                self._read_segment, self._read_offset = segments[1], 0
+            self.evicted += self._count(segment, offset)
+            self._remove(segment)
+        self._save_index()
+
+    def _remove(self, segment):
+        if self._reader_segment == segment:
+            self._reader.close()
+            self._reader = self._reader_segment = None
+        self._segments.popleft()
+        del self._sizes[segment]
+        os.remove(self._path(segment))
+
+    def read(self, max_count):
+        """Return up to ``max_count`` of the oldest uncommitted payloads.
+
+        Each payload is paired with the position to pass to
+        :meth:`commit` once it has been delivered.  Reading does not
+        remove payloads from the spool.
+
+        """
+        with self._lock:
+            segment, offset = self._read_segment, self._read_offset
+            items = []
+            while len(items) < max_count:
+                if offset >= self._sizes[segment]:
+                    if segment == self._segments[-1]:
+                        break
+                    segment, offset = segment + 1, 0
+                    continue
+                if self._reader_segment != segment:
+                    if self._reader is not None:
+                        self._reader.close()
+                    self._reader = open(self._path(segment), 'rb')
+                    self._reader_segment = segment
+                self._reader.seek(offset)
+                length, = _FRAME_HEADER.unpack(
+                    self._reader.read(_FRAME_HEADER.size))
+                payload = self._reader.read(length)
+                offset += _FRAME_HEADER.size + length
+                items.append((payload, (segment, offset)))
+            return items
+
+    def commit(self, position):
+        """Remove every payload up to ``position`` from the spool.
+        """
+        with self._lock:
+            if position <= (self._read_segment, self._read_offset):
+                # Already committed, or evicted in the meantime
+                return
+            self._read_segment, self._read_offset = position
+            while self._segments[0] < self._read_segment:
+                self._remove(self._segments[0])
+            self._save_index()
+
+    def close(self):
+        with self._lock:
+            self._writer.close()
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = self._reader_segment = None
+            self._index.flush()
+            self._index.close()
+
+
+class SpoolingGELFHandler(logging.Handler):
+    """Keep GELF records on disk while the transport is unavailable.
+
+    Records are compressed with the target handler's ``makePickle`` and
+    sent with its ``send``.  When sending fails, the payload is appended
+    to a :class:`DiskSpool` instead, and so is every following record
+    until the spool is empty again, which keeps records in order.  A
+    background thread replays spooled payloads in batches of
+    ``batch_size``, retrying every ``retry_interval`` seconds while the
+    transport is still failing.  Payloads left in the spool when the
+    process exits are replayed by the next handler opened on the same
+    ``directory``.
+
+    :param target: The graystruct handler that ships the records.  Its
+        send must fail loudly: use :class:`graystruct.handler.GELFHandler`
+        or :class:`graystruct.handler.GELFTCPHandler`, or a
+        :class:`graystruct.rabbitmq.GELFRabbitHandler` with
+        ``spill_size=0``.  UDP cannot detect an unreachable input.
+    :param directory: Directory of the spool.
+
+    The remaining parameters are passed to :class:`DiskSpool`.
+    Delivery is at-least-once: a payload sent just before the process
+    dies may be sent again by the next process.  ``sent`` counts
+    payloads delivered, ``spooled`` payloads written to disk and
+    ``dropped`` payloads evicted from a full spool.
+
+    A process forked from the one that opened the handler leaves the
+    parent's spool alone and spools to a ``pid-<pid>`` subdirectory of
+    ``directory`` instead, removed on :meth:`close` if nothing is
+    left in it.
+
+    """
+
+    def __init__(self, target, directory, segment_size=16 * 1024 * 1024,
+                 max_size=256 * 1024 * 1024, batch_size=100,
+                 retry_interval=1.0, fsync=False):
+        logging.Handler.__init__(self, level=target.level)
+        self.target = target
+        self.directory = directory
+        self._spool_args = (segment_size, max_size, fsync)
+        self._child = False
+        self.spool = DiskSpool(directory, *self._spool_args)
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self.sent = 0
+        self.spooled = 0
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._start()
+        _register_after_fork(self)
+
+    def _start(self):
+        self._thread = threading.Thread(
+            target=self._run, name='graystruct-spooling-handler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _after_fork(self):
+        if self._stopped.is_set():
+            return
+        # The parent keeps replaying its own spool; appending to it from
+        # here as well would interleave frames in its segments.
+        self.spool = DiskSpool(
+            os.path.join(self.directory, 'pid-{}'.format(os.getpid())),
+            *self._spool_args)
+        self._child = True
+        self._wake = threading.Event()
+        self._start()
+
+    @property
+    def dropped(self):
+        return self.spool.evicted
+
+    def _deliver(self, data):
+        target = self.target
+        target.acquire()
+        try:
+            target.send(data)
+            # Socket based handlers swallow errors and drop the socket
+            if getattr(target, 'sock', True) is None:
+                raise IOError('GELF input is unreachable')
+        finally:
+            target.release()
+
+    def emit(self, record):
+        target = self.target
+        if not target.filter(record):
+            return
+        try:
+            data = target.makePickle(record)
+        except Exception:
+            self.handleError(record)
+            return
+        if self.spool.empty():
+            try:
+                self._deliver(data)
+            except Exception:
+                pass
+            else:
+                self.sent += 1
+                return
+        try:
+            self.spool.append(data)
+        except Exception:
+            self.handleError(record)
+            return
+        self.spooled += 1
+        self._wake.set()
+
+    def _replay(self):
+        """Send one batch from the spool; return False if sending failed.
+        """
+        position = None
+        try:
+            for data, next_position in self.spool.read(self.batch_size):
+                self._deliver(data)
+                self.sent += 1
+                position = next_position
+        except Exception:
+            return False
+        finally:
+            if position is not None:
+                self.spool.commit(position)
+        return True
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.clear()
+            if self.spool.empty():
+                self._wake.wait()
+            elif not self._replay():
+                self._stopped.wait(self.retry_interval)
+
+    def flush(self):
+        self.target.flush()
+
+    def close(self):
+        """Stop the replay thread and close the spool and the target.
+
+        Payloads still spooled stay on disk.
+
+        """
+        self.acquire()
+        try:
+            if not self._stopped.is_set():
+                self._stopped.set()
+                self._wake.set()
+                self._thread.join()
+                empty = self.spool.empty()
+                self.spool.close()
+                if self._child and empty:
+                    shutil.rmtree(self.spool.directory)
+                self.target.close()
+        finally:
+            self.release()
+        logging.Handler.close(self)
@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+"""Counters and latency histograms for graystruct handlers.
+
+Handlers are not instrumented by default.  :func:`instrument` wraps the
+``makePickle`` and send methods of one handler instance, so handlers
+that are not instrumented run exactly as before::
+
+    stats = instrument(handler, 'graylog-http')
+    stats.snapshot()
+
+:func:`prometheus_text` renders every registered
+:class:`HandlerStats` in the Prometheus text format,
+:func:`start_http_server` serves it, and :class:`StatsReporter`
+periodically logs each snapshot as a record of its own.
+
+"""
+from __future__ import absolute_import
+
+import bisect
+import functools
+import threading
+import time
+import weakref
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from .utils import _register_after_fork
+
+try:
+    _timer = time.perf_counter
+except AttributeError:  # pragma: no cover
+    _timer = time.time
+
+
+#: Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+#: Handler attributes reported as gauges when the handler has them.
+GAUGE_ATTRIBUTES = (
+    'sent', 'dropped', 'spill_dropped', 'aggregated', 'frames_sent',
+    'writes', 'spooled')
+
+#: Registered statistics by name.
+REGISTRY = {}
+
+
+class _RegistryLock(object):
+    """Lock guarding :data:`REGISTRY`, recreated in forked children.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        _register_after_fork(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self._lock.__enter__()
+
+    def __exit__(self, *exc_info):
+        return self._lock.__exit__(*exc_info)
+
+
+_registry_lock = _RegistryLock()
+
+
+class Histogram(object):
+    """Latency histogram with fixed bucket bounds.
+
+    Updates take no lock; concurrent observations may very rarely be
+    lost, which is acceptable for monitoring.
+
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return {
+            'buckets': list(self.buckets),
+            'counts': list(self.counts),
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class HandlerStats(object):
+    """Statistics of one instrumented handler.
+
+    ``records``, ``bytes_in`` (encoded payloads), ``bytes_out`` (after
+    compression), ``sends``, ``reconnects`` and ``errors`` are counters;
+    ``encode``, ``compress`` and ``send`` are :class:`Histogram`
+    instances.  Attributes of the handler such as ``dropped`` and the
+    queue depth are read when a snapshot is taken.
+
+    """
+
+    COUNTERS = (
+        'records', 'bytes_in', 'bytes_out', 'sends', 'reconnects', 'errors')
+    HISTOGRAMS = ('encode', 'compress', 'send')
+
+    def __init__(self, name, handler=None):
+        self.name = name
+        self._handler = None if handler is None else weakref.ref(handler)
+        for counter in self.COUNTERS:
+            setattr(self, counter, 0)
+        for histogram in self.HISTOGRAMS:
+            setattr(self, histogram, Histogram())
+
+    def gauges(self):
+        handler = None if self._handler is None else self._handler()
+        if handler is None:
+            return {}
+        gauges = {}
+        for attribute in GAUGE_ATTRIBUTES:
+            value = getattr(handler, attribute, None)
+            if isinstance(value, int):
+                gauges[attribute] = value
+        queue = getattr(handler, 'queue', None)
+        if hasattr(queue, 'qsize'):
+            gauges['queue_depth'] = queue.qsize()
+        spill = getattr(handler, 'spill', None)
+        if spill is not None:
+            gauges['spill_depth'] = len(spill)
+        pool = getattr(handler, 'pool', None)
+        if hasattr(pool, 'opened'):
+            gauges['connections_opened'] = pool.opened
+        return gauges
+
+    def snapshot(self):
+        """Return the current values as a JSON-serializable dict.
+        """
+        snapshot = {'name': self.name}
+        for counter in self.COUNTERS:
+            snapshot[counter] = getattr(self, counter)
+        for histogram in self.HISTOGRAMS:
+            snapshot[histogram] = getattr(self, histogram).snapshot()
+        snapshot.update(self.gauges())
+        return snapshot
+
+
+def _register(name, stats):
+    with _registry_lock:
+        unique = name
+        index = 1
+        while unique in REGISTRY:
+            index += 1
+            unique = '{}_{}'.format(name, index)
+        stats.name = unique
+        REGISTRY[unique] = stats
+    return stats
+
+
+def unregister(stats):
+    """Remove ``stats`` from :data:`REGISTRY`.
+    """
+    with _registry_lock:
+        if REGISTRY.get(stats.name) is stats:
+            del REGISTRY[stats.name]
+
+
+def _timed_pickle(make_pickle, stats):
+    @functools.wraps(make_pickle)
+    def makePickle(record):
+        start = _timer()
+        data = make_pickle(record)
+        stats.compress.observe(_timer() - start)
+        stats.records += 1
+        # The length of the message as logged: bytes, or characters for
+        # text payloads, which the encoder keeps ASCII by default.
+        stats.bytes_in += len(record.msg)
+        stats.bytes_out += len(data)
+        return data
+    return makePickle
+
+
+def _timed_send(send, stats):
+    @functools.wraps(send)
+    def timed_send(data):
+        start = _timer()
+        try:
+            return send(data)
+        finally:
+            stats.send.observe(_timer() - start)
+            stats.sends += 1
+    return timed_send
+
+
+def _counted_connect(handler, stats):
+    create_socket = handler.createSocket
+
+    @functools.wraps(create_socket)
+    def createSocket():
+        had_socket = handler.sock is not None
+        create_socket()
+        if not had_socket and handler.sock is not None:
+            stats.reconnects += 1
+    return createSocket
+
+
+def _counted_error(handle_error, stats):
+    @functools.wraps(handle_error)
+    def handleError(record):
+        stats.errors += 1
+        return handle_error(record)
+    return handleError
+
+
+def instrument(handler, name=None):
+    """Collect statistics for ``handler`` and register them.
+
+    Wrappers such as :class:`graystruct.queued.QueuedGELFHandler` are
+    instrumented through their ``target``, with their own counters and
+    queue depth reported as gauges.  For a
+    :class:`graystruct.fanout.FanoutGELFHandler`, each destination's
+    queue is instrumented as ``<name>.<index>`` and the returned
+    statistics only hold the fan-out's own gauges and errors.  Handlers
+    with asynchronous transports (:mod:`graystruct.aio`) are not
+    supported.  Returns the :class:`HandlerStats`, also available as
+    ``handler.stats``.
+
+    """
+    if getattr(handler, 'stats', None) is not None:
+        return handler.stats
+    stats = _register(
+        name or type(handler).__name__, HandlerStats(name, handler))
+    queues = getattr(handler, 'queues', None)
+    if queues is not None:
+        for index, queue in enumerate(queues):
+            instrument(queue, '{}.{}'.format(stats.name, index))
+        handler.handleError = _counted_error(handler.handleError, stats)
+        handler.stats = stats
+        return stats
+    transport = getattr(handler, 'target', handler)
+    transport.makePickle = _timed_pickle(transport.makePickle, stats)
+    transport.send = _timed_send(transport.send, stats)
+    if hasattr(transport, 'createSocket'):
+        transport.createSocket = _counted_connect(transport, stats)
+    transport.handleError = _counted_error(transport.handleError, stats)
+    if transport is not handler:
+        handler.handleError = _counted_error(handler.handleError, stats)
+    handler.stats = stats
+    return stats
+
+
+def timed_processor(processor, name='encoder'):
+    """Wrap a structlog processor, usually the encoder, to time it.
+
+    Returns ``(wrapped_processor, stats)``; the time spent is recorded
+    in the ``encode`` histogram.
+
+    """
+    stats = _register(name, HandlerStats(name))
+
+    @functools.wraps(processor)
+    def timed(logger, method_name, event_dict):
+        start = _timer()
+        try:
+            return processor(logger, method_name, event_dict)
+        finally:
+            stats.encode.observe(_timer() - start)
+            stats.records += 1
+    return timed, stats
+
+
+def _labels(name, **extra):
+    labels = [('handler', name)] + sorted(extra.items())
+    return '{' + ','.join(
+        '{}="{}"'.format(
+            key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in labels) + '}'
+
+
+def prometheus_text(registry=None):
+    """Render the registered statistics in the Prometheus text format.
+    """
+    if registry is None:
+        registry = REGISTRY
+    with _registry_lock:
+        snapshots = [stats.snapshot() for stats in registry.values()]
+    lines = []
+    for counter in HandlerStats.COUNTERS:
+        metric = 'graystruct_{}_total'.format(counter)
+        lines.append('# TYPE {} counter'.format(metric))
+        for snapshot in snapshots:
+            lines.append('{}{} {}'.format(
+                metric, _labels(snapshot['name']), snapshot[counter]))
+    for histogram in HandlerStats.HISTOGRAMS:
+        metric = 'graystruct_{}_seconds'.format(histogram)
+        lines.append('# TYPE {} histogram'.format(metric))
+        for snapshot in snapshots:
+            values = snapshot[histogram]
+            name = snapshot['name']
+            cumulative = 0
+            for bound, count in zip(values['buckets'], values['counts']):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    metric, _labels(name, le=repr(bound)), cumulative))
+            lines.append('{}_bucket{} {}'.format(
+                metric, _labels(name, le='+Inf'), values['count']))
+            lines.append('{}_sum{} {!r}'.format(
+                metric, _labels(name), values['sum']))
+            lines.append('{}_count{} {}'.format(
+                metric, _labels(name), values['count']))
+    gauges = sorted(set().union(*[
+        set(key for key, value in snapshot.items()
+            if key not in HandlerStats.COUNTERS and
+            key not in HandlerStats.HISTOGRAMS and key != 'name')
+        for snapshot in snapshots] or [set()]))
+    for gauge in gauges:
+        metric = 'graystruct_{}'.format(gauge)
+        lines.append('# TYPE {} gauge'.format(metric))
+        for snapshot in snapshots:
+            if gauge in snapshot:
+                lines.append('{}{} {}'.format(
+                    metric, _labels(snapshot['name']), snapshot[gauge]))
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = prometheus_text(self.server.registry).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_http_server(port, host='127.0.0.1', registry=None):
+    """Serve :func:`prometheus_text` at ``/metrics`` from a daemon thread.
+
+    Returns the server; call its ``shutdown()`` method to stop it.
+
+    """
+    server = HTTPServer((host, port), _MetricsRequestHandler)
+    server.registry = REGISTRY if registry is None else registry
+    thread = threading.Thread(
+        target=server.serve_forever, name='graystruct-metrics')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class StatsReporter(object):
+    """Periodically log a snapshot of each registered handler.
+
+    :param logger: A structlog logger; each snapshot is logged as a
+        ``'graystruct.stats'`` info event with the counters, gauges and
+        the count and total time of each histogram as fields.
+    :param interval: Seconds between reports.
+
+    Handlers are not instrumented by their own report records, but a
+    report logged through an instrumented handler is counted by it.
+
+    """
+
+    def __init__(self, logger, interval=60, registry=None):
+        self.logger = logger
+        self.interval = interval
+        self.registry = REGISTRY if registry is None else registry
+        self._stopped = threading.Event()
+        self._start()
+        _register_after_fork(self)
+
+    def _start(self):
+        self._thread = threading.Thread(
+            target=self._run, name='graystruct-stats-reporter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _after_fork(self):
+        if not self._stopped.is_set():
+            self._start()
+
+    def report(self):
+        with _registry_lock:
+            snapshots = [stats.snapshot() for stats in self.registry.values()]
+        for snapshot in snapshots:
+            fields = {}
+            for key, value in snapshot.items():
+                if isinstance(value, dict):
+                    fields['{}_count'.format(key)] = value['count']
+                    fields['{}_seconds'.format(key)] = value['sum']
+                elif key != 'name':
+                    fields[key] = value
+            self.logger.info(
+                'graystruct.stats', stats_name=snapshot['name'], **fields)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+from __future__ import absolute_import
+
+import asyncio
+import json
+import logging
+import time
+import unittest
+import zlib
+
+from structlog import wrap_logger
+
+from ..aio import AsyncGELFHandler, HTTPTransport, TCPTransport, UDPTransport
+from ..encoder import GELFEncoder
+from ..handler import GELFHandler
+from .test_handler import GELFHTTPInput, TCPCollector, UDPCollector
+
+
+async def measure_lag(coro, interval=0.001):
+    """Run ``coro`` and return the largest delay of a periodic tick."""
+    lag = [0.0]
+    done = asyncio.Event()
+
+    async def tick():
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            lag[0] = max(lag[0], time.perf_counter() - start - interval)
+
+    ticker = asyncio.ensure_future(tick())
+    try:
+        await coro
+    finally:
+        done.set()
+        await ticker
+    return lag[0]
+
+
+class TestAsyncGELFHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.std_logger = logging.Logger(__name__, logging.DEBUG)
+        self.logger = wrap_logger(self.std_logger, processors=[
+            GELFEncoder(fqdn=False, localname='host')])
+
+    def _run(self, coro):
+        return asyncio.run(coro)
+
+    async def _log(self, handler, count):
+        self.std_logger.addHandler(handler)
+        for index in range(count):
+            self.logger.warning('event', index=index)
+            await asyncio.sleep(0)
+
+    def test_tcp_transport(self):
+        # Given
+        collector = TCPCollector()
+        self.addCleanup(collector.close)
+        handler = AsyncGELFHandler(TCPTransport('127.0.0.1', collector.port))
+
+        async def main():
+            handler.start()
+            await self._log(handler, 5)
+            await handler.aclose()
+
+        # When
+        self._run(main())
+
+        # Then
+        frames = collector.wait_for(5)
+        self.assertEqual([frame['_index'] for frame in frames], list(range(5)))
+        self.assertEqual(frames[0]['short_message'], 'event')
+        self.assertEqual(handler.sent, 5)
+        self.assertEqual(collector.connections, 1)
+
+    def test_udp_transport_chunks_large_records(self):
+        # Given
+        collector = UDPCollector()
+        self.addCleanup(collector.close)
+        transport = UDPTransport(
+            '127.0.0.1', collector.port, chunk_size=100, compress_level=0)
+        handler = AsyncGELFHandler(transport)
+
+        async def main():
+            handler.start()
+            self.std_logger.addHandler(handler)
+            self.logger.warning('event', data='x' * 1000)
+            await handler.aclose()
+
+        # When
+        self._run(main())
+
+        # Then
+        event_dict = json.loads(
+            zlib.decompress(collector.receive()).decode('utf-8'))
+        self.assertEqual(event_dict['_data'], 'x' * 1000)
+        self.assertGreater(len(collector.datagram_sizes), 1)
+        self.assertLessEqual(max(collector.datagram_sizes), 100)
+
+    def test_http_transport_keep_alive(self):
+        # Given
+        server = GELFHTTPInput()
+        self.addCleanup(server.stop)
+        handler = AsyncGELFHandler(HTTPTransport('127.0.0.1', server.port))
+
+        async def main():
+            handler.start()
+            await self._log(handler, 3)
+            await handler.aclose()
+
+        # When
+        self._run(main())
+
+        # Then
+        messages = [
+            json.loads(zlib.decompress(body).decode('utf-8'))['_index']
+            for body in server.bodies
+        ]
+        self.assertEqual(messages, [0, 1, 2])
+        self.assertEqual(server.connections, 1)
+
+    def test_http_transport_error_status(self):
+        # Given
+        server = GELFHTTPInput(status=500)
+        self.addCleanup(server.stop)
+        handler = AsyncGELFHandler(HTTPTransport('127.0.0.1', server.port))
+        handler.handleError = lambda record: None
+
+        async def main():
+            handler.start()
+            await self._log(handler, 1)
+            await handler.aclose()
+
+        # When
+        self._run(main())
+
+        # Then
+        self.assertEqual(len(server.bodies), 1)
+        self.assertEqual(handler.sent, 0)
+        self.assertEqual(handler.dropped, 1)
+
+    def test_overflow_drops_newest(self):
+        # Given
+        handler = AsyncGELFHandler(TCPTransport('127.0.0.1', 1), maxsize=2)
+        self.std_logger.addHandler(handler)
+
+        # When
+        for index in range(3):
+            self.logger.warning('event', index=index)
+
+        # Then
+        self.assertEqual(handler.dropped, 1)
+        self.assertEqual(
+            [json.loads(record.msg)['_index'] for record in handler._buffer],
+            [0, 1])
+
+    def test_overflow_drops_oldest(self):
+        # Given
+        handler = AsyncGELFHandler(
+            TCPTransport('127.0.0.1', 1), maxsize=2, overflow='drop-oldest')
+        self.std_logger.addHandler(handler)
+
+        # When
+        for index in range(3):
+            self.logger.warning('event', index=index)
+
+        # Then
+        self.assertEqual(handler.dropped, 1)
+        self.assertEqual(
+            [json.loads(record.msg)['_index'] for record in handler._buffer],
+            [1, 2])
+
+    def test_loop_shutdown_ships_buffered_records(self):
+        # Given
+        collector = TCPCollector()
+        self.addCleanup(collector.close)
+        handler = AsyncGELFHandler(TCPTransport('127.0.0.1', collector.port))
+
+        async def main():
+            handler.start()
+            self.std_logger.addHandler(handler)
+            for index in range(50):
+                self.logger.warning('event', index=index)
+
+        # When
+        self._run(main())
+
+        # Then
+        frames = collector.wait_for(50)
+        self.assertEqual(len(frames), 50)
+        self.assertEqual(handler.sent, 50)
+
+    def test_logging_from_another_thread(self):
+        # Given
+        collector = TCPCollector()
+        self.addCleanup(collector.close)
+        handler = AsyncGELFHandler(TCPTransport('127.0.0.1', collector.port))
+
+        async def main():
+            handler.start()
+            self.std_logger.addHandler(handler)
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.logger.warning, 'event')
+            await asyncio.sleep(0.1)
+            self.assertEqual(handler.sent, 1)
+            await handler.aclose()
+
+        # When
+        self._run(main())
+
+        # Then
+        self.assertEqual(len(collector.wait_for(1)), 1)
+
+    def test_event_loop_lag(self):
+        # Given
+        server = GELFHTTPInput(delay=0.1)
+        self.addCleanup(server.stop)
+        sync_handler = GELFHandler('127.0.0.1', server.port)
+        self.addCleanup(sync_handler.close)
+        async_handler = AsyncGELFHandler(
+            HTTPTransport('127.0.0.1', server.port))
+
+        async def log_sync():
+            await self._log(sync_handler, 5)
+            self.std_logger.removeHandler(sync_handler)
+
+        async def log_async():
+            async_handler.start()
+            await self._log(async_handler, 5)
+            await async_handler.aclose()
+
+        # When
+        sync_lag = self._run(measure_lag(log_sync()))
+        async_lag = self._run(measure_lag(log_async()))
+
+        # Then
+        self.assertEqual(len(server.bodies), 10)
+        # Each blocking request stalls the loop for the whole delay; the
+        # asynchronous handler only adds scheduling jitter.
+        self.assertGreaterEqual(sync_lag, 0.09)
+        self.assertLess(async_lag, sync_lag / 2)
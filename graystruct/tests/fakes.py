@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+from __future__ import absolute_import
+
+import json
+import logging
+import threading
+import time
+import zlib
+
+from ..handler import _CompressHandler
+
+
+class FakeTransport(_CompressHandler, logging.Handler):
+    """A graystruct transport keeping the payloads it is sent.
+
+    Payloads are decompressed (zlib or gzip) into ``payloads``.  Setting
+    ``available`` to ``False`` makes :meth:`send` raise; with
+    ``blocked=True`` each send waits until ``unblocked`` is set.
+    ``compressed`` counts the payloads compressed by all instances.
+
+    """
+
+    compressed = 0
+
+    def __init__(self, level=logging.NOTSET, blocked=False):
+        logging.Handler.__init__(self, level)
+        self.payloads = []
+        self.available = True
+        self.closed = False
+        self.unblocked = threading.Event()
+        if not blocked:
+            self.unblocked.set()
+
+    def compress_payload(self, payload):
+        FakeTransport.compressed += 1
+        return _CompressHandler.compress_payload(self, payload)
+
+    def send(self, data):
+        self.unblocked.wait(5)
+        if not self.available:
+            raise IOError('input unavailable')
+        self.payloads.append(zlib.decompress(data, 47))
+
+    def emit(self, record):
+        try:
+            self.send(self.makePickle(record))
+        except Exception:
+            self.handleError(record)
+
+    def messages(self):
+        return [json.loads(payload.decode('utf-8'))
+                for payload in self.payloads]
+
+    def wait_for(self, count, timeout=5):
+        deadline = time.time() + timeout
+        while len(self.payloads) < count and time.time() < deadline:
+            time.sleep(0.01)
+        return self.payloads
+
+    def close(self):
+        self.closed = True
+        logging.Handler.close(self)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+from __future__ import absolute_import
+
+import json
+import logging
+import time
+import unittest
+
+from structlog import wrap_logger
+
+from ..aggregate import AggregatingGELFHandler
+from ..encoder import GELFEncoder
+
+
+class CollectingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+        self.closed = False
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def close(self):
+        self.closed = True
+        logging.Handler.close(self)
+
+    def messages(self):
+        return [json.loads(record.msg) for record in self.records]
+
+
+class TestAggregatingGELFHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.target = CollectingHandler()
+        self.std_logger = logging.Logger(__name__, logging.DEBUG)
+        self.logger = wrap_logger(self.std_logger, processors=[
+            GELFEncoder(fqdn=False, localname='host')])
+
+    def _add_handler(self, **kwargs):
+        handler = AggregatingGELFHandler(self.target, **kwargs)
+        self.std_logger.addHandler(handler)
+        self.addCleanup(handler.close)
+        return handler
+
+    def test_identical_records_collapsed(self):
+        # Given
+        handler = self._add_handler(window=60)
+
+        # When
+        for attempt in range(100):
+            self.logger.error('db.timeout', attempt=attempt)
+        self.logger.error('db.connect')
+        handler.flush()
+
+        # Then
+        first, connect, collapsed = self.target.messages()
+        self.assertEqual(first['_attempt'], 0)
+        self.assertNotIn('_count', first)
+        self.assertEqual(connect['short_message'], 'db.connect')
+        self.assertNotIn('_count', connect)
+        self.assertEqual(collapsed['short_message'], 'db.timeout')
+        self.assertEqual(collapsed['_attempt'], 0)
+        self.assertEqual(collapsed['_count'], 99)
+        self.assertLessEqual(
+            collapsed['_first_seen'], collapsed['_last_seen'])
+        self.assertEqual(handler.aggregated, 99)
+
+    def test_first_record_not_delayed(self):
+        # Given
+        self._add_handler(window=60)
+
+        # When
+        self.logger.error('db.connect')
+
+        # Then
+        record, = self.target.records
+        self.assertNotIn('_count', json.loads(record.msg))
+
+    def test_fields_distinguish_records(self):
+        # Given
+        handler = self._add_handler(window=60, fields=('user',))
+
+        # When
+        for user in ('a', 'b', 'a'):
+            self.logger.warning('login.failed', user=user)
+        handler.flush()
+
+        # Then
+        self.assertEqual(
+            [(message['_user'], message.get('_count'))
+             for message in self.target.messages()],
+            [('a', None), ('b', None), ('a', 1)])
+
+    def test_levels_distinguish_records(self):
+        # Given
+        handler = self._add_handler(window=60)
+
+        # When
+        self.logger.warning('retry')
+        self.logger.error('retry')
+        handler.flush()
+
+        # Then
+        self.assertEqual(len(self.target.records), 2)
+
+    def test_window_expiry(self):
+        # Given
+        self._add_handler(window=0.1)
+
+        # When
+        self.logger.warning('retry')
+        self.logger.warning('retry')
+        deadline = time.time() + 5
+        while len(self.target.records) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+
+        # Then
+        self.assertEqual(
+            [message.get('_count') for message in self.target.messages()],
+            [None, 1])
+
+    def test_bounded_entries(self):
+        # Given
+        self._add_handler(window=60, max_entries=2)
+
+        # When
+        for event in ('a', 'b', 'a', 'c'):
+            self.logger.warning(event)
+
+        # Then
+        self.assertEqual(
+            [(message['short_message'], message.get('_count'))
+             for message in self.target.messages()],
+            [('a', None), ('b', None), ('c', None), ('a', 1)])
+
+    def test_close_flushes(self):
+        # Given
+        handler = self._add_handler(window=60)
+        self.logger.warning('retry')
+        self.logger.warning('retry')
+
+        # When
+        handler.close()
+
+        # Then
+        self.assertEqual(
+            [message.get('_count') for message in self.target.messages()],
+            [None, 1])
+        self.assertTrue(self.target.closed)
+
+    def test_bytes_payload(self):
+        # Given
+        handler = self._add_handler(window=60)
+        self.logger = wrap_logger(self.std_logger, processors=[
+            GELFEncoder(fqdn=False, localname='host', as_bytes=True)])
+
+        # When
+        self.logger.warning('retry')
+        self.logger.warning('retry')
+        handler.flush()
+
+        # Then
+        first, collapsed = self.target.records
+        self.assertIsInstance(first.msg, bytes)
+        self.assertIsInstance(collapsed.msg, bytes)
+        self.assertEqual(
+            json.loads(collapsed.msg.decode('utf-8'))['_count'], 1)
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+from __future__ import absolute_import
+
+import sys
+
+# graystruct.aio and its tests use syntax and asyncio APIs from Python
+# 3.7; they are only imported there so that the rest of the suite is
+# still discovered on older interpreters.
+if sys.version_info >= (3, 7):
+    from .async_cases import TestAsyncGELFHandler  # noqa
@@ -6,19 +6,64 @@
 # of the 3-clause BSD license.  See the LICENSE.txt file for details.
 from __future__ import absolute_import
 
+import datetime
+import decimal
+import enum
 import os
 import json
 import logging
 import unittest
+import uuid
 
 from mock import patch
+from structlog import ReturnLogger, wrap_logger
 
-from ..encoder import _get_gelf_compatible_key, GELFEncoder
+from ..encoder import (
+    _get_gelf_compatible_key, available_serializers, CachedContext,
+    GELFEncoder, KEY_CACHE_SIZE, Lazy, STANDARD_GELF_KEYS)
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+
+def _reject_duplicates(pairs):
+    keys = [key for key, _ in pairs]
+    if len(keys) != len(set(keys)):
+        raise ValueError('duplicate keys: {}'.format(keys))
+    return dict(pairs)
+
+
+class NamedReturnLogger(ReturnLogger):
+    name = __name__
+
+
+def loads(payload):
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8')
+    return json.loads(payload, object_pairs_hook=_reject_duplicates)
+
+
+class PayloadGELFEncoder(GELFEncoder):
+    """Return the payload as it is passed on to the logging call."""
+
+    def __call__(self, logger, method_name, event_dict):
+        result = super(PayloadGELFEncoder, self).__call__(
+            logger, method_name, event_dict)
+        if isinstance(result, tuple):
+            (result,), _ = result
+        return result
 
 
 class TestBasic(unittest.TestCase):
     maxDiff = None
 
+    serializer = 'json'
+
+    def _make_encoder(self, **kwargs):
+        return PayloadGELFEncoder(serializer=self.serializer, **kwargs)
+
     def test_get_gelf_compatible_key(self):
         # Given
         key = 'version'
@@ -50,7 +95,7 @@ class TestBasic(unittest.TestCase):
         answer = 42
         swallow = 'european'
 
-        encoder = GELFEncoder(fqdn=False, localname=host)
+        encoder = self._make_encoder(fqdn=False, localname=host)
         event_dict = {
             'line': line,
             'file': __file__,
@@ -97,7 +142,7 @@ class TestBasic(unittest.TestCase):
         log_method_name = 'warning'
         event = 'event'
 
-        encoder = GELFEncoder()
+        encoder = self._make_encoder()
         event_dict = {
             'event': event,
         }
@@ -132,7 +177,7 @@ class TestBasic(unittest.TestCase):
         log_method_name = 'warning'
         event = 'event'
 
-        encoder = GELFEncoder(fqdn=False)
+        encoder = self._make_encoder(fqdn=False)
         event_dict = {
             'event': event,
         }
@@ -165,7 +210,7 @@ class TestBasic(unittest.TestCase):
         event = 'answered a question'
         exception = 'Traceback\nValueError'
 
-        encoder = GELFEncoder(fqdn=False, localname=host)
+        encoder = self._make_encoder(fqdn=False, localname=host)
         event_dict = {
             'event': event,
             'exception': exception,
@@ -191,3 +236,464 @@ class TestBasic(unittest.TestCase):
         self.assertEqual(initial_event_dict, event_dict)
         new_event_dict = json.loads(event_json)
         self.assertEqual(new_event_dict, expected)
+
+    def test_gelf_keys_honoured(self):
+        # Given
+        logger = logging.getLogger(__name__)
+        encoder = self._make_encoder(
+            fqdn=False, localname='host',
+            gelf_keys=STANDARD_GELF_KEYS + ('facility',))
+
+        # When
+        event_json = encoder(
+            logger, 'warning', {'event': 'event', 'facility': 'app'})
+
+        # Then
+        event_dict = json.loads(event_json)
+        self.assertEqual(event_dict['facility'], 'app')
+        self.assertNotIn('_facility', event_dict)
+
+    def test_key_cache_is_bounded(self):
+        # Given
+        logger = logging.getLogger(__name__)
+        encoder = self._make_encoder(fqdn=False, localname='host')
+        event_dict = {
+            'key{}'.format(index): index
+            for index in range(KEY_CACHE_SIZE + 10)
+        }
+
+        # When
+        event_json = encoder(logger, 'warning', event_dict)
+
+        # Then
+        self.assertLessEqual(len(encoder._key_cache), KEY_CACHE_SIZE)
+        new_event_dict = json.loads(event_json)
+        self.assertEqual(new_event_dict['_key1'], 1)
+        self.assertEqual(
+            new_event_dict['_key{}'.format(KEY_CACHE_SIZE + 9)],
+            KEY_CACHE_SIZE + 9)
+
+    @unittest.skipUnless(
+        hasattr(os, 'register_at_fork'), 'requires os.register_at_fork')
+    def test_pid_refreshed_after_fork(self):
+        # Given
+        logger = logging.getLogger(__name__)
+        encoder = self._make_encoder(fqdn=False, localname='host')
+        encoder(logger, 'warning', {'event': 'parent'})
+        read_fd, write_fd = os.pipe()
+
+        # When
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            try:
+                os.close(read_fd)
+                event_json = encoder(logger, 'warning', {'event': 'child'})
+                if not isinstance(event_json, bytes):
+                    event_json = event_json.encode('utf-8')
+                os.write(write_fd, event_json)
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as fh:
+            child_event = json.loads(fh.read().decode('utf-8'))
+        os.waitpid(pid, 0)
+
+        # Then
+        self.assertEqual(child_event['_pid'], pid)
+
+    def test_non_serializable_falls_back_to_repr(self):
+        # Given
+        class Opaque(object):
+            def __repr__(self):
+                return '<opaque>'
+
+        logger = logging.getLogger(__name__)
+        encoder = self._make_encoder(fqdn=False, localname='host')
+
+        # When
+        event_json = encoder(
+            logger, 'warning', {'event': 'event', 'value': Opaque()})
+
+        # Then
+        self.assertEqual(json.loads(event_json)['_value'], '<opaque>')
+
+    def test_non_ascii_values(self):
+        # Given
+        logger = logging.getLogger(__name__)
+        encoder = self._make_encoder(fqdn=False, localname='host')
+
+        # When
+        event_json = encoder(
+            logger, 'warning', {'event': u'caf\xe9', 'user': u'J\xfcrgen'})
+
+        # Then
+        event_dict = json.loads(event_json)
+        self.assertEqual(event_dict['short_message'], u'caf\xe9')
+        self.assertEqual(event_dict['_user'], u'J\xfcrgen')
+
+    def test_non_utf8_bytes(self):
+        # Given
+        logger = logging.getLogger(__name__)
+        encoder = self._make_encoder(fqdn=False, localname='host')
+
+        # When
+        event_json = encoder(
+            logger, 'warning', {'event': 'event', 'body': b'\xffcaf\xc3\xa9'})
+
+        # Then
+        self.assertEqual(json.loads(event_json)['_body'], u'\ufffdcaf\xe9')
+
+    def test_non_str_keys(self):
+        # Given
+        logger = logging.getLogger(__name__)
+        encoder = self._make_encoder(fqdn=False, localname='host')
+
+        # When
+        event_json = encoder(logger, 'warning', {
+            'event': 'event',
+            'data': {2: 2, 1.5: 3, False: 4, None: 5, 'nested': {7: 'b'}},
+        })
+
+        # Then
+        self.assertEqual(
+            json.loads(event_json)['_data'],
+            {'2': 2, '1.5': 3, 'false': 4, 'null': 5, 'nested': {'7': 'b'}})
+
+    def test_large_integers(self):
+        # Given
+        logger = logging.getLogger(__name__)
+        encoder = self._make_encoder(fqdn=False, localname='host')
+
+        # When
+        event_json = encoder(
+            logger, 'warning', {'event': 'event', 'big': 2 ** 70})
+
+        # Then
+        self.assertEqual(json.loads(event_json)['_big'], 2 ** 70)
+
+    def test_builtin_subclasses(self):
+        # Given
+        class Name(text_type):
+            pass
+
+        class Count(int):
+            pass
+
+        logger = logging.getLogger(__name__)
+        encoder = self._make_encoder(fqdn=False, localname='host')
+
+        # When
+        event_json = encoder(logger, 'warning', {
+            'event': 'event', 'name': Name('abc'), 'count': Count(3)})
+
+        # Then
+        event_dict = json.loads(event_json)
+        self.assertEqual(event_dict['_name'], 'abc')
+        self.assertEqual(event_dict['_count'], 3)
+
+    def test_fast_path_types(self):
+        # Given
+        class Color(enum.Enum):
+            red = 'red'
+
+        logger = logging.getLogger(__name__)
+        encoder = self._make_encoder(fqdn=False, localname='host')
+        identifier = uuid.UUID('12345678123456781234567812345678')
+
+        # When
+        event_json = encoder(logger, 'warning', {
+            'event': 'event',
+            'body': b'caf\xc3\xa9',
+            'at': datetime.datetime(2016, 1, 2, 3, 4, 5),
+            'day': datetime.date(2016, 1, 2),
+            'id': identifier,
+            'amount': decimal.Decimal('1.10'),
+            'color': Color.red,
+        })
+
+        # Then
+        event_dict = json.loads(event_json)
+        self.assertEqual(event_dict['_body'], u'caf\xe9')
+        self.assertEqual(event_dict['_at'], '2016-01-02T03:04:05')
+        self.assertEqual(event_dict['_day'], '2016-01-02')
+        self.assertEqual(event_dict['_id'], str(identifier))
+        # ujson encodes decimals as numbers
+        self.assertEqual(
+            decimal.Decimal(str(event_dict['_amount'])),
+            decimal.Decimal('1.1'))
+        self.assertEqual(event_dict['_color'], 'red')
+
+    def test_max_field_length(self):
+        # Given
+        class Opaque(object):
+            def __repr__(self):
+                return 'o' * 50
+
+        logger = logging.getLogger(__name__)
+        encoder = self._make_encoder(
+            fqdn=False, localname='host', max_field_length=10)
+
+        # When
+        event_json = encoder(logger, 'warning', {
+            'event': 'event', 'body': 'x' * 25, 'nested': {'body': 'y' * 11},
+            'value': Opaque(), 'short': 'short'})
+
+        # Then
+        event_dict = json.loads(event_json)
+        self.assertEqual(event_dict['_body'], 'x' * 10 + '...[15 more chars]')
+        self.assertEqual(
+            event_dict['_nested'], {'body': 'y' * 10 + '...[1 more chars]'})
+        self.assertEqual(event_dict['_value'], 'o' * 10 + '...[40 more chars]')
+        self.assertEqual(event_dict['_short'], 'short')
+        self.assertTrue(event_dict['_truncated'])
+
+    def test_max_depth_and_items(self):
+        # Given
+        logger = logging.getLogger(__name__)
+        encoder = self._make_encoder(
+            fqdn=False, localname='host', max_depth=2, max_items=3)
+
+        # When
+        event_json = encoder(logger, 'warning', {
+            'event': 'event',
+            'items': list(range(10)),
+            'tree': {'a': {'b': {'c': 1}}},
+            'wide': dict((str(i), i) for i in range(5)),
+        })
+
+        # Then
+        event_dict = json.loads(event_json)
+        self.assertEqual(event_dict['_items'], [0, 1, 2, '...[7 more items]'])
+        self.assertEqual(event_dict['_tree'], {'a': {'b': '...[nested dict]'}})
+        self.assertEqual(len(event_dict['_wide']), 4)
+        self.assertEqual(event_dict['_wide']['...'], '[2 more items]')
+        self.assertTrue(event_dict['_truncated'])
+
+    def test_limits_leave_small_records_untouched(self):
+        # Given
+        logger = logging.getLogger(__name__)
+        encoder = self._make_encoder(
+            fqdn=False, localname='host', max_field_length=100, max_depth=2,
+            max_items=3, max_message_size=1000)
+        value = {'a': [1, 2]}
+
+        # When
+        event_json = encoder(
+            logger, 'warning', {'event': 'event', 'value': value})
+
+        # Then
+        event_dict = json.loads(event_json)
+        self.assertEqual(event_dict['_value'], value)
+        self.assertNotIn('_truncated', event_dict)
+
+    def test_max_message_size(self):
+        # Given
+        logger = logging.getLogger(__name__)
+        encoder = self._make_encoder(
+            fqdn=False, localname='host', max_message_size=400)
+
+        # When
+        event_json = encoder(logger, 'warning', {
+            'event': 'event', 'exception': 'e' * 300, 'request': 'r' * 500,
+            'user': 'sjagoe'})
+
+        # Then
+        self.assertLessEqual(len(event_json), 400)
+        event_dict = json.loads(event_json)
+        self.assertNotIn('full_message', event_dict)
+        self.assertNotIn('_request', event_dict)
+        self.assertEqual(event_dict['_user'], 'sjagoe')
+        self.assertEqual(event_dict['_truncated_fields'], '_request')
+        self.assertTrue(event_dict['_truncated'])
+
+    def test_max_message_size_short_message(self):
+        # Given
+        logger = logging.getLogger(__name__)
+        encoder = self._make_encoder(
+            fqdn=False, localname='host', max_message_size=300)
+
+        # When
+        event_json = encoder(logger, 'warning', {'event': 'm' * 1000})
+
+        # Then
+        self.assertLessEqual(len(event_json), 300)
+        self.assertTrue(
+            json.loads(event_json)['short_message'].endswith('more chars]'))
+
+
+    def test_static_fields(self):
+        # Given
+        logger = logging.getLogger(__name__)
+        encoder = self._make_encoder(
+            fqdn=False, localname='host',
+            static_fields={'service': 'api', 'environment': 'prod'})
+
+        # When
+        first = loads(encoder(logger, 'warning', {'event': 'one', 'a': 1}))
+        second = loads(encoder(logger, 'error', {'event': 'two'}))
+
+        # Then
+        self.assertEqual(first['_service'], 'api')
+        self.assertEqual(first['_environment'], 'prod')
+        self.assertEqual(first['_a'], 1)
+        self.assertEqual(first['version'], '1.1')
+        self.assertEqual(first['host'], 'host')
+        self.assertEqual(second['short_message'], 'two')
+        self.assertEqual(second['_service'], 'api')
+        self.assertEqual(second['level'], 3)
+
+    def test_event_overrides_static_field(self):
+        # Given
+        logger = logging.getLogger(__name__)
+        encoder = self._make_encoder(
+            fqdn=False, localname='host', static_fields={'service': 'api'})
+
+        # When
+        event_dict = loads(encoder(
+            logger, 'warning',
+            {'event': 'event', 'service': 'worker', 'host': 'other'}))
+
+        # Then
+        self.assertEqual(event_dict['_service'], 'worker')
+        self.assertEqual(event_dict['host'], 'other')
+
+    def _bound_logger(self, encoder, processors=()):
+        return wrap_logger(
+            NamedReturnLogger(), processors=list(processors) + [encoder],
+            context_class=CachedContext)
+
+    def _log(self, logger, *args, **kwargs):
+        payload = logger.warning(*args, **kwargs)
+        if isinstance(payload, tuple):
+            (payload,), _ = payload
+        return loads(payload)
+
+    def test_cached_context(self):
+        # Given
+        encoder = GELFEncoder(
+            fqdn=False, localname='host', serializer=self.serializer)
+        logger = self._bound_logger(encoder).bind(
+            request_id='abc', user='sjagoe', tags=['a'])
+
+        # When
+        first = self._log(logger, 'one', attempt=1)
+        second = self._log(logger, 'two', user='other')
+        third = self._log(logger.unbind('user'), 'three')
+
+        # Then
+        self.assertEqual(first['_request_id'], 'abc')
+        self.assertEqual(first['_user'], 'sjagoe')
+        self.assertEqual(first['_tags'], ['a'])
+        self.assertEqual(first['_attempt'], 1)
+        self.assertEqual(second['_user'], 'other')
+        self.assertEqual(second['_request_id'], 'abc')
+        self.assertNotIn('_user', third)
+        self.assertEqual(third['_request_id'], 'abc')
+        self.assertEqual(len(logger._context._fragments), 1)
+
+    def test_cached_context_processor_removes_field(self):
+        # Given
+        def drop_user(logger, method_name, event_dict):
+            del event_dict['user']
+            return event_dict
+
+        encoder = GELFEncoder(
+            fqdn=False, localname='host', serializer=self.serializer)
+        logger = self._bound_logger(encoder, [drop_user]).bind(
+            request_id='abc', user='sjagoe')
+
+        # When
+        event_dict = self._log(logger, 'event')
+
+        # Then
+        self.assertNotIn('_user', event_dict)
+        self.assertEqual(event_dict['_request_id'], 'abc')
+
+    def test_lazy_values(self):
+        # Given
+        calls = []
+
+        def compute(value, suffix=''):
+            calls.append(value)
+            return value + suffix
+
+        encoder = GELFEncoder(
+            fqdn=False, localname='host', serializer=self.serializer)
+        logger = self._bound_logger(encoder).bind(
+            state=Lazy(compute, 'bound'))
+
+        # When
+        first = self._log(logger, 'one', dump=Lazy(compute, 'x', suffix='!'))
+        second = self._log(logger, 'two')
+
+        # Then
+        self.assertEqual(first['_dump'], 'x!')
+        self.assertEqual(first['_state'], 'bound')
+        self.assertEqual(second['_state'], 'bound')
+        self.assertEqual(calls, ['bound', 'x', 'bound'])
+
+
+@unittest.skipUnless('orjson' in available_serializers(), 'requires orjson')
+class TestBasicOrjson(TestBasic):
+    serializer = 'orjson'
+
+
+@unittest.skipUnless('ujson' in available_serializers(), 'requires ujson')
+class TestBasicUjson(TestBasic):
+    serializer = 'ujson'
+
+
+@unittest.skipUnless(
+    'rapidjson' in available_serializers(), 'requires rapidjson')
+class TestBasicRapidjson(TestBasic):
+    serializer = 'rapidjson'
+
+
+class TestSerializerSelection(unittest.TestCase):
+
+    def test_auto_picks_first_available(self):
+        # Given
+        logger = logging.getLogger(__name__)
+        encoder = PayloadGELFEncoder(
+            fqdn=False, localname='host', serializer='auto')
+
+        # When
+        event_json = encoder(logger, 'warning', {'event': 'event'})
+
+        # Then
+        self.assertEqual(json.loads(event_json)['short_message'], 'event')
+        self.assertEqual(available_serializers()[-1], 'json')
+
+    def test_callable_serializer(self):
+        # Given
+        logger = logging.getLogger(__name__)
+        encoder = GELFEncoder(
+            fqdn=False, localname='host', serializer=json.dumps,
+            sort_keys=True)
+
+        # When
+        event_json = encoder(logger, 'warning', {'event': 'event'})
+
+        # Then
+        self.assertEqual(event_json, json.dumps(
+            json.loads(event_json), sort_keys=True))
+
+    def test_as_bytes(self):
+        # Given
+        logger = logging.getLogger(__name__)
+        encoder = GELFEncoder(fqdn=False, localname='host', as_bytes=True)
+
+        # When
+        args, kwargs = encoder(logger, 'warning', {'event': u'caf\xe9'})
+
+        # Then
+        self.assertEqual(kwargs, {})
+        event_json, = args
+        self.assertIsInstance(event_json, bytes)
+        self.assertEqual(
+            json.loads(event_json.decode('utf-8'))['short_message'],
+            u'caf\xe9')
+
+    def test_unknown_serializer(self):
+        with self.assertRaises(ValueError):
+            GELFEncoder(fqdn=False, localname='host', serializer='yaml')
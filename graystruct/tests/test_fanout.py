@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+from __future__ import absolute_import
+
+import json
+import logging
+import unittest
+import zlib
+
+from structlog import wrap_logger
+
+from ..encoder import GELFEncoder
+from ..fanout import FanoutGELFHandler
+from ..handler import GELFTCPHandler, GELFUDPHandler, GZIP
+from .fakes import FakeTransport
+from .test_handler import TCPCollector, UDPCollector
+
+
+class TestFanoutGELFHandler(unittest.TestCase):
+
+    def setUp(self):
+        FakeTransport.compressed = 0
+        self.std_logger = logging.Logger(__name__, logging.DEBUG)
+        self.logger = wrap_logger(self.std_logger, processors=[
+            GELFEncoder(fqdn=False, localname='host')])
+
+    def _add_handler(self, targets, **kwargs):
+        handler = FanoutGELFHandler(targets, **kwargs)
+        self.std_logger.addHandler(handler)
+        self.addCleanup(handler.close)
+        return handler
+
+    def test_compressed_once_per_setting(self):
+        # Given
+        targets = [FakeTransport() for _ in range(3)]
+        targets[2].set_compression(codec=GZIP)
+        handler = self._add_handler(targets)
+
+        # When
+        self.logger.warning('one')
+        self.logger.warning('two')
+        handler.flush()
+
+        # Then
+        self.assertEqual(FakeTransport.compressed, 4)
+        for target in targets:
+            self.assertEqual(
+                [message['short_message'] for message in target.messages()],
+                ['one', 'two'])
+        self.assertEqual(handler.sent, 6)
+
+    def test_target_levels(self):
+        # Given
+        everything = FakeTransport()
+        errors = FakeTransport(logging.ERROR)
+        handler = self._add_handler([everything, errors])
+
+        # When
+        self.logger.info('info')
+        self.logger.error('error')
+        handler.flush()
+
+        # Then
+        self.assertEqual(len(everything.payloads), 2)
+        self.assertEqual(
+            [message['short_message'] for message in errors.messages()],
+            ['error'])
+        self.assertEqual(FakeTransport.compressed, 2)
+
+    def test_slow_destination_does_not_stall_others(self):
+        # Given
+        slow = FakeTransport(blocked=True)
+        fast = FakeTransport()
+        handler = self._add_handler([slow, fast])
+        self.addCleanup(slow.unblocked.set)
+
+        # When
+        for index in range(20):
+            self.logger.warning('event', index=index)
+        handler.queues[1].flush()
+
+        # Then
+        self.assertEqual(
+            [message['_index'] for message in fast.messages()],
+            list(range(20)))
+        self.assertEqual(slow.payloads, [])
+        self.assertGreaterEqual(handler.queues[0].queue.qsize(), 19)
+
+    def test_network_transports(self):
+        # Given
+        tcp = TCPCollector()
+        self.addCleanup(tcp.close)
+        udp = UDPCollector()
+        self.addCleanup(udp.close)
+        handler = self._add_handler([
+            GELFTCPHandler('127.0.0.1', tcp.port),
+            GELFUDPHandler('127.0.0.1', udp.port)])
+
+        # When
+        self.logger.warning('one')
+        self.logger.warning('two')
+        handler.flush()
+        frames = tcp.wait_for(2)
+
+        # Then
+        self.assertEqual(
+            [frame['short_message'] for frame in frames],
+            ['one', 'two'])
+        self.assertEqual(
+            [json.loads(zlib.decompress(udp.receive()).decode('utf-8'))[
+                'short_message'] for _ in range(2)],
+            ['one', 'two'])
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from structlog import wrap_logger
+
+from ..encoder import GELFEncoder
+from ..fanout import FanoutGELFHandler
+from ..file import GELFFileHandler, read_records, replay, rotated_files
+from ..queued import QueuedGELFHandler
+from ..spool import SpoolingGELFHandler
+from ..stats import instrument, unregister
+from .fakes import FakeTransport
+
+
+class TestGELFFileHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.filename = os.path.join(self.directory, 'app.gelf')
+        self.std_logger = logging.Logger(__name__, logging.DEBUG)
+        self.logger = wrap_logger(self.std_logger, processors=[
+            GELFEncoder(fqdn=False, localname='host')])
+
+    def _add_handler(self, **kwargs):
+        handler = GELFFileHandler(self.filename, **kwargs)
+        self.std_logger.addHandler(handler)
+        self.addCleanup(handler.close)
+        return handler
+
+    def _messages(self, paths):
+        return [json.loads(payload.decode('utf-8'))['_index']
+                for path in paths for payload in read_records(path)]
+
+    def test_buffered_lines(self):
+        # Given
+        handler = self._add_handler(flush_interval=None)
+
+        # When
+        for index in range(1000):
+            self.logger.warning('event', index=index)
+        handler.close()
+
+        # Then
+        self.assertEqual(self._messages([self.filename]), list(range(1000)))
+        self.assertLessEqual(handler.writes, 3)
+
+    def test_flush_interval(self):
+        # Given
+        self._add_handler(flush_interval=0.01)
+
+        # When
+        self.logger.warning('event', index=0)
+        deadline = time.time() + 5
+        while (os.path.getsize(self.filename) == 0 and
+               time.time() < deadline):
+            time.sleep(0.01)
+
+        # Then
+        self.assertEqual(self._messages([self.filename]), [0])
+
+    def test_size_rotation(self):
+        # Given
+        handler = self._add_handler(max_bytes=1000, buffer_size=300)
+
+        # When
+        for index in range(50):
+            self.logger.warning('event', index=index)
+        handler.close()
+
+        # Then
+        rotated = rotated_files(self.filename)
+        self.assertEqual(len(rotated), handler.rotations)
+        self.assertGreater(len(rotated), 1)
+        for path in rotated:
+            self.assertLessEqual(os.path.getsize(path), 1000 + 200)
+        self.assertEqual(
+            self._messages(rotated + [self.filename]), list(range(50)))
+
+    def test_time_rotation(self):
+        # Given
+        handler = self._add_handler(rotate_interval=0.05)
+
+        # When
+        self.logger.warning('event', index=0)
+        time.sleep(0.1)
+        self.logger.warning('event', index=1)
+        self.logger.warning('event', index=2)
+        handler.close()
+
+        # Then
+        self.assertEqual(handler.rotations, 1)
+        rotated, = rotated_files(self.filename)
+        self.assertEqual(self._messages([rotated]), [0, 1])
+        self.assertEqual(self._messages([self.filename]), [2])
+
+    def test_compression_and_backup_count(self):
+        # Given
+        handler = self._add_handler(
+            max_bytes=500, compress=True, backup_count=2)
+
+        # When
+        for index in range(50):
+            self.logger.warning('event', index=index)
+        handler.close()
+
+        # Then
+        rotated = rotated_files(self.filename)
+        self.assertEqual(len(rotated), 2)
+        self.assertTrue(all(path.endswith('.gz') for path in rotated))
+        indices = self._messages(rotated + [self.filename])
+        self.assertEqual(indices, list(range(50 - len(indices), 50)))
+
+    def test_replay(self):
+        # Given
+        handler = self._add_handler(max_bytes=1000)
+        for index in range(30):
+            self.logger.warning('event', index=index)
+        handler.close()
+        target = FakeTransport()
+
+        # When
+        count = replay(rotated_files(self.filename) + [self.filename], target)
+
+        # Then
+        self.assertEqual(count, 30)
+        self.assertEqual(
+            [message['_index'] for message in target.messages()],
+            list(range(30)))
+
+    def _log_through(self, handler):
+        self.std_logger.addHandler(handler)
+        for index in range(10):
+            self.logger.warning('event', index=index)
+        handler.close()
+        return self._messages([self.filename])
+
+    def test_queued(self):
+        # Given
+        handler = QueuedGELFHandler(GELFFileHandler(self.filename))
+
+        # When
+        messages = self._log_through(handler)
+
+        # Then
+        self.assertEqual(messages, list(range(10)))
+        self.assertEqual(handler.sent, 10)
+
+    def test_fanout(self):
+        # Given
+        handler = FanoutGELFHandler([GELFFileHandler(self.filename)])
+
+        # When
+        messages = self._log_through(handler)
+
+        # Then
+        self.assertEqual(messages, list(range(10)))
+        self.assertEqual(handler.sent, 10)
+
+    def test_spooling(self):
+        # Given
+        handler = SpoolingGELFHandler(
+            GELFFileHandler(self.filename),
+            os.path.join(self.directory, 'spool'))
+
+        # When
+        messages = self._log_through(handler)
+
+        # Then
+        self.assertEqual(messages, list(range(10)))
+        self.assertEqual(handler.sent, 10)
+        self.assertEqual(handler.spooled, 0)
+
+    def test_instrumented(self):
+        # Given
+        handler = GELFFileHandler(self.filename)
+        stats = instrument(handler, 'file')
+        self.addCleanup(unregister, stats)
+
+        # When
+        self.std_logger.addHandler(handler)
+        self.logger.warning('event', index=0)
+        handler.flush()
+        handler.close()
+
+        # Then
+        self.assertEqual(self._messages([self.filename]), [0])
+        self.assertEqual(stats.records, 1)
+        self.assertEqual(stats.sends, 1)
+        self.assertEqual(stats.errors, 0)
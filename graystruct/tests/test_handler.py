@@ -6,18 +6,31 @@
 # of the 3-clause BSD license.  See the LICENSE.txt file for details.
 from __future__ import absolute_import
 
+import binascii
 import json
 import logging
 import os
+import socket
+import threading
+import time
 import unittest
 import zlib
 
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
 from structlog import wrap_logger
 
-from mock import Mock
+from mock import Mock, patch
 
 from ..encoder import GELFEncoder
-from ..handler import GELFHandler
+from ..handler import (
+    GELF_CHUNK_MAGIC, GELFHandler, GELFTCPHandler, GELFUDPHandler, httplib)
+from ..queued import QueuedGELFHandler
 from ..rabbitmq import GELFRabbitHandler
 
 
@@ -100,3 +113,632 @@ class TestGELFHandler(unittest.TestCase):
         event_json = zlib.decompress(args[0])
         event_dict = json.loads(event_json.decode('utf-8'))
         self.assertEqual(event_dict, self.expected)
+
+    def test_bytes_payload_not_reencoded(self):
+        # Given
+        payload = b'{"short_message": "event"}'
+        record = logging.makeLogRecord({'msg': payload})
+        handler = TestingGELFHandler(Mock(), 'localhost')
+
+        # When
+        data = handler.makePickle(record)
+
+        # Then
+        self.assertEqual(zlib.decompress(data), payload)
+
+    def test_memoryview_payload(self):
+        # Given
+        payload = b'{"short_message": "event"}'
+        record = logging.makeLogRecord({'msg': memoryview(payload)})
+        handler = TestingGELFHandler(Mock(), 'localhost')
+
+        # When
+        data = handler.makePickle(record)
+
+        # Then
+        self.assertEqual(zlib.decompress(data), payload)
+
+    def test_bytes_pipeline(self):
+        # Given
+        std_logger = self.std_logger
+        logger = wrap_logger(std_logger, processors=[
+            GELFEncoder(fqdn=False, localname='host', as_bytes=True)])
+        collector = Mock()
+        std_logger.addHandler(TestingGELFHandler(collector, 'localhost'))
+
+        # When
+        logger.warning('event')
+
+        # Then
+        args, kwargs = collector.call_args
+        event_dict = json.loads(zlib.decompress(args[0]).decode('utf-8'))
+        self.assertEqual(event_dict, self.expected)
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.payload = json.dumps(
+            {'short_message': 'event', '_data': 'x' * 500}).encode('utf-8')
+        self.record = logging.makeLogRecord({'msg': self.payload})
+
+    def test_below_threshold_uncompressed(self):
+        # Given
+        handler = GELFHandler('localhost', compress_threshold=1000)
+
+        # When
+        data = handler.makePickle(self.record)
+
+        # Then
+        self.assertEqual(data, self.payload)
+
+    def test_above_threshold_compressed(self):
+        # Given
+        handler = GELFHandler('localhost', compress_threshold=100)
+
+        # When
+        data = handler.makePickle(self.record)
+
+        # Then
+        self.assertEqual(zlib.decompress(data), self.payload)
+
+    def test_gzip_codec(self):
+        # Given
+        handler = GELFHandler(
+            'localhost', compress_codec='gzip', compress_level=1)
+
+        # When
+        data = handler.makePickle(self.record)
+
+        # Then
+        self.assertEqual(data[:2], b'\x1f\x8b')
+        self.assertEqual(
+            zlib.decompress(data, 16 + zlib.MAX_WBITS), self.payload)
+
+    def test_low_memlevel(self):
+        # Given
+        handler = GELFHandler('localhost', compress_memlevel=1)
+
+        # When
+        data = handler.makePickle(self.record)
+
+        # Then
+        self.assertEqual(zlib.decompress(data), self.payload)
+
+    def test_invalid_codec(self):
+        with self.assertRaises(ValueError):
+            GELFHandler('localhost', compress_codec='lzma')
+
+    def test_rabbit_handler_compression(self):
+        # Given
+        handler = GELFRabbitHandler(
+            'amqp://localhost', compress_threshold=1000)
+
+        # When
+        data = handler.makePickle(self.record)
+
+        # Then
+        self.assertEqual(data, self.payload)
+
+    def test_content_encoding_header(self):
+        # Given
+        handler = GELFHandler('localhost', compress_threshold=1000)
+
+        # When
+        with patch.object(httplib, 'HTTPConnection') as connection:
+            response = connection.return_value.getresponse.return_value
+            response.status = 202
+            response.will_close = False
+            handler.send(self.payload)
+            handler.send(zlib.compress(self.payload))
+            handler.send(gzip_compress(self.payload))
+
+        # Then
+        encodings = [
+            call[0][3].get('Content-Encoding')
+            for call in connection.return_value.request.call_args_list
+        ]
+        self.assertEqual(encodings, [None, 'deflate', 'gzip'])
+
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class UDPCollector(object):
+    """A local GELF UDP input that reassembles chunked messages."""
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(5)
+        self.port = self.sock.getsockname()[1]
+        self.datagram_sizes = []
+
+    def receive(self):
+        chunks = {}
+        while True:
+            datagram = self.sock.recv(65535)
+            self.datagram_sizes.append(len(datagram))
+            if datagram[:2] != GELF_CHUNK_MAGIC:
+                return datagram
+            message_id = datagram[2:10]
+            sequence, count = bytearray(datagram[10:12])
+            parts = chunks.setdefault(message_id, {})
+            parts[sequence] = datagram[12:]
+            if len(parts) == count:
+                return b''.join(parts[index] for index in range(count))
+
+    def close(self):
+        self.sock.close()
+
+
+class TestGELFUDPHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = UDPCollector()
+        self.std_logger = logging.Logger(__name__, logging.DEBUG)
+        self.logger = wrap_logger(self.std_logger, processors=[
+            GELFEncoder(fqdn=False, localname='host')])
+
+    def tearDown(self):
+        self.collector.close()
+
+    def _add_handler(self, **kwargs):
+        handler = GELFUDPHandler(
+            '127.0.0.1', self.collector.port, **kwargs)
+        self.std_logger.addHandler(handler)
+        self.addCleanup(handler.close)
+        return handler
+
+    def _receive(self):
+        return json.loads(
+            zlib.decompress(self.collector.receive()).decode('utf-8'))
+
+    def test_small_message_single_datagram(self):
+        # Given
+        self._add_handler()
+
+        # When
+        self.logger.warning('event')
+
+        # Then
+        self.assertEqual(self._receive()['short_message'], 'event')
+        self.assertEqual(len(self.collector.datagram_sizes), 1)
+
+    def test_chunked_message(self):
+        # Given
+        self._add_handler(chunk_size=200)
+        data = binascii.hexlify(os.urandom(4000)).decode('ascii')
+
+        # When
+        self.logger.warning('event', data=data)
+
+        # Then
+        self.assertEqual(self._receive()['_data'], data)
+        self.assertGreater(len(self.collector.datagram_sizes), 1)
+        self.assertTrue(
+            all(size <= 200 for size in self.collector.datagram_sizes))
+
+    def test_chunked_message_without_sendmsg(self):
+        # Given
+        handler = self._add_handler(chunk_size=200)
+        handler._use_sendmsg = False
+        data = binascii.hexlify(os.urandom(4000)).decode('ascii')
+
+        # When
+        self.logger.warning('event', data=data)
+
+        # Then
+        self.assertEqual(self._receive()['_data'], data)
+
+    def test_oversized_message_dropped(self):
+        # Given
+        handler = self._add_handler(chunk_size=20)
+        data = binascii.hexlify(os.urandom(4000)).decode('ascii')
+
+        # When
+        self.logger.warning('big', data=data)
+        self.logger.warning('small')
+
+        # Then
+        self.assertEqual(handler.dropped, 1)
+        self.assertEqual(self._receive()['short_message'], 'small')
+
+    def test_oversized_message_truncated(self):
+        # Given
+        handler = self._add_handler(
+            chunk_size=100, oversize='truncate', truncate_length=100)
+        data = binascii.hexlify(os.urandom(40000)).decode('ascii')
+
+        # When
+        self.logger.warning('big', data=data, exception='Traceback')
+
+        # Then
+        event_dict = self._receive()
+        self.assertEqual(handler.dropped, 0)
+        self.assertEqual(event_dict['_data'], data[:100] + '...')
+        self.assertTrue(event_dict['_truncated'])
+        self.assertNotIn('full_message', event_dict)
+
+    def test_oversize_policy_applies_to_send(self):
+        # Given
+        handler = QueuedGELFHandler(GELFUDPHandler(
+            '127.0.0.1', self.collector.port, chunk_size=20))
+        self.std_logger.addHandler(handler)
+        self.addCleanup(handler.close)
+        data = binascii.hexlify(os.urandom(4000)).decode('ascii')
+
+        # When
+        self.logger.warning('big', data=data)
+        self.logger.warning('small')
+        handler.flush()
+
+        # Then
+        self.assertEqual(handler.target.dropped, 1)
+        self.assertEqual(self._receive()['short_message'], 'small')
+
+
+class GELFHTTPRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.bodies.append(body)
+        time.sleep(self.server.delay)
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', '0')
+        if self.server.drop_connections:
+            # Close without announcing it, like an idle timeout would
+            self.close_connection = True
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class GELFHTTPInput(ThreadingMixIn, HTTPServer):
+    """A local stand-in for a Graylog GELF HTTP input."""
+
+    daemon_threads = True
+
+    def __init__(self, drop_connections=False, delay=0, status=202):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), GELFHTTPRequestHandler)
+        self.drop_connections = drop_connections
+        self.delay = delay
+        self.status = status
+        self.connections = 0
+        self.bodies = []
+        self.port = self.server_address[1]
+        self.thread = threading.Thread(
+            target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class TestGELFHandlerHTTP(unittest.TestCase):
+
+    def _start(self, **kwargs):
+        server = GELFHTTPInput(**kwargs)
+        self.addCleanup(server.stop)
+        return server
+
+    def _messages(self, server):
+        return [
+            json.loads(zlib.decompress(body).decode('utf-8'))['short_message']
+            for body in server.bodies
+        ]
+
+    def _log(self, handler, count):
+        std_logger = logging.Logger(__name__, logging.DEBUG)
+        std_logger.addHandler(handler)
+        logger = wrap_logger(std_logger, processors=[
+            GELFEncoder(fqdn=False, localname='host')])
+        for index in range(count):
+            logger.warning('event-{}'.format(index))
+
+    def test_connection_reused(self):
+        # Given
+        server = self._start()
+        handler = GELFHandler('127.0.0.1', server.port)
+        self.addCleanup(handler.close)
+
+        # When
+        self._log(handler, 20)
+
+        # Then
+        self.assertEqual(
+            self._messages(server), ['event-{}'.format(i) for i in range(20)])
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(handler.pool.opened, 1)
+
+    def test_without_keep_alive(self):
+        # Given
+        server = self._start()
+        handler = GELFHandler('127.0.0.1', server.port, keep_alive=False)
+        self.addCleanup(handler.close)
+
+        # When
+        self._log(handler, 5)
+
+        # Then
+        self.assertEqual(len(server.bodies), 5)
+        self.assertEqual(server.connections, 5)
+
+    def test_reconnect_keeps_in_flight_record(self):
+        # Given
+        server = self._start(drop_connections=True)
+        handler = GELFHandler('127.0.0.1', server.port)
+        self.addCleanup(handler.close)
+
+        # When
+        self._log(handler, 5)
+
+        # Then
+        self.assertEqual(
+            self._messages(server), ['event-{}'.format(i) for i in range(5)])
+
+    def test_new_connection_not_retried(self):
+        # Given
+        server = self._start(delay=1)
+        handler = GELFHandler('127.0.0.1', server.port, timeout=0.2)
+        self.addCleanup(handler.close)
+
+        # When
+        with self.assertRaises(socket.error):
+            handler.send(zlib.compress(b'{"short_message": "slow"}'))
+
+        # Then
+        self.assertEqual(len(server.bodies), 1)
+        self.assertEqual(handler.pool.opened, 1)
+
+
+class TCPCollector(object):
+    """A local GELF TCP input collecting null-byte terminated frames."""
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.frames = []
+        self.connections = 0
+        self._condition = threading.Condition()
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self.sock.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            thread = threading.Thread(target=self._read, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def _read(self, connection):
+        buf = b''
+        try:
+            while True:
+                data = connection.recv(65536)
+                if not data:
+                    return
+                frames = (buf + data).split(b'\0')
+                buf = frames.pop()
+                with self._condition:
+                    self.frames.extend(frames)
+                    self._condition.notify_all()
+        finally:
+            connection.close()
+
+    def wait_for(self, count, timeout=5):
+        deadline = time.time() + timeout
+        with self._condition:
+            while len(self.frames) < count and time.time() < deadline:
+                self._condition.wait(deadline - time.time())
+        return [json.loads(frame.decode('utf-8')) for frame in self.frames]
+
+    def close(self):
+        self.sock.close()
+
+
+class FlakySocket(object):
+    """Accepts a few bytes per send and fails once after ``fail_after``."""
+
+    def __init__(self, received, fail_after=None, step=7):
+        self.received = received
+        self.fail_after = fail_after
+        self.step = step
+
+    def send(self, data):
+        if self.fail_after is not None and len(self.received) >= \
+                self.fail_after:
+            raise socket.error('connection reset')
+        chunk = bytes(data[:self.step])
+        self.received.extend(chunk)
+        return len(chunk)
+
+    def close(self):
+        pass
+
+
+class TestGELFTCPHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.std_logger = logging.Logger(__name__, logging.DEBUG)
+        self.logger = wrap_logger(self.std_logger, processors=[
+            GELFEncoder(fqdn=False, localname='host')])
+
+    def test_frames_delivered(self):
+        # Given
+        collector = TCPCollector()
+        self.addCleanup(collector.close)
+        handler = GELFTCPHandler('127.0.0.1', collector.port)
+        self.addCleanup(handler.close)
+        self.std_logger.addHandler(handler)
+
+        # When
+        for index in range(10):
+            self.logger.warning('event-{}'.format(index))
+
+        # Then
+        events = collector.wait_for(10)
+        self.assertEqual(
+            [event['short_message'] for event in events],
+            ['event-{}'.format(i) for i in range(10)])
+        self.assertEqual(collector.connections, 1)
+        self.assertEqual(handler.frames_sent, 10)
+
+    def test_send_frames_payloads(self):
+        # Given
+        collector = TCPCollector()
+        self.addCleanup(collector.close)
+        handler = GELFTCPHandler('127.0.0.1', collector.port)
+        self.addCleanup(handler.close)
+
+        # When
+        handler.send(b'{"short_message": "one"}')
+        handler.send(b'{"short_message": "two"}')
+
+        # Then
+        events = collector.wait_for(2)
+        self.assertEqual(
+            [event['short_message'] for event in events], ['one', 'two'])
+        self.assertEqual(handler.frames_sent, 2)
+
+    def test_concurrent_records_coalesced(self):
+        # Given
+        collector = TCPCollector()
+        self.addCleanup(collector.close)
+        handler = GELFTCPHandler('127.0.0.1', collector.port)
+        self.addCleanup(handler.close)
+        self.std_logger.addHandler(handler)
+        gate = threading.Event()
+        original_write = handler._write
+
+        def slow_write(frames):
+            gate.wait()
+            original_write(frames)
+        handler._write = slow_write
+
+        # When
+        writer = threading.Thread(target=self.logger.warning, args=('first',))
+        writer.start()
+        while not handler._writing:
+            time.sleep(0.001)
+        queued = [
+            threading.Thread(
+                target=self.logger.warning, args=('queued-{}'.format(i),))
+            for i in range(5)]
+        for thread in queued:
+            thread.start()
+        while handler._pending is None or len(handler._pending.frames) < 5:
+            time.sleep(0.001)
+        gate.set()
+        for thread in [writer] + queued:
+            thread.join()
+
+        # Then
+        events = collector.wait_for(6)
+        self.assertEqual(len(events), 6)
+        self.assertEqual(handler.writes, 2)
+
+    def test_queued_frames_see_write_error(self):
+        # Given
+        handler = GELFTCPHandler('127.0.0.1', 1)
+        self.addCleanup(handler.close)
+        gate = threading.Event()
+
+        def failing_write(frames):
+            gate.wait()
+            raise socket.error('GELF TCP input is unreachable')
+        handler._write = failing_write
+        errors = []
+
+        def send(payload):
+            try:
+                handler.send(payload)
+            except socket.error as error:
+                errors.append(error)
+
+        # When
+        writer = threading.Thread(target=send, args=(b'{"first": 1}',))
+        writer.start()
+        while not handler._writing:
+            time.sleep(0.001)
+        queued = threading.Thread(target=send, args=(b'{"queued": 1}',))
+        queued.start()
+        while handler._pending is None:
+            time.sleep(0.001)
+        gate.set()
+        writer.join()
+        queued.join()
+
+        # Then
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(handler.dropped, 2)
+        self.assertEqual(handler.frames_sent, 0)
+
+    def test_partial_writes(self):
+        # Given
+        received = bytearray()
+        handler = GELFTCPHandler('127.0.0.1', 1)
+        handler.makeSocket = lambda timeout=1: FlakySocket(received)
+        self.std_logger.addHandler(handler)
+
+        # When
+        self.logger.warning('first')
+        self.logger.warning('second')
+
+        # Then
+        frames = bytes(received).split(b'\0')
+        self.assertEqual(frames[-1], b'')
+        self.assertEqual(
+            [json.loads(frame.decode('utf-8'))['short_message']
+             for frame in frames[:-1]],
+            ['first', 'second'])
+
+    def test_reconnect_resumes_cut_frame(self):
+        # Given
+        first, second = bytearray(), bytearray()
+        sockets = [FlakySocket(first, fail_after=10), FlakySocket(second)]
+        handler = GELFTCPHandler('127.0.0.1', 1)
+        handler.makeSocket = lambda timeout=1: sockets.pop(0)
+        self.std_logger.addHandler(handler)
+
+        # When
+        self.logger.warning('event')
+
+        # Then
+        self.assertEqual(
+            json.loads(bytes(second).rstrip(b'\0').decode('utf-8'))[
+                'short_message'],
+            'event')
+        self.assertEqual(handler.dropped, 0)
+
+    def test_unreachable_input_drops_frames(self):
+        # Given
+        handler = GELFTCPHandler('127.0.0.1', 1)
+        handler.handleError = Mock()
+        self.std_logger.addHandler(handler)
+
+        # When
+        self.logger.warning('event')
+
+        # Then
+        self.assertEqual(handler.dropped, 1)
+        self.assertEqual(handler.handleError.call_count, 1)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+from __future__ import absolute_import
+
+import json
+import logging
+import threading
+import time
+import unittest
+import zlib
+
+from structlog import wrap_logger
+
+from ..encoder import GELFEncoder
+from ..handler import GELFHandler
+from ..queued import QueuedGELFHandler, DROP_OLDEST, BLOCK
+
+
+class BlockingGELFHandler(GELFHandler):
+
+    def __init__(self, *args, **kwargs):
+        super(BlockingGELFHandler, self).__init__(*args, **kwargs)
+        self.sent = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.closed = False
+
+    def send(self, s):
+        self.gate.wait()
+        self.sent.append(json.loads(zlib.decompress(s).decode('utf-8')))
+
+    def close(self):
+        self.closed = True
+        super(BlockingGELFHandler, self).close()
+
+
+class TestQueuedGELFHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.std_logger = std_logger = logging.Logger(__name__, logging.DEBUG)
+        self.logger = wrap_logger(
+            std_logger, processors=[GELFEncoder(fqdn=False, localname='host')])
+        self.target = BlockingGELFHandler('localhost')
+
+    def _messages(self):
+        return [event['short_message'] for event in self.target.sent]
+
+    def test_emit_ships_in_background(self):
+        # Given
+        handler = QueuedGELFHandler(self.target)
+        self.std_logger.addHandler(handler)
+
+        # When
+        for index in range(10):
+            self.logger.warning('event-{}'.format(index))
+        handler.flush()
+
+        # Then
+        self.assertEqual(
+            self._messages(), ['event-{}'.format(i) for i in range(10)])
+        self.assertEqual(handler.sent, 10)
+        self.assertEqual(handler.dropped, 0)
+        handler.close()
+        self.assertTrue(self.target.closed)
+
+    def test_drop_newest(self):
+        # Given
+        self.target.gate.clear()
+        handler = QueuedGELFHandler(self.target, maxsize=2)
+        self.std_logger.addHandler(handler)
+        self.logger.warning('first')
+        # Wait for the worker to pick up the first record
+        while handler.queue.qsize():
+            time.sleep(0.001)
+
+        # When
+        for name in ('second', 'third', 'fourth', 'fifth'):
+            self.logger.warning(name)
+        self.target.gate.set()
+        handler.close()
+
+        # Then
+        self.assertEqual(self._messages(), ['first', 'second', 'third'])
+        self.assertEqual(handler.sent, 3)
+        self.assertEqual(handler.dropped, 2)
+
+    def test_drop_oldest(self):
+        # Given
+        self.target.gate.clear()
+        handler = QueuedGELFHandler(
+            self.target, maxsize=2, overflow=DROP_OLDEST)
+        self.std_logger.addHandler(handler)
+        self.logger.warning('first')
+        while handler.queue.qsize():
+            time.sleep(0.001)
+
+        # When
+        for name in ('second', 'third', 'fourth', 'fifth'):
+            self.logger.warning(name)
+        self.target.gate.set()
+        handler.close()
+
+        # Then
+        self.assertEqual(self._messages(), ['first', 'fourth', 'fifth'])
+        self.assertEqual(handler.sent, 3)
+        self.assertEqual(handler.dropped, 2)
+
+    def test_block_with_timeout(self):
+        # Given
+        self.target.gate.clear()
+        handler = QueuedGELFHandler(
+            self.target, maxsize=1, overflow=BLOCK, timeout=0.01)
+        self.std_logger.addHandler(handler)
+        self.logger.warning('first')
+        while handler.queue.qsize():
+            time.sleep(0.001)
+
+        # When
+        self.logger.warning('second')
+        self.logger.warning('third')
+        self.target.gate.set()
+        handler.close()
+
+        # Then
+        self.assertEqual(self._messages(), ['first', 'second'])
+        self.assertEqual(handler.dropped, 1)
+
+    def test_emit_after_close_is_dropped(self):
+        # Given
+        handler = QueuedGELFHandler(self.target)
+        self.std_logger.addHandler(handler)
+        handler.close()
+
+        # When
+        self.logger.warning('event')
+
+        # Then
+        self.assertEqual(self.target.sent, [])
+        self.assertEqual(handler.dropped, 1)
+
+    def test_invalid_overflow_policy(self):
+        with self.assertRaises(ValueError):
+            QueuedGELFHandler(self.target, overflow='explode')
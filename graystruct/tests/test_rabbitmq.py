@@ -0,0 +1,502 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+from __future__ import absolute_import
+
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+import unittest
+from collections import defaultdict
+
+from mock import patch
+from structlog import wrap_logger
+
+from ..encoder import GELFEncoder
+from ..rabbitmq import GELFRabbitHandler, RabbitSocket, _pool
+
+
+class FakeChannel(object):
+
+    def __init__(self):
+        self.events = defaultdict(set)
+        self.published = []
+        self.confirming = False
+        self.waits = 0
+
+    def exchange_declare(self, **kwargs):
+        pass
+
+    def confirm_select(self):
+        self.confirming = True
+
+    def basic_publish(self, msg, exchange):
+        self.published.append(msg.body)
+
+    def wait(self, allowed_methods=None, timeout=None):
+        self.waits += 1
+        for callback in self.events['basic_ack']:
+            callback(len(self.published), True)
+
+
+class FakeConnection(object):
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.channel_ = FakeChannel()
+        self.closed = False
+
+    def channel(self):
+        return self.channel_
+
+    def close(self):
+        self.closed = True
+
+
+@patch('amqp.Connection', FakeConnection)
+class TestRabbitSocket(unittest.TestCase):
+
+    def tearDown(self):
+        _pool.clear()
+
+    def _make_socket(self, **kwargs):
+        return RabbitSocket(
+            {'host': 'localhost:5672'}, 1, 'logging.gelf', 'fanout',
+            **kwargs)
+
+    def test_unbatched(self):
+        # Given
+        sock = self._make_socket()
+
+        # When
+        sock.sendall(b'one')
+        sock.sendall(b'two')
+
+        # Then
+        self.assertEqual(sock.channel.published, [b'one', b'two'])
+
+    def test_batch_size(self):
+        # Given
+        sock = self._make_socket(batch_size=3)
+
+        # When
+        sock.sendall(b'one')
+        sock.sendall(b'two')
+
+        # Then
+        self.assertEqual(sock.channel.published, [])
+
+        # When
+        sock.sendall(b'three')
+
+        # Then
+        self.assertEqual(sock.channel.published, [b'one', b'two', b'three'])
+
+    def test_batch_bytes(self):
+        # Given
+        sock = self._make_socket(batch_size=100, batch_bytes=6)
+
+        # When
+        sock.sendall(b'one')
+
+        # Then
+        self.assertEqual(sock.channel.published, [])
+
+        # When
+        sock.sendall(b'two')
+
+        # Then
+        self.assertEqual(sock.channel.published, [b'one', b'two'])
+
+    def test_batch_interval(self):
+        # Given
+        sock = self._make_socket(batch_size=100, batch_interval=0.01)
+
+        # When
+        sock.sendall(b'one')
+        deadline = time.time() + 5
+        while not sock.channel.published and time.time() < deadline:
+            time.sleep(0.005)
+
+        # Then
+        self.assertEqual(sock.channel.published, [b'one'])
+
+    def test_close_flushes_pending(self):
+        # Given
+        sock = self._make_socket(batch_size=100)
+        sock.sendall(b'one')
+
+        # When
+        sock.close()
+
+        # Then
+        self.assertEqual(sock.channel.published, [b'one'])
+        self.assertTrue(sock.connection.closed)
+
+    def test_confirm_once_per_batch(self):
+        # Given
+        sock = self._make_socket(batch_size=10, confirm=True)
+        self.assertTrue(sock.channel.confirming)
+
+        # When
+        for index in range(30):
+            sock.sendall(b'record')
+
+        # Then
+        self.assertEqual(len(sock.channel.published), 30)
+        self.assertEqual(sock.channel.waits, 3)
+
+
+@patch('amqp.Connection', FakeConnection)
+class TestGELFRabbitHandlerBatching(unittest.TestCase):
+
+    def tearDown(self):
+        _pool.clear()
+
+    def test_batch_options_passed_to_socket(self):
+        # Given
+        handler = GELFRabbitHandler(
+            'amqp://localhost', batch_size=10, batch_bytes=1024,
+            batch_interval=0.5, confirm=True)
+
+        # When
+        sock = handler.makeSocket()
+
+        # Then
+        self.assertEqual(sock.batch_size, 10)
+        self.assertEqual(sock.batch_bytes, 1024)
+        self.assertEqual(sock.batch_interval, 0.5)
+        self.assertTrue(sock.confirm)
+
+    def test_flush_publishes_pending(self):
+        # Given
+        handler = GELFRabbitHandler('amqp://localhost', batch_size=10)
+        handler.sock = handler.makeSocket()
+        handler.sock.sendall(b'record')
+
+        # When
+        handler.flush()
+
+        # Then
+        self.assertEqual(handler.sock.channel.published, [b'record'])
+        handler.close()
+
+
+class FlakyConnection(FakeConnection):
+
+    available = True
+    attempts = 0
+
+    def __init__(self, **kwargs):
+        FlakyConnection.attempts += 1
+        if not FlakyConnection.available:
+            raise IOError('broker down')
+        super(FlakyConnection, self).__init__(**kwargs)
+
+
+class CountingChannel(FakeChannel):
+
+    def __init__(self):
+        super(CountingChannel, self).__init__()
+        self.declares = 0
+
+    def exchange_declare(self, **kwargs):
+        self.declares += 1
+
+
+@patch('amqp.Connection', FakeConnection)
+class TestConnectionPool(unittest.TestCase):
+
+    def tearDown(self):
+        _pool.clear()
+
+    def test_handlers_share_connection(self):
+        # Given
+        first = GELFRabbitHandler('amqp://localhost')
+        second = GELFRabbitHandler('amqp://localhost')
+        other = GELFRabbitHandler('amqp://otherhost')
+
+        # When
+        first_sock = first.makeSocket()
+        second_sock = second.makeSocket()
+        other_sock = other.makeSocket()
+
+        # Then
+        self.assertIs(first_sock.connection, second_sock.connection)
+        self.assertIsNot(first_sock.connection, other_sock.connection)
+
+        # When
+        first_sock.close()
+
+        # Then
+        self.assertFalse(second_sock.connection.closed)
+
+        # When
+        second_sock.close()
+
+        # Then
+        self.assertTrue(first_sock.connection.closed)
+
+    def test_exchange_declared_once_per_connection(self):
+        # Given
+        with patch.object(FakeConnection, 'channel') as channel:
+            channel.return_value = counting = CountingChannel()
+
+            # When
+            RabbitSocket({}, 1, 'logging.gelf', 'fanout')
+            RabbitSocket({}, 1, 'logging.gelf', 'fanout')
+            RabbitSocket({}, 1, 'other', 'fanout')
+
+        # Then
+        self.assertEqual(counting.declares, 2)
+
+    def test_broken_connection_is_replaced(self):
+        # Given
+        first = RabbitSocket({}, 1, 'logging.gelf', 'fanout')
+        second = RabbitSocket({}, 1, 'logging.gelf', 'fanout')
+
+        # When
+        first.discard()
+        third = RabbitSocket({}, 1, 'logging.gelf', 'fanout')
+
+        # Then
+        self.assertIsNot(third.connection, second.connection)
+
+
+@patch('amqp.Connection', FlakyConnection)
+class TestReconnect(unittest.TestCase):
+
+    def setUp(self):
+        FlakyConnection.available = True
+        FlakyConnection.attempts = 0
+
+    def tearDown(self):
+        _pool.clear()
+
+    def test_backoff_with_jitter(self):
+        # Given
+        FlakyConnection.available = False
+        handler = GELFRabbitHandler('amqp://localhost')
+
+        # When
+        with patch('time.time', return_value=1000.0):
+            handler.send(b'one')
+            first_delay = handler.retryTime - 1000.0
+            handler.send(b'two')
+
+        # Then
+        self.assertEqual(FlakyConnection.attempts, 1)
+        self.assertTrue(0.5 <= first_delay <= 1.0)
+
+        # When
+        with patch('time.time', return_value=1002.0):
+            handler.send(b'three')
+
+        # Then
+        self.assertEqual(FlakyConnection.attempts, 2)
+        self.assertTrue(1.0 <= handler.retryTime - 1002.0 <= 2.0)
+
+    def test_spill_replayed_after_reconnect(self):
+        # Given
+        handler = GELFRabbitHandler('amqp://localhost', spill_size=2)
+        FlakyConnection.available = False
+
+        # When
+        for data in (b'one', b'two', b'three'):
+            handler.send(data)
+
+        # Then
+        self.assertEqual(list(handler.spill), [b'two', b'three'])
+        self.assertEqual(handler.spill_dropped, 1)
+
+        # When
+        FlakyConnection.available = True
+        handler.retryTime = None
+        handler.send(b'four')
+
+        # Then
+        self.assertEqual(
+            handler.sock.channel.published, [b'two', b'three', b'four'])
+        self.assertEqual(len(handler.spill), 0)
+
+    def test_failed_batch_is_spilled(self):
+        # Given
+        handler = GELFRabbitHandler(
+            'amqp://localhost', batch_size=2, spill_size=10)
+        handler.send(b'one')
+        channel = handler.sock.channel
+
+        # When
+        with patch.object(channel, 'basic_publish', side_effect=IOError):
+            handler.send(b'two')
+
+        # Then
+        self.assertIsNone(handler.sock)
+        self.assertEqual(list(handler.spill), [b'one', b'two'])
+
+
+class FramingBroker(object):
+    """Accept connections and check that every frame arrives whole.
+
+    A frame is ``b'F'``, the body length, the body and ``b'\xce'``,
+    like an AMQP frame.
+
+    """
+
+    def __init__(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        self.port = self.listener.getsockname()[1]
+        self.lock = threading.Lock()
+        self.bodies = []
+        self.errors = []
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self._read, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _read_exact(self, conn, size):
+        data = b''
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                return data
+            data += chunk
+        return data
+
+    def _read(self, conn):
+        with conn:
+            while True:
+                start = self._read_exact(conn, 1)
+                if not start:
+                    return
+                header = self._read_exact(conn, 4)
+                if start != b'F' or len(header) != 4:
+                    return self._error('bad frame start')
+                length, = struct.unpack('>I', header)
+                body = self._read_exact(conn, length)
+                if len(body) != length or self._read_exact(conn, 1) != b'\xce':
+                    return self._error('bad frame end')
+                with self.lock:
+                    self.bodies.append(body)
+
+    def _error(self, message):
+        with self.lock:
+            self.errors.append(message)
+
+    def wait_for(self, count, timeout=10):
+        deadline = time.time() + timeout
+        while len(self.bodies) < count and time.time() < deadline:
+            time.sleep(0.01)
+        return len(self.bodies)
+
+    def close(self):
+        self.listener.close()
+
+
+class SocketTransport(object):
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.shutdown(socket.SHUT_RDWR)
+            self.sock.close()
+            self.sock = None
+
+    # Like amqp's transports, shut the socket down when collected
+    __del__ = close
+
+
+class SocketChannel(object):
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def exchange_declare(self, **kwargs):
+        pass
+
+    def basic_publish(self, msg, exchange):
+        # One write per part, so that concurrent writers interleave
+        parts = [b'F', struct.pack('>I', len(msg.body)), msg.body, b'\xce']
+        for part in parts:
+            self.transport.sock.sendall(part)
+            time.sleep(0.0005)
+
+
+class SocketConnection(object):
+
+    port = None
+
+    def __init__(self, **kwargs):
+        sock = socket.create_connection(('127.0.0.1', SocketConnection.port))
+        self.transport = SocketTransport(sock)
+
+    def channel(self):
+        return SocketChannel(self.transport)
+
+    def close(self):
+        self.transport.close()
+
+
+@unittest.skipUnless(
+    hasattr(os, 'register_at_fork'), 'needs os.register_at_fork')
+@patch('amqp.Connection', SocketConnection)
+class TestFork(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = FramingBroker()
+        self.addCleanup(self.broker.close)
+        SocketConnection.port = self.broker.port
+
+    def tearDown(self):
+        _pool.clear()
+
+    def test_children_do_not_share_connection(self):
+        # Given
+        std_logger = logging.Logger(__name__, logging.DEBUG)
+        handler = GELFRabbitHandler('amqp://localhost')
+        std_logger.addHandler(handler)
+        logger = wrap_logger(std_logger, processors=[
+            GELFEncoder(fqdn=False, localname='host')])
+        logger.warning('parent', index=0)
+
+        # When
+        children = []
+        for child in range(4):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    for index in range(50):
+                        logger.warning('child', child=child, index=index)
+                    handler.close()
+                    status = 0
+                finally:
+                    os._exit(status)
+            children.append(pid)
+        statuses = [os.waitpid(pid, 0)[1] for pid in children]
+        logger.warning('parent', index=1)
+        handler.close()
+
+        # Then
+        self.assertEqual(statuses, [0] * 4)
+        self.assertEqual(self.broker.wait_for(202), 202)
+        self.assertEqual(self.broker.errors, [])
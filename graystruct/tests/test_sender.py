@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+from __future__ import absolute_import
+
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from structlog import wrap_logger
+
+from ..encoder import GELFEncoder
+from ..fanout import FanoutGELFHandler
+from ..file import GELFFileHandler
+from ..sender import GELFForwardingHandler, GELFSender, start_sender_process
+from .fakes import FakeTransport
+
+
+def _file_handlers(path):
+    return [GELFFileHandler(path, buffer_size=0, flush_interval=None)]
+
+
+def _log_from_worker(path, worker, count):
+    std_logger = logging.Logger('worker', logging.DEBUG)
+    std_logger.addHandler(GELFForwardingHandler(path))
+    logger = wrap_logger(std_logger, processors=[
+        GELFEncoder(fqdn=False, localname='host')])
+    for index in range(count):
+        logger.warning('event', worker=worker, index=index)
+    for handler in std_logger.handlers:
+        handler.close()
+
+
+def _count_lines(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'rb') as fh:
+        return len(fh.readlines())
+
+
+def _wait_for(predicate, timeout=10):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'requires fork')
+class TestGELFSender(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.path = os.path.join(self.tempdir, 'sender.sock')
+        self.context = multiprocessing.get_context('fork')
+
+    def _start_sender(self, handler=None):
+        collector = FakeTransport()
+        sender = GELFSender(self.path, [handler or collector])
+        thread = threading.Thread(
+            target=sender.serve_forever, kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(sender.server_close)
+        self.addCleanup(sender.shutdown)
+        return sender, collector
+
+    def test_forwarded_payload_shipped(self):
+        # Given
+        sender, collector = self._start_sender()
+
+        # When
+        _log_from_worker(self.path, 0, 3)
+        _wait_for(lambda: len(collector.payloads) == 3)
+
+        # Then
+        events = [json.loads(p.decode('utf-8')) for p in collector.payloads]
+        self.assertEqual([event['_index'] for event in events], [0, 1, 2])
+        self.assertEqual(sender.received, 3)
+
+    def test_handler_levels_pass_forwarded_records(self):
+        # Given
+        collector = FakeTransport(logging.ERROR)
+        sender, _ = self._start_sender(FanoutGELFHandler([collector]))
+
+        # When
+        _log_from_worker(self.path, 0, 3)
+        _wait_for(lambda: len(collector.payloads) == 3)
+
+        # Then
+        self.assertEqual(
+            [event['_index'] for event in collector.messages()], [0, 1, 2])
+
+    def test_multiple_worker_processes(self):
+        # Given
+        sender, collector = self._start_sender()
+        workers, count = 4, 500
+
+        # When
+        start = time.time()
+        processes = [
+            self.context.Process(
+                target=_log_from_worker, args=(self.path, worker, count))
+            for worker in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        _wait_for(lambda: len(collector.payloads) == workers * count)
+        elapsed = time.time() - start
+
+        # Then
+        events = [json.loads(p.decode('utf-8')) for p in collector.payloads]
+        received = set((event['_worker'], event['_index']) for event in events)
+        self.assertEqual(len(events), workers * count)
+        self.assertEqual(
+            received,
+            set((w, i) for w in range(workers) for i in range(count)))
+        # Every worker's records arrive in order
+        for worker in range(workers):
+            indices = [e['_index'] for e in events if e['_worker'] == worker]
+            self.assertEqual(indices, list(range(count)))
+        self.assertLess(elapsed, 30)
+
+    def test_sender_process(self):
+        # Given
+        output = os.path.join(self.tempdir, 'shipped.jsonl')
+        process = start_sender_process(
+            self.path, functools.partial(_file_handlers, output))
+
+        # When
+        _log_from_worker(self.path, 0, 5)
+        _wait_for(lambda: _count_lines(output) == 5)
+        process.terminate()
+        process.join(10)
+
+        # Then
+        with open(output, 'rb') as fh:
+            events = [json.loads(line.decode('utf-8')) for line in fh]
+        self.assertEqual([event['_index'] for event in events], list(range(5)))
+        self.assertFalse(os.path.exists(self.path))
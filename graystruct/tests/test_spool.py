@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+from __future__ import absolute_import
+
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from ..spool import DiskSpool, SpoolingGELFHandler
+from .fakes import FakeTransport
+
+
+class TestDiskSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _open(self, **kwargs):
+        spool = DiskSpool(self.directory, **kwargs)
+        self.addCleanup(spool.close)
+        return spool
+
+    def test_read_and_commit(self):
+        # Given
+        spool = self._open(segment_size=64)
+        for index in range(10):
+            spool.append('payload {}'.format(index).encode('ascii'))
+
+        # When
+        first = spool.read(4)
+        spool.commit(first[-1][1])
+        rest = spool.read(100)
+
+        # Then
+        self.assertEqual(
+            [payload for payload, _ in first + rest],
+            ['payload {}'.format(index).encode('ascii')
+             for index in range(10)])
+        self.assertFalse(spool.empty())
+        spool.commit(rest[-1][1])
+        self.assertTrue(spool.empty())
+        self.assertEqual(spool.size, 0)
+        self.assertEqual(
+            sorted(os.listdir(self.directory)),
+            ['0000000000000002.seg', 'index'])
+
+    def test_survives_restart(self):
+        # Given
+        spool = DiskSpool(self.directory, segment_size=64)
+        for index in range(10):
+            spool.append(str(index).encode('ascii'))
+        spool.commit(spool.read(3)[-1][1])
+        spool.close()
+
+        # When
+        spool = self._open(segment_size=64)
+
+        # Then
+        self.assertEqual(
+            [payload for payload, _ in spool.read(100)],
+            [str(index).encode('ascii') for index in range(3, 10)])
+
+    def test_incomplete_frame_discarded(self):
+        # Given
+        spool = DiskSpool(self.directory)
+        spool.append(b'complete')
+        spool.close()
+        with open(os.path.join(
+                self.directory, '0000000000000000.seg'), 'ab') as fh:
+            fh.write(b'\x00\x00\x00\x10cut')
+
+        # When
+        spool = self._open()
+        spool.append(b'next')
+
+        # Then
+        self.assertEqual(
+            [payload for payload, _ in spool.read(100)],
+            [b'complete', b'next'])
+
+    def test_oldest_segments_evicted(self):
+        # Given
+        spool = self._open(segment_size=40, max_size=100)
+
+        # When
+        for index in range(20):
+            spool.append('{:06d}'.format(index).encode('ascii'))
+
+        # Then
+        payloads = [payload for payload, _ in spool.read(100)]
+        self.assertLessEqual(spool.size, 100)
+        self.assertEqual(spool.evicted + len(payloads), 20)
+        self.assertEqual(
+            payloads,
+            ['{:06d}'.format(index).encode('ascii')
+             for index in range(spool.evicted, 20)])
+
+
+class TestSpoolingGELFHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.target = FakeTransport()
+        self.logger = logging.Logger(__name__, logging.DEBUG)
+
+    def _add_handler(self, target=None, **kwargs):
+        kwargs.setdefault('retry_interval', 0.01)
+        handler = SpoolingGELFHandler(
+            target or self.target, self.directory, **kwargs)
+        self.logger.addHandler(handler)
+        self.addCleanup(handler.close)
+        return handler
+
+    def test_sends_directly_when_available(self):
+        # Given
+        handler = self._add_handler()
+
+        # When
+        self.logger.warning('one')
+        self.logger.warning('two')
+
+        # Then
+        self.assertEqual(self.target.payloads, [b'one', b'two'])
+        self.assertEqual(handler.sent, 2)
+        self.assertEqual(handler.spooled, 0)
+
+    def test_replays_in_order_after_outage(self):
+        # Given
+        handler = self._add_handler(batch_size=3)
+        self.logger.warning('before')
+        self.target.available = False
+
+        # When
+        for index in range(10):
+            self.logger.warning('outage {}'.format(index))
+        time.sleep(0.05)
+        self.target.available = True
+        self.logger.warning('after')
+        received = self.target.wait_for(12)
+
+        # Then
+        self.assertEqual(
+            [payload.decode('utf-8') for payload in received],
+            ['before'] + ['outage {}'.format(index) for index in range(10)] +
+            ['after'])
+        self.assertEqual(handler.spooled, 11)
+        self.assertEqual(handler.sent, 12)
+        self.assertTrue(handler.spool.empty())
+
+    def test_replays_after_restart(self):
+        # Given
+        self.target.available = False
+        handler = self._add_handler()
+        for index in range(5):
+            self.logger.warning('outage {}'.format(index))
+        handler.close()
+        self.logger.removeHandler(handler)
+
+        # When
+        target = FakeTransport()
+        self._add_handler(target)
+        received = target.wait_for(5)
+
+        # Then
+        self.assertEqual(self.target.payloads, [])
+        self.assertTrue(self.target.closed)
+        self.assertEqual(
+            [payload.decode('utf-8') for payload in received],
+            ['outage {}'.format(index) for index in range(5)])
+
+    def test_full_spool_drops_oldest(self):
+        # Given
+        self.target.available = False
+        handler = self._add_handler(segment_size=100, max_size=200)
+
+        # When
+        for index in range(100):
+            self.logger.warning('outage {:03d}'.format(index))
+        self.target.available = True
+        deadline = time.time() + 5
+        while not handler.spool.empty() and time.time() < deadline:
+            time.sleep(0.01)
+
+        # Then
+        self.assertGreater(handler.dropped, 0)
+        self.assertEqual(
+            [payload.decode('utf-8') for payload in self.target.payloads],
+            ['outage {:03d}'.format(index)
+             for index in range(handler.dropped, 100)])
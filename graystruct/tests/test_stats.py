@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Simon Jagoe and Enthought Ltd
+# All rights reserved.
+#
+# This software may be modified and distributed under the terms
+# of the 3-clause BSD license.  See the LICENSE.txt file for details.
+from __future__ import absolute_import
+
+import logging
+import socket
+import unittest
+import zlib
+
+from mock import Mock, patch
+from structlog import wrap_logger
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+from ..encoder import GELFEncoder
+from ..fanout import FanoutGELFHandler
+from ..handler import GELFTCPHandler, GELFUDPHandler
+from ..queued import QueuedGELFHandler
+from ..stats import (
+    REGISTRY, Histogram, StatsReporter, instrument, prometheus_text,
+    start_http_server, timed_processor)
+from .fakes import FakeTransport
+from .test_handler import TCPCollector, UDPCollector
+
+
+def _unused_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_observe(self):
+        # Given
+        histogram = Histogram(buckets=(0.1, 1.0))
+
+        # When
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(value)
+
+        # Then
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 3.65)
+
+
+class TestInstrument(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.dict(REGISTRY, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.std_logger = logging.Logger(__name__, logging.DEBUG)
+        self.logger = wrap_logger(self.std_logger, processors=[
+            GELFEncoder(fqdn=False, localname='host')])
+
+    def _add_handler(self, handler):
+        self.std_logger.addHandler(handler)
+        self.addCleanup(handler.close)
+        return handler
+
+    def test_not_instrumented_by_default(self):
+        # Given
+        handler = GELFUDPHandler('127.0.0.1', _unused_port())
+
+        # Then
+        self.assertNotIn('send', vars(handler))
+        self.assertNotIn('makePickle', vars(handler))
+
+    def test_udp_handler(self):
+        # Given
+        collector = UDPCollector()
+        self.addCleanup(collector.close)
+        handler = self._add_handler(
+            GELFUDPHandler('127.0.0.1', collector.port))
+        stats = instrument(handler, 'udp')
+
+        # When
+        self.logger.warning('event', data='x' * 1000)
+        payload = collector.receive()
+
+        # Then
+        self.assertIs(REGISTRY['udp'], stats)
+        self.assertIs(handler.stats, stats)
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['records'], 1)
+        self.assertEqual(snapshot['sends'], 1)
+        self.assertEqual(snapshot['bytes_out'], len(payload))
+        self.assertEqual(
+            snapshot['bytes_in'], len(zlib.decompress(payload)))
+        self.assertEqual(snapshot['compress']['count'], 1)
+        self.assertEqual(snapshot['send']['count'], 1)
+        self.assertEqual(snapshot['dropped'], 0)
+        self.assertEqual(snapshot['errors'], 0)
+
+    def test_reconnects_and_errors(self):
+        # Given
+        collector = TCPCollector()
+        self.addCleanup(collector.close)
+        handler = self._add_handler(
+            GELFTCPHandler('127.0.0.1', collector.port))
+        stats = instrument(handler)
+
+        # When
+        self.logger.warning('one')
+        self.logger.warning('two')
+        collector.wait_for(2)
+        handler.sock.close()
+        handler.sock = None
+        handler.address = ('127.0.0.1', _unused_port())
+        with patch.object(logging, 'raiseExceptions', False):
+            self.logger.warning('three')
+
+        # Then
+        self.assertEqual(stats.name, 'GELFTCPHandler')
+        self.assertEqual(stats.records, 3)
+        self.assertEqual(stats.reconnects, 1)
+        self.assertEqual(stats.errors, 1)
+        self.assertEqual(stats.snapshot()['dropped'], 1)
+
+    def test_queued_handler(self):
+        # Given
+        collector = UDPCollector()
+        self.addCleanup(collector.close)
+        handler = self._add_handler(QueuedGELFHandler(
+            GELFUDPHandler('127.0.0.1', collector.port)))
+        stats = instrument(handler, 'queued')
+
+        # When
+        self.logger.warning('event')
+        handler.flush()
+
+        # Then
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['records'], 1)
+        self.assertEqual(snapshot['sent'], 1)
+        self.assertEqual(snapshot['queue_depth'], 0)
+
+    def test_fanout_handler(self):
+        # Given
+        targets = [FakeTransport(), FakeTransport()]
+        handler = self._add_handler(FanoutGELFHandler(targets))
+        stats = instrument(handler, 'fanout')
+
+        # When
+        self.logger.warning('event')
+        handler.flush()
+
+        # Then
+        self.assertEqual(stats.snapshot()['sent'], 2)
+        for index, target in enumerate(targets):
+            snapshot = REGISTRY['fanout.{}'.format(index)].snapshot()
+            self.assertEqual(snapshot['records'], 1)
+            self.assertEqual(snapshot['sends'], 1)
+            self.assertEqual(
+                snapshot['bytes_in'], len(target.payloads[0]))
+
+    def test_unique_names(self):
+        # Given
+        first = GELFUDPHandler('127.0.0.1', _unused_port())
+        second = GELFUDPHandler('127.0.0.1', _unused_port())
+
+        # When
+        instrument(first, 'udp')
+        instrument(second, 'udp')
+
+        # Then
+        self.assertEqual(sorted(REGISTRY), ['udp', 'udp_2'])
+
+    def test_timed_processor(self):
+        # Given
+        encoder, stats = timed_processor(
+            GELFEncoder(fqdn=False, localname='host'))
+        logger = wrap_logger(self.std_logger, processors=[encoder])
+
+        # When
+        logger.warning('event')
+
+        # Then
+        self.assertEqual(stats.encode.count, 1)
+        self.assertIs(REGISTRY['encoder'], stats)
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.dict(REGISTRY, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        handler = GELFUDPHandler('127.0.0.1', _unused_port())
+        self.addCleanup(handler.close)
+        self.stats = instrument(handler, 'udp')
+        self.stats.records = 3
+        self.stats.send.observe(0.002)
+
+    def test_prometheus_text(self):
+        # When
+        text = prometheus_text()
+
+        # Then
+        lines = text.splitlines()
+        self.assertIn('graystruct_records_total{handler="udp"} 3', lines)
+        self.assertIn(
+            'graystruct_send_seconds_bucket{handler="udp",le="0.001"} 0',
+            lines)
+        self.assertIn(
+            'graystruct_send_seconds_bucket{handler="udp",le="0.0025"} 1',
+            lines)
+        self.assertIn(
+            'graystruct_send_seconds_bucket{handler="udp",le="+Inf"} 1',
+            lines)
+        self.assertIn('graystruct_send_seconds_count{handler="udp"} 1', lines)
+        self.assertIn('# TYPE graystruct_dropped gauge', lines)
+        self.assertIn('graystruct_dropped{handler="udp"} 0', lines)
+
+    def test_http_server(self):
+        # Given
+        server = start_http_server(0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        # When
+        response = urlopen(
+            'http://127.0.0.1:{}/metrics'.format(server.server_port))
+
+        # Then
+        self.assertEqual(response.read().decode('utf-8'), prometheus_text())
+
+    def test_reporter(self):
+        # Given
+        logger = Mock()
+        reporter = StatsReporter(logger, interval=3600)
+        self.addCleanup(reporter.stop)
+
+        # When
+        reporter.report()
+
+        # Then
+        args, kwargs = logger.info.call_args
+        self.assertEqual(args, ('graystruct.stats',))
+        self.assertEqual(kwargs['stats_name'], 'udp')
+        self.assertEqual(kwargs['records'], 3)
+        self.assertEqual(kwargs['send_count'], 1)
+        self.assertAlmostEqual(kwargs['send_seconds'], 0.002)
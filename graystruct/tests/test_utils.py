@@ -9,7 +9,14 @@ from __future__ import absolute_import
 import logging
 import unittest
 
-from ..utils import add_app_context
+from mock import Mock
+from structlog import DropEvent
+from structlog.processors import format_exc_info
+
+from ..rabbitmq import ExcludeFilter
+from ..utils import (
+    add_app_context, AppContextAdder, ExceptionFormatter, HandlerLevelFilter,
+    RateLimiter)
 
 
 class TestAddAppContext(unittest.TestCase):
@@ -27,6 +34,365 @@ class TestAddAppContext(unittest.TestCase):
             {
                 'file': __file__,
                 'function': 'test_add_app_context',
-                'line': 22,
+                'line': 29,
             },
         )
+
+
+class TestAppContextAdder(unittest.TestCase):
+
+    def _log_from_helper(self, processor, method_name='warning'):
+        return processor(logging.getLogger(__name__), method_name, {})
+
+    def test_additional_ignores(self):
+        # Given
+        processor = AppContextAdder(ignore=('logging', __name__))
+
+        # When
+        event_dict = self._log_from_helper(processor)
+
+        # Then
+        self.assertNotEqual(event_dict['file'], __file__)
+
+    def test_min_level(self):
+        # Given
+        processor = AppContextAdder(min_level=logging.WARNING)
+
+        # When
+        info = self._log_from_helper(processor, 'info')
+        error = self._log_from_helper(processor, 'error')
+
+        # Then
+        self.assertEqual(info, {})
+        self.assertEqual(error['function'], '_log_from_helper')
+
+    def test_sampling(self):
+        # Given
+        never = AppContextAdder(sample_rate=0.0)
+        always = AppContextAdder(sample_rate=1.0)
+
+        # When/Then
+        self.assertEqual(self._log_from_helper(never), {})
+        self.assertEqual(
+            self._log_from_helper(always)['function'], '_log_from_helper')
+
+    def test_cache_is_bounded(self):
+        # Given
+        processor = AppContextAdder(cache_size=2)
+
+        # When
+        event_dict = self._log_from_helper(processor)
+
+        # Then
+        self.assertLessEqual(len(processor._ignored), 2)
+        self.assertEqual(event_dict['function'], '_log_from_helper')
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.logger = logging.getLogger(__name__)
+        self.summary_logger = Mock()
+
+    def _limiter(self, **kwargs):
+        kwargs.setdefault('summary_logger', self.summary_logger)
+        return RateLimiter(clock=self.clock, **kwargs)
+
+    def _kept(self, limiter, count, event='db.timeout', method_name='error'):
+        kept = 0
+        for _ in range(count):
+            try:
+                limiter(self.logger, method_name, {'event': event})
+            except DropEvent:
+                pass
+            else:
+                kept += 1
+        return kept
+
+    def test_burst_then_rate(self):
+        # Given
+        limiter = self._limiter(rate=2, burst=5)
+
+        # When
+        burst = self._kept(limiter, 100)
+        self.clock.now += 1.5
+        refilled = self._kept(limiter, 100)
+
+        # Then
+        self.assertEqual(burst, 5)
+        self.assertEqual(refilled, 3)
+        self.assertEqual(limiter.suppressed, 192)
+
+    def test_keys_limited_independently(self):
+        # Given
+        limiter = self._limiter(rate=1)
+
+        # When
+        timeouts = self._kept(limiter, 10)
+        other = self._kept(limiter, 10, event='db.connect')
+        warnings = self._kept(limiter, 10, method_name='warning')
+
+        # Then
+        self.assertEqual((timeouts, other, warnings), (1, 1, 1))
+
+    def test_sampling_over_limit(self):
+        # Given
+        never = self._limiter(rate=1, sample_rate=0.0)
+        always = self._limiter(rate=1, sample_rate=1.0)
+
+        # When/Then
+        self.assertEqual(self._kept(never, 10), 1)
+        self.assertEqual(self._kept(always, 10), 10)
+
+    def test_sampling_only(self):
+        # Given
+        limiter = self._limiter(rate=None, sample_rate=0.0)
+
+        # When
+        kept = self._kept(limiter, 10)
+
+        # Then
+        self.assertEqual(kept, 0)
+        self.assertEqual(limiter.suppressed, 10)
+
+    def test_keys_bounded(self):
+        # Given
+        limiter = self._limiter(rate=1, max_keys=2)
+
+        # When
+        for event in ('a', 'b', 'c', 'a'):
+            self._kept(limiter, 1, event=event)
+
+        # Then
+        self.assertEqual(
+            [key[0] for key in limiter._buckets], ['c', 'a'])
+
+    def test_summary(self):
+        # Given
+        limiter = self._limiter(rate=1, summary_interval=10)
+        self._kept(limiter, 5)
+
+        # When
+        self.clock.now += 10
+        self._kept(limiter, 1, event='other')
+
+        # Then
+        self.summary_logger.warning.assert_called_once_with(
+            'ratelimit.suppressed', suppressed=4,
+            suppressed_key=['db.timeout', __name__, 'error'], interval=10)
+
+        # When
+        self.clock.now += 10
+        self._kept(limiter, 1, event='other')
+
+        # Then
+        self.assertEqual(self.summary_logger.warning.call_count, 1)
+
+    def test_summary_not_limited(self):
+        # Given
+        limiter = self._limiter(rate=1, summary_interval=10)
+        logged = []
+
+        def summary(event, **kw):
+            logged.append(limiter(self.logger, 'warning', {'event': event}))
+        self.summary_logger.warning.side_effect = summary
+        self._kept(limiter, 3)
+
+        # When
+        self.clock.now += 10
+        self._kept(limiter, 1)
+
+        # Then
+        self.assertEqual(logged, [{'event': 'ratelimit.suppressed'}])
+
+
+class Rejecting(logging.Filter):
+
+    def filter(self, record):
+        return False
+
+
+class TestHandlerLevelFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.parent = logging.Logger('app', logging.DEBUG)
+        self.logger = logging.Logger('app.db', logging.DEBUG)
+        self.logger.parent = self.parent
+        self.handler = logging.NullHandler(logging.WARNING)
+        self.parent.addHandler(self.handler)
+        self.processor = HandlerLevelFilter()
+
+    def _passes(self, method_name, logger=None):
+        try:
+            self.processor(logger or self.logger, method_name, {})
+        except DropEvent:
+            return False
+        return True
+
+    def test_handler_level(self):
+        # Then
+        self.assertFalse(self._passes('debug'))
+        self.assertTrue(self._passes('warning'))
+        self.assertTrue(self._passes('exception'))
+
+    def test_logger_level(self):
+        # Given
+        self.logger.setLevel(logging.ERROR)
+
+        # Then
+        self.assertFalse(self._passes('warning'))
+
+    def test_handler_changes_invalidate(self):
+        # Given
+        self.assertFalse(self._passes('info'))
+
+        # When
+        self.handler.setLevel(logging.INFO)
+        info_after_level_change = self._passes('info')
+        self.logger.addHandler(logging.NullHandler(logging.DEBUG))
+        debug_after_add = self._passes('debug')
+        self.logger.propagate = False
+        self.logger.handlers = []
+        info_without_handlers = self._passes('info')
+
+        # Then
+        self.assertTrue(info_after_level_change)
+        self.assertTrue(debug_after_add)
+        # Only the last resort handler (WARNING) is left
+        self.assertFalse(info_without_handlers)
+
+    def test_name_filters(self):
+        # Given
+        self.handler.addFilter(ExcludeFilter('app.db'))
+        other = logging.Logger('app.web', logging.DEBUG)
+        other.parent = self.parent
+
+        # Then
+        self.assertFalse(self._passes('error'))
+        self.assertTrue(self._passes('error', other))
+
+    def test_other_filters_assumed_to_accept(self):
+        # Given
+        self.handler.addFilter(Rejecting())
+
+        # Then
+        self.assertTrue(self._passes('error'))
+
+    def test_wrapped_target_level(self):
+        # Given
+        self.parent.removeHandler(self.handler)
+        wrapper = logging.NullHandler(logging.DEBUG)
+        wrapper.target = logging.NullHandler(logging.ERROR)
+        self.parent.addHandler(wrapper)
+
+        # Then
+        self.assertFalse(self._passes('warning'))
+        self.assertTrue(self._passes('error'))
+
+
+def _fail(message):
+    raise KeyError(message)
+
+
+def _fail_chained(message):
+    try:
+        _fail(message)
+    except KeyError as exc:
+        error = ValueError('wrapped')
+        error.__cause__ = exc
+        raise error
+
+
+class TestExceptionFormatter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def _format(self, formatter, function, message='x'):
+        try:
+            function(message)
+        except Exception as exc:
+            return formatter(None, 'error', {'exc_info': exc})
+
+    def test_same_text_as_structlog(self):
+        # Given
+        formatter = ExceptionFormatter()
+
+        # When
+        for function in (_fail, _fail_chained):
+            try:
+                function('x')
+            except Exception:
+                expected = format_exc_info(None, 'error', {'exc_info': True})
+                event_dict = formatter(None, 'error', {'exc_info': True})
+
+            # Then
+            self.assertEqual(event_dict['exception'], expected['exception'])
+            self.assertNotIn('exc_info', event_dict)
+
+    def test_fingerprint(self):
+        # Given
+        formatter = ExceptionFormatter()
+
+        # When
+        first = self._format(formatter, _fail_chained, 'a')
+        second = self._format(formatter, _fail_chained, 'b')
+        other = self._format(formatter, _fail, 'a')
+
+        # Then
+        self.assertEqual(
+            first['exception_fingerprint'], second['exception_fingerprint'])
+        self.assertNotEqual(
+            first['exception_fingerprint'], other['exception_fingerprint'])
+        self.assertIn("KeyError: 'b'", second['exception'])
+        self.assertNotIn("KeyError: 'a'", second['exception'])
+
+    def test_traceback_limit(self):
+        # Given
+        formatter = ExceptionFormatter(
+            traceback_limit=2, window=60, clock=self.clock)
+
+        # When
+        events = [self._format(formatter, _fail) for _ in range(3)]
+        self.clock.now += 60
+        after_window = self._format(formatter, _fail)
+
+        # Then
+        self.assertIn('Traceback', events[1]['exception'])
+        self.assertEqual(events[2]['exception'], "KeyError: 'x'")
+        self.assertTrue(events[2]['traceback_omitted'])
+        self.assertEqual(
+            events[2]['exception_fingerprint'],
+            events[0]['exception_fingerprint'])
+        self.assertIn('Traceback', after_window['exception'])
+
+    def test_cache_is_bounded(self):
+        # Given
+        formatter = ExceptionFormatter(max_entries=1)
+
+        # When
+        self._format(formatter, _fail)
+        self._format(formatter, _fail_chained)
+
+        # Then
+        self.assertEqual(len(formatter._entries), 1)
+
+    def test_without_exc_info(self):
+        # Given
+        formatter = ExceptionFormatter()
+
+        # When
+        event_dict = formatter(None, 'error', {'exc_info': False, 'a': 1})
+
+        # Then
+        self.assertEqual(event_dict, {'a': 1})
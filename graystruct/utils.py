@@ -6,12 +6,517 @@
 # of the 3-clause BSD license.  See the LICENSE.txt file for details.
 from __future__ import absolute_import
 
-from structlog._frames import _find_first_app_frame_and_name
+import collections
+import hashlib
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import traceback
+import weakref
 
+import structlog
+from structlog.stdlib import _NAME_TO_LEVEL
 
-def add_app_context(logger, method_name, event_dict):
-    f, name = _find_first_app_frame_and_name(['logging', __name__])
-    event_dict['file'] = f.f_code.co_filename
-    event_dict['line'] = f.f_lineno
-    event_dict['function'] = f.f_code.co_name
-    return event_dict
+
+# Objects whose ``_after_fork`` method runs in each forked child
+_after_fork_objects = weakref.WeakSet()
+
+
+def _register_after_fork(obj):
+    """Call ``obj._after_fork()`` in the child process after a fork.
+
+    Used by handlers to drop connections, locks, queues and threads
+    inherited from the parent.  Only effective where
+    ``os.register_at_fork`` exists (Python 3.7+ on POSIX).
+
+    """
+    _after_fork_objects.add(obj)
+
+
+def _reinit_after_fork():
+    for obj in list(_after_fork_objects):
+        try:
+            obj._after_fork()
+        except Exception:
+            if logging.raiseExceptions:
+                traceback.print_exc()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reinit_after_fork)
+
+
+class AppContextAdder(object):
+    """Processor adding the file, line and function of the logging call.
+
+    The stack is walked with ``sys._getframe``; whether a frame belongs
+    to an ignored module is decided once per code object and memoized.
+
+    :param ignore: Module name prefixes to skip when looking for the
+        calling frame, in addition to ``structlog`` and this module
+        (default ``('logging',)``).
+    :param min_level: Only add the call site for events at or above
+        this ``logging`` level (default ``None``, all events).
+    :param sample_rate: Fraction of events, between 0 and 1, for which
+        the call site is added (default ``None``, all events).
+    :param cache_size: Maximum number of memoized code objects.
+
+    """
+
+    def __init__(self, ignore=('logging',), min_level=None, sample_rate=None,
+                 cache_size=1024):
+        self.ignore = ('structlog', __name__) + tuple(ignore)
+        self.min_level = min_level
+        self.sample_rate = sample_rate
+        self.cache_size = cache_size
+        self._ignored = {}
+
+    def _is_ignored(self, code, f_globals):
+        name = f_globals.get('__name__') or '?'
+        ignored = name.startswith(self.ignore)
+        cache = self._ignored
+        if len(cache) >= self.cache_size:
+            cache.clear()
+        cache[code] = ignored
+        return ignored
+
+    def __call__(self, logger, method_name, event_dict):
+        if (self.min_level is not None and
+                _NAME_TO_LEVEL.get(method_name, 0) < self.min_level):
+            return event_dict
+        if (self.sample_rate is not None and
+                random.random() >= self.sample_rate):
+            return event_dict
+
+        ignored = self._ignored
+        f = sys._getframe()
+        while f.f_back is not None:
+            code = f.f_code
+            is_ignored = ignored.get(code)
+            if is_ignored is None:
+                is_ignored = self._is_ignored(code, f.f_globals)
+            if not is_ignored:
+                break
+            f = f.f_back
+        event_dict['file'] = f.f_code.co_filename
+        event_dict['line'] = f.f_lineno
+        event_dict['function'] = f.f_code.co_name
+        return event_dict
+
+
+add_app_context = AppContextAdder()
+
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+def _event_key(logger, method_name, event_dict):
+    return (event_dict.get('event'), getattr(logger, 'name', None),
+            method_name)
+
+
+class RateLimiter(object):
+    """Processor dropping repeated events beyond a rate limit.
+
+    Events are grouped by key, by default the event name, the logger
+    name and the level.  Each key has a token bucket refilled at
+    ``rate`` events per second and holding at most ``burst`` tokens;
+    an event arriving at an empty bucket is kept with probability
+    ``sample_rate`` and otherwise dropped by raising
+    :class:`structlog.DropEvent`.  Place it before
+    :class:`graystruct.encoder.GELFEncoder` so that dropped events are
+    never serialized.
+
+    :param rate: Events per second allowed per key, or ``None`` to only
+        sample.
+    :param burst: Bucket capacity (default ``rate``, or 1 if it is
+        lower).
+    :param sample_rate: Fraction of the events over the limit that are
+        kept anyway (default ``None``, none).  Without a ``rate``, the
+        fraction of all events kept.
+    :param key: Callable ``(logger, method_name, event_dict)`` returning
+        the key of an event.
+    :param max_keys: Number of keys tracked; the least recently seen key
+        is forgotten beyond that.
+    :param summary_interval: Seconds between summaries of suppressed
+        events, or ``None`` to disable them.
+    :param summary_logger: structlog logger the summaries are logged to,
+        as one ``'ratelimit.suppressed'`` warning per key (default
+        ``structlog.get_logger('graystruct.ratelimit')``).
+
+    Summaries are due once ``summary_interval`` has elapsed and are
+    logged while processing the next event.  ``suppressed`` counts all
+    dropped events.
+
+    """
+
+    def __init__(self, rate=10, burst=None, sample_rate=None,
+                 key=_event_key, max_keys=1024, summary_interval=60,
+                 summary_logger=None, clock=_monotonic):
+        if rate is None and sample_rate is None:
+            raise ValueError('one of rate and sample_rate is required')
+        self.rate = rate
+        if burst is None and rate is not None:
+            burst = max(rate, 1)
+        self.burst = burst
+        self.sample_rate = sample_rate
+        self.key = key
+        self.max_keys = max_keys
+        self.summary_interval = summary_interval
+        self.summary_logger = summary_logger
+        self.suppressed = 0
+        self._clock = clock
+        # key -> [tokens, last refill time, suppressed since summary]
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._next_summary = (
+            None if summary_interval is None
+            else clock() + summary_interval)
+        _register_after_fork(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def _allow(self, key, now):
+        with self._lock:
+            buckets = self._buckets
+            bucket = buckets.get(key)
+            if bucket is None:
+                if len(buckets) >= self.max_keys:
+                    buckets.popitem(last=False)
+                bucket = buckets[key] = [self.burst, now, 0]
+            else:
+                buckets[key] = buckets.pop(key)
+                bucket[0] = min(
+                    self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return True
+            if (self.sample_rate is not None and
+                    random.random() < self.sample_rate):
+                return True
+            bucket[2] += 1
+            self.suppressed += 1
+            return False
+
+    def _sample(self, key):
+        if random.random() < self.sample_rate:
+            return True
+        with self._lock:
+            buckets = self._buckets
+            bucket = buckets.get(key)
+            if bucket is None:
+                if len(buckets) >= self.max_keys:
+                    buckets.popitem(last=False)
+                bucket = buckets[key] = [0, 0, 0]
+            else:
+                buckets[key] = buckets.pop(key)
+            bucket[2] += 1
+            self.suppressed += 1
+        return False
+
+    def _summarize(self, now):
+        with self._lock:
+            if now < self._next_summary:
+                return
+            self._next_summary = now + self.summary_interval
+            counts = []
+            for key, bucket in self._buckets.items():
+                if bucket[2]:
+                    counts.append((key, bucket[2]))
+                    bucket[2] = 0
+        if not counts:
+            return
+        logger = self.summary_logger
+        if logger is None:
+            logger = structlog.get_logger('graystruct.ratelimit')
+        self._local.summarizing = True
+        try:
+            for key, count in counts:
+                logger.warning(
+                    'ratelimit.suppressed', suppressed=count,
+                    suppressed_key=list(key) if isinstance(key, tuple)
+                    else key,
+                    interval=self.summary_interval)
+        finally:
+            self._local.summarizing = False
+
+    def __call__(self, logger, method_name, event_dict):
+        if getattr(self._local, 'summarizing', False):
+            return event_dict
+        key = self.key(logger, method_name, event_dict)
+        now = self._clock()
+        if self.rate is None:
+            allowed = self._sample(key)
+        else:
+            allowed = self._allow(key, now)
+        if (self._next_summary is not None and
+                now >= self._next_summary):
+            self._summarize(now)
+        if not allowed:
+            raise structlog.DropEvent
+        return event_dict
+
+
+def _checks_name_only(log_filter):
+    # Only these filters can be asked before the record is formatted
+    return (type(log_filter) is logging.Filter or
+            getattr(log_filter, 'checks_name_only', False))
+
+
+def _handler_accepts(handler, record):
+    if record.levelno < handler.level:
+        return False
+    for log_filter in handler.filters:
+        if _checks_name_only(log_filter) and not log_filter.filter(record):
+            return False
+    # Wrappers such as QueuedGELFHandler pass records on to a target
+    target = getattr(handler, 'target', None)
+    if isinstance(target, logging.Handler) and target is not handler:
+        return _handler_accepts(target, record)
+    return True
+
+
+def _handler_signature(logger):
+    signature = []
+    while logger is not None:
+        signature.append(logger.propagate)
+        for handler in logger.handlers:
+            signature.append(handler)
+            signature.append(handler.level)
+            if handler.filters:
+                signature.append(tuple(handler.filters))
+        if not logger.propagate:
+            break
+        logger = logger.parent
+    return tuple(signature)
+
+
+class HandlerLevelFilter(object):
+    """Processor dropping events that no attached handler would emit.
+
+    Replaces :func:`structlog.stdlib.filter_by_level` as the first
+    processor: besides the level of the stdlib logger, it checks the
+    levels of the handlers the record would reach and their
+    ``logging.Filter`` and :class:`graystruct.rabbitmq.ExcludeFilter`
+    filters, and raises :class:`structlog.DropEvent` when none of them
+    would accept it.  Other filters are assumed to accept the record.
+
+    The decision is cached per logger and level, and made again when
+    the handlers, their levels or their filters change.
+
+    :param cache_size: Maximum number of cached decisions.
+
+    """
+
+    def __init__(self, cache_size=1024):
+        self.cache_size = cache_size
+        self._cache = {}
+
+    def _accepts(self, logger, levelno):
+        record = logging.LogRecord(
+            logger.name, levelno, '', 0, '', None, None)
+        found = False
+        current = logger
+        while current is not None:
+            for handler in current.handlers:
+                found = True
+                if _handler_accepts(handler, record):
+                    return True
+            if not current.propagate:
+                break
+            current = current.parent
+        last_resort = getattr(logging, 'lastResort', None)
+        if not found and last_resort is not None:
+            return _handler_accepts(last_resort, record)
+        return False
+
+    def __call__(self, logger, method_name, event_dict):
+        levelno = _NAME_TO_LEVEL.get(method_name)
+        if levelno is None or not isinstance(logger, logging.Logger):
+            return event_dict
+        if not logger.isEnabledFor(levelno):
+            raise structlog.DropEvent
+        key = (logger, levelno)
+        signature = _handler_signature(logger)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] == signature:
+            accepted = cached[1]
+        else:
+            accepted = self._accepts(logger, levelno)
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[key] = (signature, accepted)
+        if not accepted:
+            raise structlog.DropEvent
+        return event_dict
+
+
+filter_by_handler_level = HandlerLevelFilter()
+
+
+_CAUSE_MESSAGE = (
+    '\nThe above exception was the direct cause of the following '
+    'exception:\n\n')
+_CONTEXT_MESSAGE = (
+    '\nDuring handling of the above exception, another exception '
+    'occurred:\n\n')
+
+
+def _exc_info(value):
+    if value is True:
+        return sys.exc_info()
+    if isinstance(value, BaseException):
+        return type(value), value, getattr(value, '__traceback__', None)
+    return value
+
+
+def _exception_chain(exc_type, exc_value, tb):
+    """Return ``[(type, value, traceback, link)]``, outermost first.
+
+    ``link`` is the message printed between an exception and the one
+    that caused it, or ``None`` for the innermost exception.
+
+    """
+    chain = []
+    seen = set()
+    while True:
+        seen.add(id(exc_value))
+        cause = getattr(exc_value, '__cause__', None)
+        context = getattr(exc_value, '__context__', None)
+        if cause is not None:
+            inner, link = cause, _CAUSE_MESSAGE
+        elif (context is not None and
+              not getattr(exc_value, '__suppress_context__', False)):
+            inner, link = context, _CONTEXT_MESSAGE
+        else:
+            inner = link = None
+        if inner is not None and id(inner) in seen:
+            inner = link = None
+        chain.append((exc_type, exc_value, tb, link))
+        if inner is None:
+            return chain
+        exc_type, exc_value, tb = (
+            type(inner), inner, getattr(inner, '__traceback__', None))
+
+
+def _fingerprint(chain):
+    parts = []
+    for exc_type, _, tb, link in chain:
+        parts.append('{}.{}'.format(
+            exc_type.__module__,
+            getattr(exc_type, '__qualname__', exc_type.__name__)))
+        while tb is not None:
+            parts.append('{}:{}:{}'.format(
+                tb.tb_frame.f_globals.get('__name__', '?'),
+                tb.tb_frame.f_code.co_name, tb.tb_lineno))
+            tb = tb.tb_next
+        parts.append('cause' if link is _CAUSE_MESSAGE else 'context')
+    return hashlib.sha1(
+        '\n'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+
+def _format_stacks(chain):
+    return [
+        None if tb is None else 'Traceback (most recent call last):\n' +
+        ''.join(traceback.format_list(traceback.extract_tb(tb)))
+        for _, _, tb, _ in chain]
+
+
+class ExceptionFormatter(object):
+    """Processor rendering ``exc_info`` with cached tracebacks.
+
+    A drop-in replacement for
+    :func:`structlog.processors.format_exc_info` producing the same
+    ``exception`` text.  Tracebacks are fingerprinted by the exception
+    types and the module, function and line of each frame, including
+    chained exceptions; the rendered stacks are kept per fingerprint,
+    so repeated errors only format their exception messages.  The
+    fingerprint is added as ``exception_fingerprint`` for grouping in
+    Graylog.
+
+    :param traceback_limit: Send the traceback with only the first
+        ``traceback_limit`` occurrences of a fingerprint per ``window``;
+        later ones carry the exception message alone and
+        ``traceback_omitted``.  ``None`` (the default) always sends it.
+    :param window: Seconds after which the occurrences are counted anew.
+    :param max_entries: Number of fingerprints cached; the least
+        recently seen is forgotten beyond that.
+
+    """
+
+    def __init__(self, traceback_limit=None, window=60, max_entries=256,
+                 clock=_monotonic):
+        self.traceback_limit = traceback_limit
+        self.window = window
+        self.max_entries = max_entries
+        self._clock = clock
+        # fingerprint -> [rendered stacks, window start, occurrences]
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        _register_after_fork(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def _entry(self, fingerprint, chain):
+        now = self._clock()
+        with self._lock:
+            entries = self._entries
+            entry = entries.get(fingerprint)
+            if entry is None:
+                if len(entries) >= self.max_entries:
+                    entries.popitem(last=False)
+                entry = entries[fingerprint] = [None, now, 0]
+            else:
+                entries[fingerprint] = entries.pop(fingerprint)
+                if now - entry[1] >= self.window:
+                    entry[1] = now
+                    entry[2] = 0
+            entry[2] += 1
+            occurrences = entry[2]
+            stacks = entry[0]
+        if stacks is None:
+            # Rendered outside the lock; a concurrent miss renders twice
+            stacks = entry[0] = _format_stacks(chain)
+        return stacks, occurrences
+
+    def __call__(self, logger, method_name, event_dict):
+        exc_info = event_dict.pop('exc_info', None)
+        if not exc_info:
+            return event_dict
+        exc_type, exc_value, tb = _exc_info(exc_info)
+        if exc_type is None:
+            return event_dict
+        chain = _exception_chain(exc_type, exc_value, tb)
+        fingerprint = _fingerprint(chain)
+        stacks, occurrences = self._entry(fingerprint, chain)
+        event_dict['exception_fingerprint'] = fingerprint
+        if (self.traceback_limit is not None and
+                occurrences > self.traceback_limit):
+            text = ''.join(traceback.format_exception_only(
+                exc_type, exc_value))
+            event_dict['traceback_omitted'] = True
+        else:
+            parts = []
+            for index in range(len(chain) - 1, -1, -1):
+                exc_type, exc_value, _, _ = chain[index]
+                if stacks[index] is not None:
+                    parts.append(stacks[index])
+                parts.extend(
+                    traceback.format_exception_only(exc_type, exc_value))
+                if index:
+                    parts.append(chain[index - 1][3])
+            text = ''.join(parts)
+        if text.endswith('\n'):
+            text = text[:-1]
+        event_dict['exception'] = text
+        return event_dict
+
+
+format_exc_info = ExceptionFormatter()
@@ -143,5 +143,10 @@ if __name__ == "__main__":
         license='BSD',
         packages=['graystruct'],
         install_requires=install_requires,
-        extras_require={'amqp': ['amqp==1.4.6']},
+        extras_require={
+            'amqp': ['amqp==1.4.6'],
+            'orjson': ['orjson'],
+            'rapidjson': ['python-rapidjson'],
+            'ujson': ['ujson'],
+        },
     )